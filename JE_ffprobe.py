@@ -1,19 +1,110 @@
+import asyncio
+import struct
+import subprocess
+
 import ffmpeg
 
+import instrument
+import mp4_reader
+import probe_store
+from probe_store import probe_async  # moved to probe_store, still importable from here
+
+
 class JE_FFProbe():
+    """ The streams of a video file and the extraction of their raw data
+    ffprobe only runs when the format or streams are first needed, through
+    `probe_store`, so every probe of a file in the process shares one result.
+    """
 
-    def __init__(self, video_path):
+    def __init__(self, video_path, cache=None, probe=None):
 
         self.video_path = video_path
+        self.cache = cache
+        self._probe = probe
+        # codec tags from the MP4 track headers: None until read, False when not readable
+        self._track_codes = None
 
-        self.probe = ffmpeg.probe(video_path)
-        self.format = self.probe["format"]
-        self.streams = self.probe["streams"]
+    @property
+    def probe(self):
 
-    def get_stream_codes(self):
+        if self._probe is None:
+            self._probe = probe_store.get_probe(self.video_path, self.cache)
+        return self._probe
+
+    @property
+    def format(self):
+
+        return self.probe["format"]
+
+    @property
+    def streams(self):
+
+        return self.probe["streams"]
+
+    @classmethod
+    async def open_async(cls, video_path, cache=None):
+        """ Open a file without blocking the event loop
+        The codec tags are read from the MP4 track headers on the loop executor,
+        ffprobe only runs, as a subprocess, when the native reader cannot parse
+        the file.
+        Parameters
+        ----------
+        video_path: str
+            The input file
+        cache: TelemetryCache, optional
+            Where to read and store the probe result.
+        Returns
+        -------
+        probe: JE_FFProbe
+        """
+        self = cls(video_path, cache)
+        await asyncio.get_running_loop().run_in_executor(None, self._read_track_codes)
+        if self._track_codes is False:
+            await self.load_probe_async()
+        return self
+
+    async def load_probe_async(self):
+        """ Run ffprobe, if not done yet, without blocking the event loop """
+        if self._probe is None:
+            self._probe = await probe_store.get_probe_async(self.video_path, self.cache)
+        return self._probe
+
+    def _read_track_codes(self):
 
+        if self._track_codes is None:
+            try:
+                self._track_codes = [track.codec_tag for track in mp4_reader.read_track_info(self.video_path, sized_codecs=())]
+            except (RuntimeError, KeyError, struct.error):
+                self._track_codes = False
+        return self._track_codes
+
+    def get_stream_codes(self):
+        """ The codec tag of every stream
+        Before the file is probed, the tags are read from the MP4 track headers,
+        so telling clips apart does not need ffprobe.
+        """
+        if self._probe is None and self._read_track_codes() is not False:
+            return self._track_codes
         return [s["codec_tag_string"] for s in self.streams]
 
+    def get_stream(self, codec_tag):
+        """ The ffprobe description of the first stream with a codec tag, None if missing """
+        return next((s for s in self.streams if s["codec_tag_string"] == codec_tag), None)
+
+    def get_duration(self):
+        """ The duration of the file in seconds, from the container format """
+        return float(self.format["duration"])
+
+    def get_stream_index(self, codec_tag):
+
+        stream_index = -1
+        for s in self.streams:
+            if s["codec_tag_string"] == codec_tag:
+                stream_index = s["index"]
+
+        assert stream_index != -1, f"codec_tag {codec_tag} not found in {self.video_path}"
+        return stream_index
+
     def log_dict_sumary(self, log_dict, prefix=""):
 
         for k, v in log_dict.items():
@@ -37,17 +128,152 @@ class JE_FFProbe():
             print("STREAM: ", s["codec_tag_string"])
             self.log_dict_sumary(s)
 
-    def extract_bin_stream(self, codec_tag, verbose=False):
+    def extract_bin_stream(self, codec_tag, verbose=False, backend="auto"):
+        """ Extract the raw data of the stream with the given codec tag
+        Parameters
+        ----------
+        codec_tag: str
+            The codec tag of the stream, e.g. "gpmd" or "text".
+        verbose: bool, optional (default=False)
+            If True, display ffmpeg messages.
+        backend: str, optional (default="auto")
+            "native" reads the samples straight from the MP4 sample tables,
+            "ffmpeg" copies the stream through an ffmpeg process and "auto"
+            tries the native reader first and falls back to ffmpeg.
+            When the probe has a cache, the data is read from it if present.
+        Returns
+        -------
+        data: bytes
+            The raw stream data
+        """
+        assert backend in ("auto", "native", "ffmpeg"), f"unknown backend {backend}"
 
-        stream_index = -1
-        for s in self.streams:
-            if s["codec_tag_string"] == codec_tag:
-                stream_index = s["index"]
+        if self.cache is not None:
+            data = self.cache.get_stream(self.video_path, codec_tag)
+            if data is None:
+                data = self._timed_extract_bin_stream(codec_tag, verbose, backend)
+                self.cache.put_stream(self.video_path, codec_tag, data)
+            return data
+
+        return self._timed_extract_bin_stream(codec_tag, verbose, backend)
+
+    def _timed_extract_bin_stream(self, codec_tag, verbose, backend):
 
-        assert stream_index != -1, f"codec_tag {codec_tag} not found in {self.video_path10}"
+        with instrument.stage("extract") as stage:
+            data = self._extract_bin_stream(codec_tag, verbose, backend)
+            stage.add(bytes_in=len(data), items_out=1)
+        return data
+
+    def _extract_bin_stream(self, codec_tag, verbose, backend):
+
+        if backend != "ffmpeg":
+            try:
+                return mp4_reader.extract_bin_stream(self.video_path, codec_tag)
+            except (RuntimeError, KeyError, struct.error):
+                if backend == "native":
+                    raise
+
+        stream_index = self.get_stream_index(codec_tag)
 
         ffmpeg_input = ffmpeg.input(self.video_path)
         ffmpeg_output = ffmpeg_input.output("pipe:", format="rawvideo", map="0:%i" % stream_index, codec="copy")
         bin = ffmpeg_output.run(capture_stdout=True, capture_stderr=not verbose)
 
         return bin[0]
+
+    async def extract_bin_stream_async(self, codec_tag, verbose=False, backend="auto", executor=None):
+        """ Extract the raw data of a stream without blocking the event loop
+        The native reader and the cache run on `executor`, ffprobe and ffmpeg
+        run as asyncio subprocesses, only when the native reader fails.
+        Parameters
+        ----------
+        codec_tag: str
+            The codec tag of the stream, e.g. "gpmd" or "text".
+        verbose: bool, optional (default=False)
+            If True, display ffmpeg messages.
+        backend: str, optional (default="auto")
+            See `extract_bin_stream`.
+        executor: concurrent.futures.Executor, optional
+            Where to run the blocking file reads. Defaults to the loop executor.
+        Returns
+        -------
+        data: bytes
+            The raw stream data
+        """
+        assert backend in ("auto", "native", "ffmpeg"), f"unknown backend {backend}"
+        loop = asyncio.get_running_loop()
+
+        if self.cache is not None:
+            data = await loop.run_in_executor(executor, self.cache.get_stream, self.video_path, codec_tag)
+            if data is not None:
+                return data
+
+        data = None
+        if backend != "ffmpeg":
+            try:
+                data = await loop.run_in_executor(executor, mp4_reader.extract_bin_stream, self.video_path, codec_tag)
+            except (RuntimeError, KeyError, struct.error):
+                if backend == "native":
+                    raise
+
+        if data is None:
+            await self.load_probe_async()
+            ffmpeg_input = ffmpeg.input(self.video_path)
+            ffmpeg_output = ffmpeg_input.output("pipe:", format="rawvideo", map="0:%i" % self.get_stream_index(codec_tag), codec="copy")
+            process = await asyncio.create_subprocess_exec(
+                *ffmpeg_output.compile(), stdout=asyncio.subprocess.PIPE,
+                stderr=None if verbose else asyncio.subprocess.PIPE)
+            data, err = await process.communicate()
+            if process.returncode != 0:
+                raise ffmpeg.Error("ffmpeg", data, err)
+
+        if self.cache is not None:
+            await loop.run_in_executor(executor, self.cache.put_stream, self.video_path, codec_tag, data)
+        return data
+
+    def iter_bin_stream(self, codec_tag, verbose=False, backend="auto", chunk_size=1 << 16):
+        """ Read the raw data of a stream in chunks, without holding all of it in memory
+        Parameters
+        ----------
+        codec_tag: str
+            The codec tag of the stream, e.g. "gpmd" or "text".
+        verbose: bool, optional (default=False)
+            If True, display ffmpeg messages.
+        backend: str, optional (default="auto")
+            See `extract_bin_stream`.
+        chunk_size: int, optional
+            The size of the reads from the ffmpeg pipe.
+        Returns
+        -------
+        chunk_gen: generator
+            A generator of bytes: one MP4 sample per chunk with the native reader,
+            `chunk_size` reads of the ffmpeg pipe otherwise.
+        """
+        assert backend in ("auto", "native", "ffmpeg"), f"unknown backend {backend}"
+
+        if backend != "ffmpeg":
+            try:
+                track = mp4_reader.find_track(self.video_path, codec_tag)
+            except (RuntimeError, KeyError, struct.error):
+                if backend == "native":
+                    raise
+            else:
+                yield from mp4_reader.iter_samples(self.video_path, track)
+                return
+
+        stream_index = self.get_stream_index(codec_tag)
+
+        ffmpeg_input = ffmpeg.input(self.video_path)
+        ffmpeg_output = ffmpeg_input.output("pipe:", format="rawvideo", map="0:%i" % stream_index, codec="copy")
+        process = subprocess.Popen(ffmpeg_output.compile(), stdout=subprocess.PIPE,
+                                   stderr=None if verbose else subprocess.DEVNULL)
+        try:
+            for chunk in iter(lambda: process.stdout.read(chunk_size), b""):
+                yield chunk
+            if process.wait() != 0:
+                raise RuntimeError(f"ffmpeg failed with code {process.returncode} on {self.video_path}")
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
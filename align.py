@@ -0,0 +1,213 @@
+import numpy as np
+
+from np_telem import NPIMU
+import time_utils
+
+
+class NPAligned:
+    """ Several telemetry streams resampled on one shared time axis
+
+    `columns` maps "<stream>_<column>" names (e.g. "gyro_x") to arrays of the
+    same length as `np_msecs`.
+    """
+
+    def __init__(self, msecs, columns, start_timestamp=None):
+
+        self.np_msecs = msecs
+        self.columns = columns
+        self.start_timestamp = start_timestamp
+
+    def to_array(self, names=None, dtype=np.float32):
+        """ Stack the columns into a (N, k) array, e.g. for a model input """
+        names = list(self.columns) if names is None else names
+        out = np.empty((len(self.np_msecs), len(names)), dtype=dtype)
+        for i, name in enumerate(names):
+            out[:, i] = self.columns[name]
+        return out
+
+
+def _stream_offsets(streams):
+    """ Offset in msecs of each stream on a shared time axis
+    Streams that know the UTC time of their first point are placed relative to
+    the earliest of them, the others are assumed to start at 0.
+    """
+    starts = {name: getattr(stream, "start_timestamp", None) for name, stream in streams.items()}
+    known = [start for start in starts.values() if start is not None]
+    origin = min(known) if known else None
+    offsets = {
+        name: 0. if start is None else (start - origin) / time_utils.NS_PER_MSEC
+        for name, start in starts.items()
+    }
+    return offsets, origin
+
+
+def _sample_range(stream, offset, targets):
+    """ The samples of a compact stream surrounding some target times
+    Parameters
+    ----------
+    stream: np_telem.NPIMU
+    offset: float
+        The offset of the stream on the shared time axis, see `_stream_offsets`.
+    targets: numpy.ndarray
+        The output times.
+    Returns
+    -------
+    start, end: int
+        The range of samples of the blocks holding the targets, with one block
+        of margin on each side for the neighbours of the targets.
+    """
+    nblocks = len(stream.np_block_starts)
+    if not len(targets) or not nblocks:
+        return 0, 0
+    block_msecs = stream.np_block_msecs + offset
+    first = max(int(np.searchsorted(block_msecs, targets.min(), side="right")) - 2, 0)
+    last = int(np.searchsorted(block_msecs, targets.max(), side="right")) + 1
+    end = int(stream.np_block_starts[last]) if last < nblocks else len(stream.np_raw)
+    return int(stream.np_block_starts[first]), end
+
+
+def locate(x, targets):
+    """ Find the samples surrounding each target time
+    Parameters
+    ----------
+    x: numpy.ndarray
+        The sorted sample times.
+    targets: numpy.ndarray
+        The times to interpolate at.
+    Returns
+    -------
+    left, right: numpy.ndarray
+        Index of the samples before and after each target.
+    weight: numpy.ndarray
+        The relative position of each target between them.
+    outside: numpy.ndarray
+        True for the targets outside of [x[0], x[-1]].
+    """
+    if len(x) == 0:
+        zeros = np.zeros(len(targets), dtype=np.int64)
+        return zeros, zeros, np.zeros(len(targets)), np.ones(len(targets), dtype=bool)
+
+    right = np.minimum(np.maximum(np.searchsorted(x, targets, side="right"), 1), len(x) - 1)
+    left = np.maximum(right - 1, 0)
+    x0 = x[left]
+    span = x[right] - x0
+    weight = np.divide(targets - x0, span, out=np.zeros(len(targets)), where=span > 0)
+    return left, right, weight, (targets < x[0]) | (targets > x[-1])
+
+
+def interpolate(y, location, method="linear", out=None):
+    """ Interpolate sampled values at the positions found by `locate`
+    Parameters
+    ----------
+    y: numpy.ndarray
+        The sample values.
+    location: tuple
+        The result of `locate` for the sample times of `y`.
+    method: str, optional (default="linear")
+        "linear" or "nearest".
+    out: numpy.ndarray, optional
+        Where to write the result.
+    Returns
+    -------
+    values: numpy.ndarray
+        The interpolated values, nan outside of the sampled time range.
+    """
+    left, right, weight, outside = location
+    if out is None:
+        out = np.empty(len(left))
+    if len(y) == 0:
+        out[:] = np.nan
+        return out
+
+    if method == "linear":
+        y0 = y[left]
+        np.add(y0, weight * (y[right] - y0), out=out)
+    elif method == "nearest":
+        out[:] = np.where(weight < 0.5, y[left], y[right])
+    else:
+        raise ValueError("Unknown interpolation method %s" % method)
+
+    out[outside] = np.nan
+    return out
+
+
+def resample(streams, rate=None, msecs=None, reference=None, method="linear", chunk_size=1 << 18):
+    """ Resample several telemetry streams onto one shared time axis
+    Exactly one of `rate`, `msecs` or `reference` chooses the output times.
+    Parameters
+    ----------
+    streams: dict of str to NP* object
+        The streams to align, e.g. {"gps": np_gps, "gyro": np_gyro}. Each object
+        needs `np_msecs` and a `columns` tuple of attribute names. Rows with a
+        nan time are ignored. Compact
+        `np_telem.NPIMU` streams are only scaled and timed over the samples
+        around each chunk of output times.
+    rate: float, optional
+        Output rate in Hz, over the time range covered by all the streams.
+        Empty when no stream has any sample.
+    msecs: numpy.ndarray, optional
+        Output times in msecs on the shared time axis.
+    reference: str, optional
+        Name of the stream whose own times are used as output times.
+    method: str, optional (default="linear")
+        "linear" or "nearest".
+    chunk_size: int, optional
+        The number of output times processed at once, bounding the temporary memory.
+    Returns
+    -------
+    aligned: NPAligned
+    """
+    assert sum(arg is not None for arg in (rate, msecs, reference)) == 1, "give one of rate, msecs or reference"
+
+    offsets, origin = _stream_offsets(streams)
+    compact = {name for name, stream in streams.items() if isinstance(stream, NPIMU)}
+    times = {name: np.asarray(stream.np_msecs, dtype=np.float64) + offsets[name]
+             for name, stream in streams.items() if name not in compact or name == reference}
+    # rows without a time, e.g. void GPRMC sentences, are left out
+    timed_rows = {}
+    for name, t in times.items():
+        finite = np.isfinite(t)
+        if not finite.all():
+            timed_rows[name] = np.flatnonzero(finite)
+            times[name] = t[finite]
+
+    if reference is not None:
+        msecs = times[reference]
+    elif rate is not None:
+        bounds = [(t[0], t[-1]) for t in times.values() if len(t)]
+        for name in compact:
+            npoints = len(streams[name].np_raw)
+            if npoints:
+                bounds.append((streams[name].sample_msecs(0, 1)[0] + offsets[name],
+                               streams[name].sample_msecs(npoints - 1, npoints)[0] + offsets[name]))
+        # without any sample there is no common time range, the output is empty
+        start = max((first for first, _ in bounds), default=0.)
+        end = min((last for _, last in bounds), default=0.)
+        msecs = np.arange(start, end, 1000. / rate) if end > start else np.zeros(0)
+    msecs = np.asarray(msecs, dtype=np.float64)
+
+    names = {
+        name: ["%s_%s" % (name, column[len("np_"):]) for column in stream.columns]
+        for name, stream in streams.items()
+    }
+    out = {column_name: np.empty(len(msecs)) for column_names in names.values() for column_name in column_names}
+
+    for start in range(0, len(msecs), chunk_size):
+        targets = msecs[start: start + chunk_size]
+        for name, stream in streams.items():
+            if name in compact:
+                sample_start, sample_end = _sample_range(stream, offsets[name], targets)
+                location = locate(stream.sample_msecs(sample_start, sample_end) + offsets[name], targets)
+                for axis, column_name in enumerate(names[name]):
+                    interpolate(stream.scaled(sample_start, sample_end, axis, np.float64), location, method,
+                                out=out[column_name][start: start + chunk_size])
+                continue
+            location = locate(times[name], targets)
+            if name in timed_rows and len(timed_rows[name]):
+                left, right, weight, outside = location
+                location = timed_rows[name][left], timed_rows[name][right], weight, outside
+            for column, column_name in zip(stream.columns, names[name]):
+                interpolate(np.asarray(getattr(stream, column)), location, method,
+                            out=out[column_name][start: start + chunk_size])
+
+    return NPAligned(msecs, out, origin)
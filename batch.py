@@ -0,0 +1,324 @@
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+
+from cache import TelemetryCache, default_max_bytes
+from JE_ffprobe import JE_FFProbe
+from gps_data_extractor import extract_nextbase_from_video
+import instrument
+import main
+from spatial_index import SpatialIndex
+import time_utils
+
+video_extensions = {".mp4", ".mov"}
+# finished clips between two evictions of the cache by `run_batch`
+evict_interval = 64
+
+ClipResult = namedtuple("ClipResult",
+                        [
+                            "video_path",
+                            "output_path",
+                            "kind",
+                            "nbytes",
+                            "npoints",
+                            "seconds",
+                            "error",
+                            "stats",
+                        ])
+
+
+def find_videos(inputs):
+    """ Expand directories and glob patterns into a sorted list of video files
+    Parameters
+    ----------
+    inputs: list of str
+        Files, directories (searched recursively) or glob patterns.
+    Returns
+    -------
+    video_paths: list of str
+    """
+    video_paths = set()
+    for pattern in inputs:
+        for path in glob.glob(pattern, recursive=True) or [pattern]:
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    for name in files:
+                        if os.path.splitext(name)[1].lower() in video_extensions:
+                            video_paths.add(os.path.join(root, name))
+            elif os.path.isfile(path):
+                video_paths.add(path)
+
+    return sorted(video_paths)
+
+
+def detect_kind(probe):
+    """ Tell GoPro and Nextbase clips apart from their stream codec tags
+    Parameters
+    ----------
+    probe: JE_FFProbe
+    Returns
+    -------
+    kind: str or None
+        "gopro" for a `gpmd` track, "nextbase" for a `text` track, None otherwise.
+    """
+    codes = probe.get_stream_codes()
+    if "gpmd" in codes:
+        return "gopro"
+    if "text" in codes:
+        return "nextbase"
+    return None
+
+
+def extract_gopro(probe):
+
+    np_gps, np_gyro, np_accl = main.decode_gpmf_stream(probe.extract_bin_stream("gpmd"))
+    return {
+        "gps_msecs": np_gps.np_msecs,
+        "gps_lat": np_gps.np_lat,
+        "gps_long": np_gps.np_long,
+        "gps_elev": np_gps.np_elev,
+        "gps_start_timestamp": np.int64(time_utils.NO_TIMESTAMP if np_gps.start_timestamp is None else np_gps.start_timestamp),
+        "gyro_msecs": np_gyro.np_msecs,
+        "gyro_z": np_gyro.np_z,
+        "gyro_x": np_gyro.np_x,
+        "gyro_y": np_gyro.np_y,
+        "accl_msecs": np_accl.np_msecs,
+        "accl_z": np_accl.np_z,
+        "accl_x": np_accl.np_x,
+        "accl_y": np_accl.np_y,
+    }
+
+
+def extract_nextbase(probe):
+
+    np_accl, np_gyro, np_gprmc, np_gpgga = extract_nextbase_from_video(probe.video_path, probe=probe)
+    return {
+        "gps_timestamps": np_gprmc.np_timestamps,
+        "gps_msecs": np_gprmc.np_msecs,
+        "gps_lat": np_gprmc.np_lat,
+        "gps_long": np_gprmc.np_long,
+        "gps_speed": np_gprmc.np_speed,
+        "gps_bearing": np_gprmc.np_bearing,
+        "gps_valid": np_gprmc.np_valid,
+        "gps_start_timestamp": np.int64(time_utils.NO_TIMESTAMP if np_gprmc.start_timestamp is None else np_gprmc.start_timestamp),
+        "gps_altitude": np_gpgga.np_altitude,
+        "gps_satellites": np_gpgga.np_satellites,
+        "imu_start_timestamp": np.int64(time_utils.NO_TIMESTAMP if np_accl.start_timestamp is None else np_accl.start_timestamp),
+        "gyro_msecs": np_gyro.np_msecs,
+        "gyro_z": np_gyro.np_z,
+        "gyro_x": np_gyro.np_x,
+        "gyro_y": np_gyro.np_y,
+        "accl_msecs": np_accl.np_msecs,
+        "accl_z": np_accl.np_z,
+        "accl_x": np_accl.np_x,
+        "accl_y": np_accl.np_y,
+    }
+
+
+extractors = {
+    "gopro": extract_gopro,
+    "nextbase": extract_nextbase,
+}
+
+
+def get_output_path(video_path, output_dir, root=None):
+    """ Path of the `.npz` output of a clip
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    output_dir: str or None
+        Where to write the output. Defaults to next to the input file.
+    root: str, optional
+        The directory the inputs are relative to. The output keeps the path of
+        the input below it, so clips with the same name in different
+        directories do not overwrite each other. Defaults to the directory of
+        the input.
+    Returns
+    -------
+    output_path: str
+    """
+    if not output_dir:
+        return os.path.splitext(video_path)[0] + ".npz"
+    root = root if root is not None else os.path.dirname(os.path.abspath(video_path))
+    name = os.path.splitext(os.path.relpath(os.path.abspath(video_path), root))[0] + ".npz"
+    return os.path.join(output_dir, name)
+
+
+def get_common_root(video_paths):
+    """ The deepest directory holding all the input files, None without input """
+    if not video_paths:
+        return None
+    return os.path.commonpath([os.path.dirname(os.path.abspath(video_path)) for video_path in video_paths])
+
+
+def process_clip(video_path, output_dir=None, cache_dir=None, stats=False, root=None, cache_max_bytes=default_max_bytes):
+    """ Extract the telemetry of one clip and save it as a `.npz` file
+    Any exception is caught and reported in the result, so that one bad clip
+    does not stop a batch.
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    output_dir: str, optional
+        Where to write the output. Defaults to next to the input file.
+    cache_dir: str, optional
+        If given, the probe, raw stream and decoded arrays are cached there
+        and reused on the next runs.
+    stats: bool, optional (default=False)
+        If True, record the statistics of each stage in the result, see `instrument`.
+    root: str, optional
+        The directory the output path is relative to, see `get_output_path`.
+    cache_max_bytes: int, optional
+        The size limit of the cache, see `TelemetryCache`.
+    Returns
+    -------
+    result: ClipResult
+        `npoints` is the number of samples over all the sensors.
+    """
+    start = time.perf_counter()
+    nbytes = 0
+    if stats:
+        instrument.enable(memory=True)
+        instrument.reset()
+    try:
+        nbytes = os.path.getsize(video_path)
+        # evicted by `run_batch`, not by each worker
+        cache = TelemetryCache(cache_dir, cache_max_bytes, evict_every=None) if cache_dir is not None else None
+        probe = JE_FFProbe(video_path, cache=cache)
+        kind = detect_kind(probe)
+        if kind is None:
+            raise RuntimeError("No gpmd or text telemetry stream found")
+        arrays = cache.get_columns(video_path, kind) if cache is not None else None
+        if arrays is None:
+            arrays = extractors[kind](probe)
+            if cache is not None:
+                cache.put_columns(video_path, kind, arrays)
+        output_path = get_output_path(video_path, output_dir, root)
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        # one time column per sensor
+        npoints = sum(len(a) for k, a in arrays.items() if k.endswith("_msecs"))
+        with instrument.stage("export", items_out=npoints):
+            np.savez(output_path, **arrays)
+        return ClipResult(video_path, output_path, kind, nbytes, npoints, time.perf_counter() - start, None,
+                          instrument.get_stats() if stats else None)
+    except Exception:
+        return ClipResult(video_path, None, None, nbytes, 0, time.perf_counter() - start, traceback.format_exc(),
+                          instrument.get_stats() if stats else None)
+    finally:
+        if stats:
+            instrument.disable()
+
+
+def run_batch(video_paths, output_dir=None, workers=None, cache_dir=None, log=print, stats=False,
+              cache_max_bytes=default_max_bytes):
+    """ Extract the telemetry of many clips over a process pool
+    Parameters
+    ----------
+    video_paths: list of str
+        The input files
+    output_dir: str, optional
+        Where to write the outputs, below it at their path relative to the
+        common directory of the inputs. Defaults to next to each input file.
+    workers: int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    cache_dir: str, optional
+        The telemetry cache directory, see `process_clip`.
+    log: callable, optional (default=print)
+        Called with one progress line per finished clip and the final summary.
+    stats: bool, optional (default=False)
+        If True, the statistics of each stage, summed over the clips, are logged
+        at the end and available from `instrument.get_stats`.
+    cache_max_bytes: int, optional
+        The cache is evicted down to this size during and after the batch.
+    Returns
+    -------
+    results: list of ClipResult
+        One result per input file, in completion order.
+    """
+    results = []
+    start = time.perf_counter()
+    root = get_common_root(video_paths)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_clip, video_path, output_dir, cache_dir, stats, root, cache_max_bytes) for video_path in video_paths]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result.stats is not None:
+                instrument.merge_stats(result.stats)
+            status = result.kind if result.error is None else "FAILED"
+            log("[%i/%i] %s %s (%.2fs)" % (len(results), len(video_paths), result.video_path, status, result.seconds))
+            if result.error is not None:
+                log(result.error)
+            if cache_dir is not None and len(results) % evict_interval == 0:
+                TelemetryCache(cache_dir, cache_max_bytes).evict()
+    if cache_dir is not None:
+        TelemetryCache(cache_dir, cache_max_bytes).evict()
+    elapsed = time.perf_counter() - start
+
+    nbytes = sum(result.nbytes for result in results)
+    failed = sum(result.error is not None for result in results)
+    log("%i clips (%i failed), %.1f MB in %.2fs: %.2f clips/s, %.1f MB/s" % (
+        len(results), failed, nbytes / 1e6, elapsed,
+        len(results) / elapsed if elapsed else 0., nbytes / 1e6 / elapsed if elapsed else 0.))
+    if stats:
+        log(instrument.format_stats())
+
+    return results
+
+
+def update_index(index_path, results):
+    """ Insert the GPS tracks of the successful clips into a spatial index file
+    Parameters
+    ----------
+    index_path: str
+        The `SpatialIndex` file, created if missing.
+    results: list of ClipResult
+    Returns
+    -------
+    index: SpatialIndex
+    """
+    index = SpatialIndex.load(index_path) if os.path.exists(index_path) else SpatialIndex()
+    for result in results:
+        if result.error is None:
+            with np.load(result.output_path) as npz:
+                index.insert_columns(os.path.abspath(result.video_path), npz)
+    index.save(index_path)
+    return index
+
+
+def main_cli(argv=None):
+
+    parser = argparse.ArgumentParser(description="Extract GoPro and Nextbase telemetry from a batch of clips")
+    parser.add_argument("inputs", nargs="+", help="video files, directories or glob patterns")
+    parser.add_argument("-o", "--output-dir", default=None, help="output directory (default: next to each clip)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--cache-dir", default=None, help="cache probes and decoded telemetry in this directory")
+    parser.add_argument("--cache-max-bytes", type=int, default=default_max_bytes,
+                        help="evict the least recently used clips beyond this cache size (default: %(default)s)")
+    parser.add_argument("--index", default=None, help="add the GPS tracks to this spatial index file")
+    parser.add_argument("--stats", action="store_true", help="print the time, throughput and memory of each stage")
+    args = parser.parse_args(argv)
+
+    video_paths = find_videos(args.inputs)
+    if not video_paths:
+        print("No video files found")
+        return 1
+
+    results = run_batch(video_paths, args.output_dir, args.workers, args.cache_dir, stats=args.stats,
+                        cache_max_bytes=args.cache_max_bytes)
+    if args.index is not None:
+        update_index(args.index, results)
+    return 1 if any(result.error is not None for result in results) else 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main_cli())
@@ -0,0 +1,200 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import gps
+import gpmf_streams
+import gps_data_extractor
+import main
+import parse
+import synthetic
+from np_telem import NPGPS, NPGYRO, NPACCL
+
+
+def measure(func, repeat=3):
+    """ Time a function and measure its peak memory
+    The timing runs are made without tracemalloc, which slows allocations down,
+    and an extra run measures the peak of the Python allocations.
+    Parameters
+    ----------
+    func: callable
+        The stage to measure, called without arguments.
+    repeat: int, optional (default=3)
+        The number of timing runs.
+    Returns
+    -------
+    result: object
+        The return value of the last run.
+    stats: dict
+        "best" and "mean" wall time in seconds, "peak_bytes" of allocations.
+    """
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+        del result
+
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, {"best": min(times), "mean": sum(times) / len(times), "peak_bytes": peak}
+
+
+def _walk(items):
+    """ Consume a KLV generator and all its nested generators """
+    count = 0
+    for item in items:
+        count += 1
+        if item.length.type == "\x00":
+            count += _walk(item.value)
+    return count
+
+
+def _timed_np(blocks_to_items, np_type):
+
+    timestamp_indexes, timestamp_timestamps, items = blocks_to_items()
+    timestamp_steps = main.calc_timestamp_steps(timestamp_indexes, timestamp_timestamps, items)
+    return np_type(timestamp_indexes, timestamp_timestamps, items, timestamp_steps)
+
+
+def run_benchmarks(seconds=600, records=3600, repeat=3):
+    """ Run every stage of the pipeline on synthetic data
+    Parameters
+    ----------
+    seconds: float, optional (default=600)
+        The length of the synthetic GoPro recording.
+    records: int, optional (default=3600)
+        The number of synthetic Nextbase records.
+    repeat: int, optional (default=3)
+        The number of timing runs per stage.
+    Returns
+    -------
+    report: dict
+        Environment, parameters and per stage statistics, ready to be saved as JSON.
+    """
+    stream = synthetic.make_gpmf_stream(seconds)
+    text = synthetic.make_nextbase_text(records)
+    nbytes = len(stream)
+
+    stages = {}
+
+    def stage(name, func, items=None, size=nbytes):
+        result, stats = measure(func, repeat)
+        count = items(result) if items is not None else None
+        stats["bytes"] = size
+        stats["mb_per_s"] = size / 1e6 / stats["best"] if stats["best"] else None
+        stats["items"] = count
+        stats["items_per_s"] = count / stats["best"] if count and stats["best"] else None
+        stages[name] = stats
+        return result
+
+    stage("iter_klv", lambda: _walk(parse.iter_klv(stream)), items=lambda n: n)
+    stage("index_klv", lambda: parse.index_klv(stream), items=len)
+    stage("filter_klv", lambda: sum(1 for _ in parse.filter_klv(stream, "STRM")), items=lambda n: n)
+    accl_blocks, gyro_blocks, gps_blocks = stage("get_blocks_from_stream", lambda: main.get_blocks_from_stream(stream),
+                                                 items=lambda blocks: sum(len(b) for b in blocks))
+
+    stage("parse_gps_block", lambda: [gps.parse_gps_block(b) for b in gps_blocks],
+          items=lambda parsed: sum(p.npoints for p in parsed))
+    stage("parse_gyro_block", lambda: [gps.parse_gyro_block(b) for b in gyro_blocks],
+          items=lambda parsed: sum(p.npoints for p in parsed))
+    stage("parse_accl_block", lambda: [gps.parse_accl_block(b) for b in accl_blocks],
+          items=lambda parsed: sum(p.npoints for p in parsed))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, timestamp_timestamps, _ = main.get_gps_list_from_blocks(gps_blocks)
+    stage("NPGPS", lambda: _timed_np(lambda: main.get_gps_list_from_blocks(gps_blocks), NPGPS),
+          items=lambda np_gps: len(np_gps.np_msecs))
+    stage("NPGYRO", lambda: _timed_np(lambda: main.get_gyro_list_from_blocks(timestamp_timestamps, gyro_blocks), NPGYRO),
+          items=lambda np_gyro: len(np_gyro.np_msecs))
+    stage("NPACCL", lambda: _timed_np(lambda: main.get_accl_list_from_blocks(timestamp_timestamps, accl_blocks), NPACCL),
+          items=lambda np_accl: len(np_accl.np_msecs))
+    stage("decode_gpmf_stream", lambda: main.decode_gpmf_stream(stream),
+          items=lambda nps: sum(len(n.np_msecs) for n in nps))
+    stage("decode_gpmf_stream_compact", lambda: main.decode_gpmf_stream(stream, compact=True),
+          items=lambda nps: sum(len(n.np_msecs) for n in nps))
+
+    stage("decode_streams", lambda: gpmf_streams.decode_streams(stream),
+          items=lambda streams: sum(len(next(iter(s.columns.values()))) for s in streams.values()))
+
+    stage("decode_gprmc", lambda: gps_data_extractor.decode_gprmc(text),
+          items=lambda np_gprmc: len(np_gprmc.np_msecs), size=len(text))
+    stage("decode_nextbase", lambda: gps_data_extractor.decode_nextbase(text),
+          items=lambda nps: sum(len(n.np_msecs) for n in nps), size=len(text))
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "revision": _git_revision(),
+        },
+        "parameters": {"seconds": seconds, "records": records, "repeat": repeat},
+        "stages": stages,
+    }
+
+
+def _git_revision():
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_report(report, baseline=None):
+    """ Format a benchmark report as a table, with the speedup against a baseline report """
+    lines = ["%-24s %10s %10s %12s %12s" % ("stage", "best (s)", "MB/s", "peak (MB)", "speedup")]
+    baseline_stages = baseline["stages"] if baseline is not None else {}
+    for name, stats in report["stages"].items():
+        speedup = ""
+        if name in baseline_stages and stats["best"]:
+            speedup = "%.2fx" % (baseline_stages[name]["best"] / stats["best"])
+        lines.append("%-24s %10.4f %10.1f %12.2f %12s" % (
+            name, stats["best"], stats["mb_per_s"] or 0., stats["peak_bytes"] / 1e6, speedup))
+    return "\n".join(lines)
+
+
+def main_cli(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the telemetry pipeline on synthetic streams")
+    parser.add_argument("--seconds", type=float, default=600, help="length of the synthetic GoPro recording")
+    parser.add_argument("--records", type=int, default=3600, help="number of synthetic Nextbase records")
+    parser.add_argument("--repeat", type=int, default=3, help="timing runs per stage")
+    parser.add_argument("-o", "--output", default=None, help="save the report as JSON")
+    parser.add_argument("--compare", default=None, help="JSON report of a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.seconds, args.records, args.repeat)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(format_report(report, baseline))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main_cli())
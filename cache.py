@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# size of a cache, see `TelemetryCache`
+default_max_bytes = 10 << 30
+
+
+def file_key(video_path, content_hash=False):
+    """ Compute the cache key of a file
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    content_hash: bool, optional (default=False)
+        If True, hash the whole file content, so renamed or copied files share an
+        entry. Otherwise the key is built from the absolute path, size and mtime,
+        which costs a single `stat`.
+    Returns
+    -------
+    key: str
+        A hexadecimal digest.
+    """
+    if content_hash:
+        h = hashlib.sha256()
+        with open(video_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    st = os.stat(video_path)
+    identity = "%s\0%i\0%i" % (os.path.abspath(video_path), st.st_size, st.st_mtime_ns)
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+def _write_atomic(path, write):
+    """ Write a file through a temporary file so readers never see partial data """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class TelemetryCache:
+    """ On-disk cache of probe results, raw streams and decoded columns
+
+    Every file gets one entry directory named after its `file_key`. Entries are
+    evicted least recently used first once the cache grows over `max_bytes`,
+    by `evict`: scanning the cache costs one `stat` per file, so it runs after
+    `evict_every` bytes were written through this object, or from `batch.run_batch`.
+    Concurrent processes may share a cache, an entry evicted while in use is a miss.
+    """
+
+    meta_name = "meta.json"
+    # bump when the arrays produced by the decoders change, so older cached columns are not reused
+    columns_version = 4
+
+    def __init__(self, cache_dir, max_bytes=default_max_bytes, content_hash=False, evict_every=1 << 30):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        self.evict_every = evict_every
+        self._written = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_dir(self, video_path):
+
+        return os.path.join(self.cache_dir, file_key(video_path, self.content_hash))
+
+    def _get_path(self, video_path, name):
+
+        entry_dir = self.entry_dir(video_path)
+        path = os.path.join(entry_dir, name)
+        if not os.path.exists(path):
+            return None
+        # the mtime of the meta file is the last access time used for LRU eviction
+        try:
+            os.utime(os.path.join(entry_dir, self.meta_name))
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _put(self, video_path, name, write):
+
+        entry_dir = self.entry_dir(video_path)
+        meta_path = os.path.join(entry_dir, self.meta_name)
+        for attempt in range(2):
+            try:
+                os.makedirs(entry_dir, exist_ok=True)
+                if not os.path.exists(meta_path):
+                    meta = {"path": os.path.abspath(video_path), "size": os.path.getsize(video_path)}
+                    _write_atomic(meta_path, lambda f: f.write(json.dumps(meta).encode()))
+                _write_atomic(os.path.join(entry_dir, name), write)
+                os.utime(meta_path)
+                self._written += os.path.getsize(os.path.join(entry_dir, name))
+                break
+            except FileNotFoundError:
+                # the entry was evicted by another process meanwhile, write it again
+                if attempt:
+                    raise
+
+        if self.evict_every is not None and self._written >= self.evict_every:
+            self._written = 0
+            self.evict()
+
+    def _read(self, video_path, name, read):
+        """ Read a cached file with `read(path)`, None when missing or evicted meanwhile """
+        path = self._get_path(video_path, name)
+        if path is None:
+            return None
+        try:
+            return read(path)
+        except FileNotFoundError:
+            return None
+
+    def get_probe(self, video_path):
+        """ Return the cached ffprobe result of a file, or None """
+        def read(path):
+            with open(path) as f:
+                return json.load(f)
+        return self._read(video_path, "probe.json", read)
+
+    def put_probe(self, video_path, probe):
+
+        self._put(video_path, "probe.json", lambda f: f.write(json.dumps(probe).encode()))
+
+    def get_stream(self, video_path, codec_tag):
+        """ Return the cached raw bytes of a stream, or None """
+        def read(path):
+            with open(path, "rb") as f:
+                return f.read()
+        return self._read(video_path, "%s.bin" % codec_tag, read)
+
+    def put_stream(self, video_path, codec_tag, data):
+
+        self._put(video_path, "%s.bin" % codec_tag, lambda f: f.write(data))
+
+    def get_columns(self, video_path, name):
+        """ Return the cached decoded arrays stored under `name`, or None
+        Returns
+        -------
+        columns: dict of str to numpy.ndarray
+        """
+        def read(path):
+            with np.load(path) as npz:
+                return dict(npz)
+        return self._read(video_path, self._columns_name(name), read)
+
+    def put_columns(self, video_path, name, columns):
+
+        self._put(video_path, self._columns_name(name), lambda f: np.savez(f, **columns))
+
+    def _columns_name(self, name):
+
+        return "%s.v%i.npz" % (name, self.columns_version)
+
+    def invalidate(self, video_path):
+        """ Drop every entry of a file, including the ones of older versions of it
+        Returns
+        -------
+        count: int
+            The number of entries removed.
+        """
+        video_path = os.path.abspath(video_path)
+        count = 0
+        for entry_dir, meta, _, _ in self.iter_entries():
+            if meta.get("path") == video_path:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                count += 1
+        return count
+
+    def clear(self):
+
+        for entry_dir, _, _, _ in self.iter_entries():
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def iter_entries(self):
+        """ Iterate on the cache entries
+        Returns
+        -------
+        entry_gen: generator
+            A generator of (entry_dir, meta, last_access, nbytes) tuples.
+        """
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            meta_path = os.path.join(entry_dir, self.meta_name)
+            try:
+                last_access = os.path.getmtime(meta_path)
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                nbytes = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+            except (OSError, ValueError):
+                continue
+            yield entry_dir, meta, last_access, nbytes
+
+    def size(self):
+
+        return sum(nbytes for _, _, _, nbytes in self.iter_entries())
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in `max_bytes`
+        Entries removed by another process meanwhile are skipped.
+        """
+        entries = sorted(self.iter_entries(), key=lambda entry: entry[2])
+        total = sum(entry[3] for entry in entries)
+        for entry_dir, _, _, nbytes in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= nbytes
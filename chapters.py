@@ -0,0 +1,213 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import re
+import struct
+
+import numpy as np
+
+from JE_ffprobe import JE_FFProbe
+import gpmf_streams
+import mp4_reader
+
+logger = logging.getLogger(__name__)
+
+# GX010042.MP4 (chapter 01 of recording 0042), GH.., and the older GOPR0042.MP4 / GP010042.MP4
+chapter_patterns = [
+    re.compile(r"^(?P<prefix>G[HXL])(?P<chapter>\d\d)(?P<number>\d{4})\.(?P<ext>mp4)$", re.IGNORECASE),
+    re.compile(r"^(?P<prefix>GOPR)(?P<number>\d{4})\.(?P<ext>mp4)$", re.IGNORECASE),
+    re.compile(r"^(?P<prefix>GP)(?P<chapter>\d\d)(?P<number>\d{4})\.(?P<ext>mp4)$", re.IGNORECASE),
+]
+
+Chapter = namedtuple("Chapter", ["video_path", "duration_msecs", "streams"])
+
+Recording = namedtuple("Recording", ["chapter_paths", "chapter_offsets", "streams"])
+
+
+def chapter_key(video_path):
+    """ Identify the recording and chapter of a GoPro file name
+    Returns
+    -------
+    key: tuple or None
+        (recording, chapter), where recording identifies the sibling chapters
+        and chapter orders them. The first chapter of the older naming,
+        GOPR0042.MP4, is chapter 0 followed by GP010042.MP4, while the newer
+        GX010042.MP4 is chapter 1. None when the name is not a GoPro chapter.
+    """
+    name = os.path.basename(video_path)
+    for pattern in chapter_patterns:
+        match = pattern.match(name)
+        if match is not None:
+            groups = match.groupdict()
+            chapter = int(groups["chapter"]) if groups.get("chapter") else 0
+            prefix = "GP" if groups["prefix"].upper() == "GOPR" else groups["prefix"].upper()
+            return (prefix, groups["number"], groups["ext"].lower()), chapter
+    return None
+
+
+def find_chapters(video_path):
+    """ Find the chapters of the recording a GoPro file belongs to
+    Parameters
+    ----------
+    video_path: str
+        Any chapter of the recording.
+    Returns
+    -------
+    chapter_paths: list of str
+        The sibling chapters in the same directory, in chapter order.
+        Just `video_path` when the name is not a GoPro chapter.
+    """
+    key = chapter_key(video_path)
+    if key is None:
+        return [video_path]
+
+    directory = os.path.dirname(video_path)
+    chapters = {}
+    for name in os.listdir(directory or "."):
+        other = chapter_key(name)
+        if other is not None and other[0] == key[0]:
+            chapters[other[1]] = os.path.join(directory, name)
+    return [chapters[chapter] for chapter in sorted(chapters)]
+
+
+def extract_chapter(video_path, fourccs):
+    """ Extract and decode the GPMF streams of one chapter
+    Returns
+    -------
+    chapter: Chapter
+        The container duration in msecs and the `gpmf_streams.GPMFStream` of each fourcc.
+    """
+    try:
+        track = mp4_reader.find_track(video_path, "gpmd")
+        stream = mp4_reader.read_samples(video_path, track)
+        duration_msecs = track.duration * 1000. / track.timescale
+    except (RuntimeError, KeyError, struct.error):
+        probe = JE_FFProbe(video_path)
+        stream = probe.extract_bin_stream("gpmd", backend="ffmpeg")
+        duration_msecs = probe.get_duration() * 1000.
+    return Chapter(video_path, duration_msecs, gpmf_streams.decode_streams(stream, fourccs))
+
+
+def _chapter_msecs(chapter, stream):
+    """ Sample times of a chapter stream, evenly spread over the chapter without STMP """
+    if stream.msecs is not None:
+        return stream.msecs
+    npoints = len(next(iter(stream.columns.values())))
+    return np.arange(npoints) * (chapter.duration_msecs / max(npoints, 1))
+
+
+def chapter_offsets(chapters, fourcc):
+    """ Offset in msecs to add to the times of each chapter of a stream
+    A chapter whose camera clock (STMP) continues the previous one needs no
+    offset. Otherwise, when its TSMP continues the sample count of the previous
+    chapter, it is placed one sample period after it, else after the container
+    duration of the previous chapters.
+    Parameters
+    ----------
+    chapters: list of Chapter
+        The chapters, in order.
+    fourcc: str
+        The stream.
+    Returns
+    -------
+    offsets: list of float
+    """
+    offsets = []
+    container_offset = 0.
+    previous = None
+    for chapter in chapters:
+        stream = chapter.streams.get(fourcc)
+        if stream is None:
+            offsets.append(container_offset)
+        elif previous is None:
+            offsets.append(0.)
+        else:
+            previous_stream, previous_msecs, previous_offset = previous
+            msecs = _chapter_msecs(chapter, stream)
+            if stream.msecs is not None and previous_stream.msecs is not None and len(msecs) and msecs[0] > previous_msecs[-1]:
+                offsets.append(previous_offset)
+            elif (stream.tsmp is not None and previous_stream.tsmp is not None and len(msecs) > 1 and
+                  stream.tsmp[0] - np.diff(np.append(stream.block_starts, len(msecs)))[0] == previous_stream.tsmp[-1]):
+                period = np.median(np.diff(msecs))
+                offsets.append(previous_msecs[-1] + previous_offset + period - msecs[0])
+            else:
+                offsets.append(container_offset)
+        if stream is not None and len(stream.block_starts):
+            previous = (stream, _chapter_msecs(chapter, stream), offsets[-1])
+        container_offset += chapter.duration_msecs
+    return offsets
+
+
+def stitch_chapters(chapters, fourccs):
+    """ Join the decoded streams of the chapters of a recording on one timeline
+    The output arrays are allocated once and every chapter is copied in place,
+    so the data is copied a single time.
+    Parameters
+    ----------
+    chapters: list of Chapter
+        The chapters, in order.
+    fourccs: list of str
+        The streams to join.
+    Returns
+    -------
+    streams: dict of str to gpmf_streams.GPMFStream
+        Times in msecs since the start of the first chapter, `block_starts`,
+        `stmp` and `tsmp` concatenated.
+    """
+    streams = {}
+    for fourcc in fourccs:
+        parts = [(chapter, chapter.streams[fourcc]) for chapter in chapters if fourcc in chapter.streams]
+        if not parts:
+            continue
+        offsets = [offset for chapter, offset in zip(chapters, chapter_offsets(chapters, fourcc)) if fourcc in chapter.streams]
+        first = parts[0][1]
+        sizes = [len(next(iter(stream.columns.values()))) for _, stream in parts]
+        starts = np.cumsum([0] + sizes)
+
+        msecs = np.empty(starts[-1])
+        columns = {name: np.empty(starts[-1], dtype=column.dtype) for name, column in first.columns.items()}
+        for (chapter, stream), offset, start, end in zip(parts, offsets, starts, starts[1:]):
+            np.add(_chapter_msecs(chapter, stream), offset, out=msecs[start: end])
+            for name, column in columns.items():
+                column[start: end] = stream.columns[name]
+
+        stmp = [stream.stmp for _, stream in parts]
+        tsmp = [stream.tsmp for _, stream in parts]
+        streams[fourcc] = first._replace(
+            columns=columns,
+            msecs=msecs,
+            block_starts=np.concatenate([stream.block_starts + start for (_, stream), start in zip(parts, starts)]),
+            stmp=np.concatenate(stmp) if all(t is not None for t in stmp) else None,
+            tsmp=np.concatenate(tsmp) if all(t is not None for t in tsmp) else None,
+        )
+    return streams
+
+
+def extract_recording(video_path, fourccs=("GPS5", "ACCL", "GYRO"), workers=None):
+    """ Extract the telemetry of a whole GoPro recording, all chapters joined
+    The chapters are read and decoded concurrently, on a thread pool so the
+    decoded arrays are not copied between processes.
+    Parameters
+    ----------
+    video_path: str
+        Any chapter of the recording.
+    fourccs: list of str, optional
+        The streams to decode, see `gpmf_streams.decode_streams`.
+    workers: int, optional
+        The number of threads. Defaults to one per chapter, up to the CPU count.
+    Returns
+    -------
+    recording: Recording
+        The chapter paths, the container start of each chapter in msecs, and
+        the joined streams.
+    """
+    chapter_paths = find_chapters(video_path)
+    if workers is None:
+        workers = min(len(chapter_paths), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chapters = list(executor.map(lambda path: extract_chapter(path, list(fourccs)), chapter_paths))
+
+    durations = [chapter.duration_msecs for chapter in chapters]
+    logger.debug("%s: %i chapters, %.1f s", video_path, len(chapters), sum(durations) / 1000.)
+    return Recording(chapter_paths, list(np.cumsum([0.] + durations[:-1])), stitch_chapters(chapters, fourccs))
@@ -0,0 +1,319 @@
+import json
+import logging
+
+import numpy as np
+
+import instrument
+import time_utils
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+# decimals written for each column, the others get `default_decimals`
+column_decimals = {
+    "np_msecs": 3,
+    "np_lat": 7,
+    "np_long": 7,
+    "np_elev": 3,
+    "np_speed": 3,
+    "np_bearing": 2,
+}
+default_decimals = 6
+
+_digit = np.uint8(ord("0"))
+
+
+def _format_fixed(values, decimals):
+    """ Format numbers as fixed-point decimal text, all rows at once
+    Parameters
+    ----------
+    values: numpy.ndarray
+        The numbers, nan is written as an empty field.
+    decimals: int
+        The number of decimals.
+    Returns
+    -------
+    chars: numpy.ndarray
+        (N, W) uint8 array of characters, right aligned.
+    keep: numpy.ndarray
+        (N, W) bool array, False for the padding characters to drop.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    finite = np.isfinite(values)
+    mantissa = np.round(np.abs(np.where(finite, values, 0.)) * 10. ** decimals).astype(np.int64)
+
+    ndigits = max(len(str(int(mantissa.max()))) if len(mantissa) else 1, decimals + 1)
+    powers = 10 ** np.arange(ndigits - 1, -1, -1, dtype=np.int64)
+    digits = (mantissa[:, None] // powers % 10).astype(np.uint8) + _digit
+
+    # leading zeros are dropped, up to the units digit
+    significant = np.maximum.accumulate(digits != _digit, axis=1)
+    significant[:, ndigits - decimals - 1:] = True
+
+    sign = np.full((len(values), 1), ord("-"), dtype=np.uint8)
+    negative = (values < 0) & (mantissa > 0)
+    if decimals:
+        chars = np.hstack([sign, digits[:, :ndigits - decimals], np.full((len(values), 1), ord("."), dtype=np.uint8),
+                           digits[:, ndigits - decimals:]])
+        keep = np.hstack([negative[:, None], significant[:, :ndigits - decimals], np.ones((len(values), 1), dtype=bool),
+                          significant[:, ndigits - decimals:]])
+    else:
+        chars = np.hstack([sign, digits])
+        keep = np.hstack([negative[:, None], significant])
+    keep &= finite[:, None]
+    return chars, keep
+
+
+def _format_text(values):
+    """ Fixed-width byte strings as a character matrix, trailing NULs dropped """
+    values = np.asarray(values, dtype=np.bytes_)
+    width = max(values.dtype.itemsize, 1)
+    chars = np.frombuffer(values.astype("S%i" % width).tobytes(), dtype=np.uint8).reshape(len(values), width)
+    return chars, chars != 0
+
+
+def format_rows(nrows, parts):
+    """ Build the text of many rows at once, without a per-row Python loop
+    Each part is a column of characters, the text is their concatenation row
+    by row with the padding of every field dropped in one boolean selection.
+    Parameters
+    ----------
+    nrows: int
+        The number of rows.
+    parts: list
+        Constant `bytes` written on every row, (values, decimals) numeric
+        columns, or arrays of byte strings.
+    Returns
+    -------
+    text: bytes
+    """
+    chars, keep = [], []
+    for part in parts:
+        if isinstance(part, bytes):
+            c = np.broadcast_to(np.frombuffer(part, dtype=np.uint8), (nrows, len(part)))
+            k = np.ones((nrows, len(part)), dtype=bool)
+        elif isinstance(part, tuple):
+            c, k = _format_fixed(*part)
+        else:
+            c, k = _format_text(part)
+        chars.append(c)
+        keep.append(k)
+    return np.hstack(chars)[np.hstack(keep)].tobytes()
+
+
+def _columns(telem):
+    """ The columns written for an NP* object: msecs then its data columns """
+    return ("np_msecs",) + tuple(telem.columns)
+
+
+def _column(telem, name, start, end):
+    """ Rows [start, end) of a column, without expanding a whole compact stream """
+    if hasattr(telem, "column"):
+        return telem.column(name, start, end)
+    return getattr(telem, name)[start:end]
+
+
+def _length(telem):
+
+    return len(telem) if hasattr(telem, "__len__") else len(telem.np_msecs)
+
+
+def _chunks(n, chunk_size):
+
+    return [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)] if n else []
+
+
+def _open(path_or_file):
+    """ Open a path for binary writing, or wrap an open file object """
+    if hasattr(path_or_file, "write"):
+        return _Unclosed(getattr(path_or_file, "buffer", path_or_file))
+    return open(path_or_file, "wb")
+
+
+class _Unclosed:
+    """ Context manager giving a file object without closing it """
+
+    def __init__(self, f):
+        self.f = f
+
+    def __enter__(self):
+        return self.f
+
+    def __exit__(self, *exc_info):
+        self.f.flush()
+        return False
+
+
+def write_csv(telem, path_or_file, chunk_size=1 << 16, header=True):
+    """ Write an NP* object as CSV
+    Parameters
+    ----------
+    telem: NP* object
+        Any object with `np_msecs` and a `columns` tuple, e.g. NPGPS. Compact
+        `np_telem.NPIMU` streams are scaled one chunk at a time.
+    path_or_file: str or file
+        The output path, or an open file (binary or text with a `buffer`).
+    chunk_size: int, optional
+        The number of rows formatted at once, bounding the memory use.
+    header: bool, optional (default=True)
+        Write the column names first.
+    """
+    names = _columns(telem)
+    n = _length(telem)
+    with instrument.stage("export", items_out=n), _open(path_or_file) as f:
+        if header:
+            f.write((",".join(name[len("np_"):] for name in names) + "\n").encode())
+        for start, end in _chunks(n, chunk_size):
+            parts = []
+            for name in names:
+                parts += [(_column(telem, name, start, end), column_decimals.get(name, default_decimals)), b","]
+            parts[-1] = b"\n"
+            f.write(format_rows(end - start, parts))
+
+
+def _utc_times(telem, start, end):
+    """ ISO 8601 times of some points, None when the start time is unknown """
+    if getattr(telem, "start_timestamp", None) is None:
+        return None
+    msecs = np.asarray(_column(telem, "np_msecs", start, end), dtype=np.float64)
+    timed = np.isfinite(msecs)
+    epoch_ns = telem.start_timestamp + np.round(np.where(timed, msecs, 0.) * time_utils.NS_PER_MSEC).astype(np.int64)
+    return np.where(timed, np.char.add(time_utils.format_epoch_ns(epoch_ns).astype(np.bytes_), b"Z"), b"")
+
+
+def _located_rows(telem, start, end):
+    """ Index of the points of a chunk with a finite position, and a valid fix when known """
+    keep = np.isfinite(telem.np_lat[start:end]) & np.isfinite(telem.np_long[start:end])
+    valid = getattr(telem, "np_valid", None)
+    if valid is not None:
+        keep &= np.asarray(valid[start:end], dtype=bool)
+    return np.flatnonzero(keep)
+
+
+def write_gpx(telem, path_or_file, name=None, chunk_size=1 << 16):
+    """ Write a GPS track as GPX 1.1
+    Parameters
+    ----------
+    telem: NPGPS or NPGPRMC
+        `np_lat` and `np_long` are required, `np_elev` and the UTC times are
+        written when available. Points without a position or with `np_valid`
+        False are left out.
+    path_or_file: str or file
+        The output path or an open file.
+    name: str, optional
+        The track name.
+    chunk_size: int, optional
+        The number of points formatted at once.
+    """
+    n = len(telem.np_msecs)
+    elev = getattr(telem, "np_elev", None)
+    with instrument.stage("export", items_out=n), _open(path_or_file) as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                b'<gpx version="1.1" creator="telemetry" xmlns="http://www.topografix.com/GPX/1/1">\n<trk>\n')
+        if name is not None:
+            f.write(b"<name>%s</name>\n" % name.replace("&", "&amp;").replace("<", "&lt;").encode())
+        f.write(b"<trkseg>\n")
+        for start, end in _chunks(n, chunk_size):
+            rows = _located_rows(telem, start, end)
+            parts = [b'<trkpt lat="', (telem.np_lat[start:end][rows], 7), b'" lon="', (telem.np_long[start:end][rows], 7), b'">']
+            if elev is not None:
+                parts += [b"<ele>", (elev[start:end][rows], 3), b"</ele>"]
+            times = _utc_times(telem, start, end)
+            if times is not None:
+                parts += [b"<time>", times[rows], b"</time>"]
+            parts.append(b"</trkpt>\n")
+            f.write(format_rows(len(rows), parts))
+        f.write(b"</trkseg>\n</trk>\n</gpx>\n")
+
+
+def write_geojson(telem, path_or_file, properties=None, chunk_size=1 << 16):
+    """ Write a GPS track as a GeoJSON LineString feature
+    Parameters
+    ----------
+    telem: NPGPS or NPGPRMC
+        Points without a position or with `np_valid` False are left out.
+    path_or_file: str or file
+        The output path or an open file.
+    properties: dict, optional
+        The feature properties, the start time is added when known.
+    chunk_size: int, optional
+        The number of points formatted at once.
+    """
+    properties = dict(properties or {})
+    if getattr(telem, "start_timestamp", None) is not None:
+        properties.setdefault("start_time", str(time_utils.format_epoch_ns([telem.start_timestamp])[0]) + "Z")
+
+    n = len(telem.np_msecs)
+    elev = getattr(telem, "np_elev", None)
+    with instrument.stage("export", items_out=n), _open(path_or_file) as f:
+        f.write(b'{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": ')
+        f.write(json.dumps(properties).encode())
+        f.write(b', "geometry": {"type": "LineString", "coordinates": [')
+        first = True
+        for start, end in _chunks(n, chunk_size):
+            rows = _located_rows(telem, start, end)
+            if not len(rows):
+                continue
+            parts = [b",[", (telem.np_long[start:end][rows], 7), b",", (telem.np_lat[start:end][rows], 7)]
+            if elev is not None:
+                parts += [b",", (elev[start:end][rows], 3)]
+            parts.append(b"]")
+            text = format_rows(len(rows), parts)
+            f.write(text[1:] if first else text)
+            first = False
+        f.write(b"]}}]}\n")
+
+
+def write_parquet(telem, path, chunk_size=1 << 16):
+    """ Write an NP* object as Parquet, one row group per `DEVC`
+    Parameters
+    ----------
+    telem: NP* object
+        Row groups follow `np_block_starts` when present, `chunk_size` rows otherwise.
+    path: str
+        The output file.
+    chunk_size: int, optional
+        The number of rows of each row group without `np_block_starts`.
+    Raises
+    ------
+    RuntimeError: If pyarrow is not installed.
+    """
+    if pyarrow is None:
+        raise RuntimeError("Parquet export needs pyarrow")
+
+    names = _columns(telem)
+    n = _length(telem)
+    block_starts = getattr(telem, "np_block_starts", None)
+    if block_starts is not None and len(block_starts):
+        bounds = list(zip(block_starts, np.append(block_starts[1:], n)))
+    else:
+        bounds = _chunks(n, chunk_size)
+
+    fields = [pyarrow.field(name[len("np_"):], pyarrow.float64()) for name in names]
+    if getattr(telem, "start_timestamp", None) is not None:
+        fields.append(pyarrow.field("timestamp", pyarrow.timestamp("ns", tz="UTC")))
+    schema = pyarrow.schema(fields, metadata={"kind": type(telem).__name__})
+
+    with instrument.stage("export", items_out=n), pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for start, end in bounds:
+            arrays = [pyarrow.array(np.asarray(_column(telem, name, start, end), dtype=np.float64)) for name in names]
+            if len(fields) > len(names):
+                msecs = np.asarray(_column(telem, "np_msecs", start, end), dtype=np.float64)
+                timed = np.isfinite(msecs)
+                epoch_ns = telem.start_timestamp + np.round(np.where(timed, msecs, 0.) * time_utils.NS_PER_MSEC).astype(np.int64)
+                # untimed rows, e.g. void GPRMC sentences, get a null timestamp
+                arrays.append(pyarrow.array(epoch_ns, mask=~timed, type=pyarrow.timestamp("ns", tz="UTC")))
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+
+writers = {
+    "csv": write_csv,
+    "gpx": write_gpx,
+    "geojson": write_geojson,
+    "parquet": write_parquet,
+}
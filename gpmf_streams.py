@@ -0,0 +1,355 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import logging
+from multiprocessing import shared_memory
+import os
+import re
+
+import numpy as np
+
+import instrument
+import parse
+import time_utils
+
+logger = logging.getLogger(__name__)
+
+GPMFStream = namedtuple("GPMFStream",
+                        [
+                            "fourcc",
+                            "name",
+                            "units",
+                            "columns",
+                            "msecs",
+                            "block_starts",
+                            "stmp",
+                            "tsmp",
+                        ])
+
+StreamHandler = namedtuple("StreamHandler", ["columns", "decode"])
+
+# the items of a STRM describing its data item
+metadata_fourccs = ("STNM", "SIUN", "UNIT", "SCAL", "TYPE", "TSMP", "STMP")
+
+# byte strings in complex structures, kept out of the numeric columns
+text_types = {"c": 1, "F": 4, "U": 16}
+
+
+def complex_dtype(type_def):
+    """ Build the big-endian structured dtype of a complex "?" item from its `TYPE`
+    Parameters
+    ----------
+    type_def: str
+        The `TYPE` value, one character per field as in `parse.num_types`,
+        "x[n]" repeating a field n times.
+    Returns
+    -------
+    dtype: numpy.dtype
+        One field per value, named f0, f1...
+    """
+    chars = re.sub(r"(.)\[(\d+)\]", lambda m: m.group(1) * int(m.group(2)), type_def.rstrip("\0"))
+    fields = []
+    for i, c in enumerate(chars):
+        if c in parse.num_types:
+            fields.append(("f%i" % i, ">" + parse.num_types[c][1]))
+        elif c in text_types:
+            fields.append(("f%i" % i, "S%i" % text_types[c]))
+        else:
+            raise RuntimeError(f"Unsupported type {c!r} in TYPE {type_def!r}")
+    return np.dtype(fields)
+
+
+def _scale_rows(scal, nvalues):
+    """ Turn a SCAL value into one divisor per value column """
+    scal = np.atleast_1d(np.asarray(scal, dtype=np.float64)) if scal is not None else np.ones(1)
+    if len(scal) != nvalues:
+        scal = np.repeat(scal[:1], nvalues)
+    return scal
+
+
+def decode_numeric(x, index, rows, metadata):
+    """ Default handler: decode the data items of a stream and apply SCAL
+    Parameters
+    ----------
+    x: memoryview
+        The stream.
+    index: numpy.ndarray
+        The KLV index of the stream, see `parse.index_klv`.
+    rows: numpy.ndarray
+        The rows of the data items, one per `STRM`, in stream order.
+    metadata: dict of str to list
+        The parsed SCAL and TYPE values of each data item, None when missing.
+    Returns
+    -------
+    values: numpy.ndarray
+        (N, k) float64 array, the scaled values of all the items.
+    counts: numpy.ndarray
+        The number of samples of each item.
+    """
+    items = index[rows]
+    uniform = len(np.unique(items["type"])) == 1 and len(np.unique(items["size"])) == 1
+    types = metadata["TYPE"]
+    if uniform and (items[0]["type"] != b"?" or len(set(types)) == 1):
+        groups = [rows]
+    else:
+        groups = [rows[i: i + 1] for i in range(len(rows))]
+
+    values, counts = [], []
+    for group in groups:
+        dtype = None
+        if index[group[0]]["type"] == b"?":
+            type_def = types[np.searchsorted(rows, group[0])]
+            if type_def is None:
+                raise RuntimeError("Complex item %s without TYPE" % index[group[0]]["fourcc"].decode("latin1"))
+            dtype = complex_dtype(type_def)
+        group_values, group_counts = parse.gather_payloads(x, index, group, dtype)
+        if dtype is not None:
+            group_values = np.column_stack([
+                group_values[name].astype(np.float64) if dtype[name].kind != "S" else np.full(len(group_values), np.nan)
+                for name in dtype.names
+            ])
+        values.append(np.asarray(group_values, dtype=np.float64).reshape(len(group_values), -1))
+        counts.append(group_counts)
+    values = np.concatenate(values) if len(values) > 1 else values[0]
+    counts = np.concatenate(counts)
+
+    scal = metadata["SCAL"]
+    if all(s is not None and np.array_equal(s, scal[0]) for s in scal):
+        values /= _scale_rows(scal[0], values.shape[1])
+    else:
+        values /= np.repeat(np.array([_scale_rows(s, values.shape[1]) for s in scal]), counts, axis=0)
+    return values, counts
+
+
+stream_handlers = {}
+
+
+def register_stream(fourcc, columns=None, decode=decode_numeric):
+    """ Register the handler of a data fourcc
+    Parameters
+    ----------
+    fourcc: str
+        The FourCC code of the data item of the `STRM`, e.g. "GPS9".
+    columns: tuple of str, optional
+        The names of the value columns. Streams whose number of values does
+        not match get "c0", "c1"...
+    decode: callable, optional (default=decode_numeric)
+        Called as decode(x, index, rows, metadata), see `decode_numeric`.
+    """
+    stream_handlers[fourcc] = StreamHandler(tuple(columns) if columns is not None else None, decode)
+
+
+register_stream("GPS5", ("latitude", "longitude", "altitude", "speed_2d", "speed_3d"))
+register_stream("GPS9", ("latitude", "longitude", "altitude", "speed_2d", "speed_3d", "days", "seconds", "dop", "fix"))
+register_stream("ACCL", ("z", "x", "y"))
+register_stream("GYRO", ("z", "x", "y"))
+register_stream("MAGN", ("z", "x", "y"))
+register_stream("GRAV", ("x", "y", "z"))
+register_stream("CORI", ("w", "x", "y", "z"))
+register_stream("IORI", ("w", "x", "y", "z"))
+register_stream("SHUT", ("exposure",))
+register_stream("WBAL", ("kelvin",))
+register_stream("WRGB", ("r", "g", "b"))
+register_stream("ISOE", ("iso",))
+register_stream("ISOG", ("gain",))
+register_stream("UNIF", ("uniformity",))
+register_stream("FACE", ("id", "x", "y", "w", "h"))
+
+
+def _metadata_rows(index, fourcc):
+    """ Row of the `fourcc` item of each STRM, -1 when it has none """
+    lookup = np.full(len(index), -1, dtype=np.int64)
+    rows = np.nonzero(parse.select_klv(index, fourcc, "STRM"))[0]
+    lookup[index["parent"][rows]] = rows
+    return lookup
+
+
+def _parse_row(x, index, row):
+
+    item = index[row]
+    size, repeat = int(item["size"]), int(item["repeat"])
+    start = int(item["offset"])
+    return parse.parse_payload(x[start: start + parse.ceil4(size * repeat)], item["fourcc"].decode("latin1"),
+                               item["type"].decode("latin1"), size, repeat)
+
+
+def _block_counters(x, index, rows):
+    """ Decode scalar TSMP or STMP items of every block, None if one is missing """
+    if len(rows) == 0 or (rows < 0).any():
+        return None
+    items = index[rows]
+    if len(np.unique(items["type"])) == 1 and len(np.unique(items["size"])) == 1 and (items["repeat"] == 1).all():
+        values, _ = parse.gather_payloads(x, index, rows)
+    else:
+        values = [_parse_row(x, index, row) for row in rows]
+    return np.asarray(values, dtype=np.int64).reshape(len(rows))
+
+
+def decode_streams(stream, fourccs=None):
+    """ Decode the data streams of a GPMF stream in one pass over its headers
+    The KLV headers are indexed once, the `STRM` containers are matched to a
+    handler by the fourcc of their data item, and only the requested ones are
+    decoded: the payloads of the others are never read.
+    Parameters
+    ----------
+    stream: bytes
+        The raw GPMF binary stream
+    fourccs: list of str, optional
+        The data fourccs to decode, e.g. ["ACCL", "GPS9"]. Defaults to every
+        registered one. Unregistered fourccs use `decode_numeric`.
+    Returns
+    -------
+    streams: dict of str to GPMFStream
+        The decoded streams found in the stream, with SCAL applied, units from
+        UNIT or SIUN, and times in milliseconds on the camera clock fitted from
+        STMP and TSMP (None when the stream has no STMP).
+    """
+    x = memoryview(stream)
+    with instrument.stage("klv_parse", bytes_in=len(x)) as stage:
+        index = parse.index_klv(x)
+        stage.add(items_out=len(index))
+    if fourccs is None:
+        fourccs = list(stream_handlers)
+
+    data_mask = parse.select_klv(index, fourccs, "STRM")
+    if not data_mask.any():
+        return {}
+    lookups = {fourcc: _metadata_rows(index, fourcc) for fourcc in metadata_fourccs}
+
+    streams = {}
+    for fourcc in fourccs:
+        rows = np.nonzero(data_mask & (index["fourcc"] == fourcc.encode("latin1")))[0]
+        if len(rows) == 0:
+            continue
+        strms = index["parent"][rows]
+        handler = stream_handlers.get(fourcc, StreamHandler(None, decode_numeric))
+
+        metadata = {
+            meta: [_parse_row(x, index, row) if row >= 0 else None for row in lookups[meta][strms]]
+            for meta in ("SCAL", "TYPE")
+        }
+        with instrument.stage("block_decode") as stage:
+            values, counts = handler.decode(x, index, rows, metadata)
+            stage.add(items_out=len(values))
+
+        columns = handler.columns
+        if columns is None or len(columns) != values.shape[1]:
+            columns = tuple("c%i" % i for i in range(values.shape[1]))
+
+        name_row, unit_row, siun_row = (lookups[meta][strms[0]] for meta in ("STNM", "UNIT", "SIUN"))
+        units = _parse_row(x, index, unit_row) if unit_row >= 0 else _parse_row(x, index, siun_row) if siun_row >= 0 else None
+        if isinstance(units, str):
+            units = [units] * len(columns)
+
+        block_starts = np.cumsum(counts) - counts
+        stmp = _block_counters(x, index, lookups["STMP"][strms])
+        tsmp = _block_counters(x, index, lookups["TSMP"][strms])
+        msecs = None
+        if stmp is not None:
+            first_samples = tsmp - counts if tsmp is not None else block_starts
+            msecs = time_utils.fit_sample_msecs(stmp, first_samples, counts)
+
+        streams[fourcc] = GPMFStream(
+            fourcc=fourcc,
+            name=_parse_row(x, index, name_row) if name_row >= 0 else None,
+            units=units,
+            columns={name: values[:, i] for i, name in enumerate(columns)},
+            msecs=msecs,
+            block_starts=block_starts,
+            stmp=stmp,
+            tsmp=tsmp,
+        )
+        logger.debug("%s: %i blocks, %i samples", fourcc, len(rows), len(values))
+
+    return streams
+
+
+def _decode_range(shm_name, start, end, fourccs):
+    """ Process pool worker: decode a range of a stream held in shared memory """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return decode_streams(shm.buf[start:end], fourccs)
+    finally:
+        shm.close()
+
+
+def concat_streams(parts):
+    """ Join the streams decoded from consecutive ranges of a GPMF stream
+    Parameters
+    ----------
+    parts: list of dict of str to GPMFStream
+        The output of `decode_streams` for each range, in stream order.
+    Returns
+    -------
+    streams: dict of str to GPMFStream
+        The concatenated columns, `block_starts`, `stmp` and `tsmp`, with the
+        times fitted again over all the blocks, as if decoded at once.
+    """
+    streams = {}
+    fourccs = list(dict.fromkeys(fourcc for part in parts for fourcc in part))
+    for fourcc in fourccs:
+        chunks = [part[fourcc] for part in parts if fourcc in part]
+        first = chunks[0]
+        sizes = [len(next(iter(chunk.columns.values()))) for chunk in chunks]
+        starts = np.cumsum([0] + sizes[:-1])
+        block_starts = np.concatenate([chunk.block_starts + start for chunk, start in zip(chunks, starts)])
+        stmp = np.concatenate([chunk.stmp for chunk in chunks]) if all(c.stmp is not None for c in chunks) else None
+        tsmp = np.concatenate([chunk.tsmp for chunk in chunks]) if all(c.tsmp is not None for c in chunks) else None
+
+        msecs = None
+        if stmp is not None:
+            counts = np.diff(np.append(block_starts, sum(sizes)))
+            msecs = time_utils.fit_sample_msecs(stmp, tsmp - counts if tsmp is not None else block_starts, counts)
+        streams[fourcc] = first._replace(
+            name=next((chunk.name for chunk in chunks if chunk.name is not None), None),
+            units=next((chunk.units for chunk in chunks if chunk.units is not None), None),
+            columns={name: np.concatenate([chunk.columns[name] for chunk in chunks]) for name in first.columns},
+            msecs=msecs,
+            block_starts=block_starts,
+            stmp=stmp,
+            tsmp=tsmp,
+        )
+    return streams
+
+
+def decode_streams_parallel(stream, fourccs=None, workers=None, min_bytes=8 << 20):
+    """ Decode a large GPMF stream on several processes
+    The top level `DEVC` containers are independent: a scan of their headers
+    splits the stream into one range per worker, the stream is copied once to
+    shared memory where the workers decode their range, and the columns they
+    return are joined in stream order.
+    Parameters
+    ----------
+    stream: bytes
+        The raw GPMF binary stream
+    fourccs: list of str, optional
+        The data fourccs to decode, see `decode_streams`.
+    workers: int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    min_bytes: int, optional (default=8 MiB)
+        Smaller streams, or a single worker, are decoded by `decode_streams`
+        in this process: starting the pool would cost more than it saves.
+    Returns
+    -------
+    streams: dict of str to GPMFStream
+        As returned by `decode_streams`.
+    """
+    workers = workers or os.cpu_count() or 1
+    bounds = parse.split_klv(stream, workers) if len(stream) >= min_bytes else []
+    if len(bounds) < 2:
+        return decode_streams(stream, fourccs)
+
+    shm = shared_memory.SharedMemory(create=True, size=len(stream))
+    try:
+        shm.buf[:len(stream)] = stream
+        with ProcessPoolExecutor(max_workers=len(bounds)) as executor:
+            futures = [executor.submit(_decode_range, shm.name, start, end, fourccs) for start, end in bounds]
+            parts = [future.result() for future in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+    logger.debug("decoded %i bytes in %i ranges", len(stream), len(bounds))
+
+    with instrument.stage("columnize") as stage:
+        streams = concat_streams(parts)
+        stage.add(items_out=sum(len(s.block_starts) for s in streams.values()))
+    return streams
@@ -14,10 +14,17 @@ GPSData = namedtuple("GPSData",
                          "speed_2d",
                          "speed_3d",
                          "units",
+                         "cumulative_points",
+                         "stmp",
                          "npoints"
                      ])
 
 
+def _get_value(block_dict, fourcc, default=None):
+
+    return block_dict[fourcc].value if fourcc in block_dict else default
+
+
 def extract_gps_blocks(stream):
     """ Extract GPS data blocks from binary stream
     This is a generator on lists `KVLItem` objects. In
@@ -64,15 +71,17 @@ def parse_gps_block(gps_block):
 
     return GPSData(
         description=block_dict["STNM"].value,
-        timestamp=block_dict["GPSU"].value,
-        precision=block_dict["GPSP"].value / 100.,
-        fix=block_dict["GPSF"].value,
+        timestamp=_get_value(block_dict, "GPSU"),
+        precision=block_dict["GPSP"].value / 100. if "GPSP" in block_dict else None,
+        fix=_get_value(block_dict, "GPSF", 0),
         latitude=latitude,
         longitude=longitude,
         altitude=altitude,
         speed_2d=speed_2d,
         speed_3d=speed_3d,
-        units=block_dict["UNIT"].value,
+        units=_get_value(block_dict, "UNIT"),
+        cumulative_points=_get_value(block_dict, "TSMP"),
+        stmp=_get_value(block_dict, "STMP"),
         npoints=len(gps_data)
     )
 
@@ -83,6 +92,7 @@ GYROData = namedtuple("GYROData",
                          "gy_x",
                          "gy_y",
                          "cumulative_points",
+                         "stmp",
                          "npoints"
                      ])
 
@@ -110,7 +120,8 @@ def parse_gyro_block(gyro_block):
         gy_z=gy_z,
         gy_x=gy_x,
         gy_y=gy_y,
-        cumulative_points=block_dict["TSMP"].value,
+        cumulative_points=_get_value(block_dict, "TSMP"),
+        stmp=_get_value(block_dict, "STMP"),
         npoints = len(gyro_data)
     )
 
@@ -122,6 +133,7 @@ ACCLData = namedtuple("ACCLData",
                          "acc_x",
                          "acc_y",
                          "cumulative_points",
+                         "stmp",
                          "npoints"
                      ])
 
@@ -149,7 +161,8 @@ def parse_accl_block(accl_block):
         acc_z=acc_z,
         acc_x=acc_x,
         acc_y=acc_y,
-        cumulative_points=block_dict["TSMP"].value,
+        cumulative_points=_get_value(block_dict, "TSMP"),
+        stmp=_get_value(block_dict, "STMP"),
         npoints = len(accl_data)
     )
 
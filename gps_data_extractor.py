@@ -1,21 +1,30 @@
-import datetime
-import os
-import re
-from typing import Dict, List
+import logging
+from typing import Dict, List, Tuple
+
+import numpy as np
 
 from JE_ffprobe import JE_FFProbe
+import instrument
+from np_telem import NPACCL, NPGYRO, NPGPGGA, NPGPRMC
+import time_utils
+
+logger = logging.getLogger(__name__)
 
-def extract_gps_locations_from_video(video_path: str) -> List[Dict]:
+def extract_gps_locations_from_video(video_path: str, probe: JE_FFProbe = None) -> List[Dict]:
     """
     Extracts the imu data from the video into a list of GPS locations
     :param video_path: (String) path to the video
+    :param probe: (JE_FFProbe) probe of the video, if already available
     :return: (List[Dict]) of gps locations, example [{"latitude": 1, "longitude": 2, "timestamp": 0}].
     """
 
-    probe = JE_FFProbe(video_path)
+    if probe is None:
+        probe = JE_FFProbe(video_path)
     byte_data = probe.extract_bin_stream("text")
 
     list_of_locations = _extract_gps_locations_from_byte_data(byte_data)
+    if not list_of_locations:
+        return [], None
 
     # assuming the first location in the gps data is the start of the video
     video_start_timestamp = list_of_locations[0]["timestamp"]
@@ -25,61 +34,324 @@ def extract_gps_locations_from_video(video_path: str) -> List[Dict]:
     return list_of_locations, video_start_timestamp
 
 
+def extract_gprmc_from_video(video_path: str, probe: JE_FFProbe = None) -> NPGPRMC:
+    """
+    Extracts the GPRMC sentences of a Nextbase video as columns
+    :param video_path: (String) path to the video
+    :param probe: (JE_FFProbe) probe of the video, if already available
+    :return: (NPGPRMC) the decoded GPRMC columns
+    """
+    if probe is None:
+        probe = JE_FFProbe(video_path)
+    byte_data = probe.extract_bin_stream("text")
+
+    with instrument.stage("gprmc_decode", bytes_in=len(byte_data)) as stage:
+        np_gprmc = decode_gprmc(byte_data)
+        stage.add(items_out=len(np_gprmc.np_msecs))
+    return np_gprmc
+
+
+def extract_nextbase_from_video(video_path: str, probe: JE_FFProbe = None) -> Tuple[NPACCL, NPGYRO, NPGPRMC, NPGPGGA]:
+    """
+    Extracts the IMU samples, GPRMC and GPGGA sentences of a Nextbase video as columns
+    :param video_path: (String) path to the video
+    :param probe: (JE_FFProbe) probe of the video, if already available
+    :return: (Tuple) the decoded columns, see `decode_nextbase`
+    """
+    if probe is None:
+        probe = JE_FFProbe(video_path)
+    byte_data = probe.extract_bin_stream("text")
+
+    with instrument.stage("nextbase_decode", bytes_in=len(byte_data)) as stage:
+        telemetry = decode_nextbase(byte_data)
+        stage.add(items_out=len(telemetry[0].np_msecs))
+    return telemetry
+
+
+_hex_values = np.full(256, -1, dtype=np.int64)
+_hex_values[np.frombuffer(b"0123456789", dtype=np.uint8)] = np.arange(10)
+_hex_values[np.frombuffer(b"ABCDEF", dtype=np.uint8)] = np.arange(10, 16)
+_hex_values[np.frombuffer(b"abcdef", dtype=np.uint8)] = np.arange(10, 16)
+
+KNOTS_TO_MPS = 1852 / 3600
+
+# order is 480 bytes of imu (20x2x12bytes) followed by 128 bytes of gprmc and 128 bytes of gpgga
+IMU_SAMPLES_PER_RECORD = 20
+nextbase_record_dtype = np.dtype([
+    ("imu", "<f4", (IMU_SAMPLES_PER_RECORD, 2, 3)),
+    ("gprmc", "u1", 128),
+    ("gpgga", "u1", 128),
+])
+
+
+def _find_sentences(buffer, tag):
+    """
+    Finds the start of every NMEA sentence with a given tag
+    :param buffer: (np.ndarray) uint8 view on the byte data
+    :param tag: (Bytes) sentence tag, e.g. b"$GPRMC"
+    :return: (np.ndarray) offsets of the sentences
+    """
+    tag = np.frombuffer(tag, dtype=np.uint8)
+    candidates = np.flatnonzero(buffer[:len(buffer) - len(tag) + 1] == tag[0])
+    for i in range(1, len(tag)):
+        candidates = candidates[buffer[candidates + i] == tag[i]]
+    return candidates
+
+
+def _sentence_rows(buffer, offsets, width=128):
+    """
+    Gathers fixed width rows starting at each sentence, cut at the checksum
+    :param buffer: (np.ndarray) uint8 view on the byte data
+    :param offsets: (np.ndarray) offsets of the sentences
+    :param width: (int) maximum sentence length
+    :return: (np.ndarray) (N, width) uint8 rows, (np.ndarray) column of the "*", (np.ndarray) checksum ok
+    """
+    padded = np.concatenate([buffer, np.zeros(width, dtype=np.uint8)])
+    return _cut_rows(padded[offsets[:, None] + np.arange(width)])
+
+
+def _cut_rows(rows):
+    """
+    Finds the checksum of fixed width sentence rows and zeroes what follows it
+    :param rows: (np.ndarray) (N, W) uint8 rows, each starting with "$", modified in place
+    :return: (np.ndarray) the rows, (np.ndarray) column of the "*", (np.ndarray) checksum ok
+    """
+    width = rows.shape[1]
+    is_star = rows == ord("*")
+    has_star = is_star.any(axis=1)
+    star = np.where(has_star, is_star.argmax(axis=1), width - 2)
+
+    # the checksum is the XOR of every character between "$" and "*"
+    columns = np.arange(width)
+    body = (columns >= 1) & (columns < star[:, None])
+    computed = np.bitwise_xor.reduce(np.where(body, rows, 0), axis=1)
+    star_column = np.minimum(star, width - 3)[:, None]
+    hex_digits = _hex_values[np.take_along_axis(rows, star_column + np.array([1, 2]), axis=1)]
+    expected = hex_digits[:, 0] * 16 + hex_digits[:, 1]
+    checksum_ok = has_star & (hex_digits >= 0).all(axis=1) & (computed == expected)
+
+    rows[columns >= star[:, None]] = 0
+    return rows, star, checksum_ok
+
+
+def _field_bounds(rows, star, nfields):
+    """
+    Finds the start and end columns of the first comma separated fields
+    :param rows: (np.ndarray) (N, W) uint8 sentence rows
+    :param star: (np.ndarray) column of the "*" ending each sentence
+    :param nfields: (int) the number of fields after the tag
+    :return: (np.ndarray) (N, nfields) starts, (np.ndarray) (N, nfields) ends, (np.ndarray) enough fields
+    """
+    row_ids, columns = np.nonzero(rows == ord(","))
+    columns = np.append(columns, 0)
+    counts = np.bincount(row_ids, minlength=len(rows))
+    first = np.cumsum(counts) - counts
+
+    # column of the k-th comma of each row, the "*" when there are fewer commas
+    k = np.arange(nfields + 1)
+    commas = np.where(k < counts[:, None], columns[np.minimum(first[:, None] + k, len(columns) - 1)], star[:, None])
+    return commas[:, :-1] + 1, commas[:, 1:], counts >= nfields
+
+
+def _parse_fixed_point(rows, starts, ends, width=16):
+    """
+    Parses decimal numbers ("ddmm.mmmm", "12.5"...) as exact integers
+    :param rows: (np.ndarray) (N, W) uint8 sentence rows
+    :param starts: (np.ndarray) first column of the field, per row
+    :param ends: (np.ndarray) column after the field, per row
+    :param width: (int) maximum field length
+    :return: (np.ndarray) int64 mantissa, (np.ndarray) number of decimals, (np.ndarray) non empty and well formed
+    """
+    columns = starts[:, None] + np.arange(width)
+    inside = columns < ends[:, None]
+    chars = np.take_along_axis(rows, np.minimum(columns, rows.shape[1] - 1), axis=1)
+    is_dot = inside & (chars == ord("."))
+    digits = chars.astype(np.int64) - ord("0")
+    is_digit = inside & (digits >= 0) & (digits <= 9)
+
+    # weight each digit by the number of digits after it in the field
+    weights = np.cumsum(is_digit[:, ::-1], axis=1, dtype=np.int8)[:, ::-1] - is_digit
+    mantissa = np.where(is_digit, digits * 10 ** weights.astype(np.int64), 0).sum(axis=1)
+    has_dot = is_dot.any(axis=1)
+    decimals = np.where(has_dot, np.sum(is_digit & (np.cumsum(is_dot, axis=1, dtype=np.int8) > 0), axis=1), 0)
+    ok = (is_digit.sum(axis=1) > 0) & (is_digit | is_dot | ~inside).all(axis=1) & (is_dot.sum(axis=1) <= 1)
+    return mantissa, decimals, ok
+
+
+def _parse_decimal(rows, starts, ends):
+    mantissa, decimals, ok = _parse_fixed_point(rows, starts, ends)
+    return np.where(ok, mantissa / 10.0 ** decimals, np.nan)
+
+
 def _convert_gps_to_decimal_degree(value, code):
     """
-    Converts the GPRMC style gps coordinate to decimal degrees
-    :param value: (String) GPRMC gps coordinate
-    :param code: (String) Compass direction of coordinate (N, E, S, W)
-    :return: (Float) decimal degree value of float
+    Converts GPRMC style gps coordinates to decimal degrees
+    :param value: (np.ndarray) GPRMC gps coordinates (ddmm.mmmm)
+    :param code: (np.ndarray) compass direction of the coordinates (N, E, S, W) as uint8
+    :return: (np.ndarray) decimal degree values
+    """
+    degrees = np.floor(value / 100)
+    minutes = value - degrees * 100
+    sign = np.where((code == ord("S")) | (code == ord("W")), -1., 1.)
+    return (degrees + minutes / 60) * sign
+
+
+def decode_gprmc(byte_data: bytes) -> NPGPRMC:
+    """
+    Decodes every GPRMC sentence of the byte data at once
+    The sentences are gathered into a 2D array and every field is parsed with
+    array operations, checksums included, without a per-sentence Python loop.
+    :param byte_data: (Bytes) the raw text track
+    :return: (NPGPRMC) timestamps as int64 UTC epoch nanoseconds, latitude and
+        longitude in decimal degrees, speed in m/s, bearing in degrees (nan when
+        empty) and whether the sentence is a valid fix: correct checksum, status
+        "A", a date and a position. Invalid sentences get `time_utils.NO_TIMESTAMP`.
+    """
+    buffer = np.frombuffer(byte_data, dtype=np.uint8)
+    offsets = _find_sentences(buffer, b"$GPRMC")
+    return _decode_gprmc_rows(*_sentence_rows(buffer, offsets))
+
+
+def _decode_gprmc_rows(rows, star, checksum_ok):
+    """
+    Decodes GPRMC sentence rows, see `decode_gprmc`
+    :param rows: (np.ndarray) (N, W) uint8 rows cut by `_cut_rows`
+    :param star: (np.ndarray) column of the "*" ending each sentence
+    :param checksum_ok: (np.ndarray) whether the checksum of each sentence is correct
+    :return: (NPGPRMC) the decoded columns
+    """
+    # fields: utc, status, lat, lat code, long, long code, speed, bearing, date
+    starts, ends, complete = _field_bounds(rows, star, 9)
+    rows_index = np.arange(len(rows))
+
+    hours, hours_ok = time_utils.parse_digits(rows, starts[:, 0], 2)
+    minutes, minutes_ok = time_utils.parse_digits(rows, starts[:, 0] + 2, 2)
+    seconds, seconds_decimals, seconds_ok = _parse_fixed_point(rows, starts[:, 0] + 4, ends[:, 0])
+    day, day_ok = time_utils.parse_digits(rows, starts[:, 8], 2)
+    month, month_ok = time_utils.parse_digits(rows, starts[:, 8] + 2, 2)
+    year, year_ok = time_utils.parse_digits(rows, starts[:, 8] + 4, 2)
+    nanoseconds = seconds * 10 ** (9 - np.minimum(seconds_decimals, 9))
+    date_ok = hours_ok & minutes_ok & seconds_ok & day_ok & month_ok & year_ok & (month >= 1) & (month <= 12)
+    timestamps = time_utils.civil_to_epoch_ns(2000 + year, np.where(date_ok, month, 1), day, hours, minutes, nanoseconds)
+
+    latitude = _convert_gps_to_decimal_degree(_parse_decimal(rows, starts[:, 2], ends[:, 2]), rows[rows_index, starts[:, 3]])
+    longitude = _convert_gps_to_decimal_degree(_parse_decimal(rows, starts[:, 4], ends[:, 4]), rows[rows_index, starts[:, 5]])
+    speed = _parse_decimal(rows, starts[:, 6], ends[:, 6]) * KNOTS_TO_MPS
+    bearing = _parse_decimal(rows, starts[:, 7], ends[:, 7])
+
+    status = rows[rows_index, starts[:, 1]]
+    valid = checksum_ok & complete & date_ok & (status == ord("A")) & np.isfinite(latitude) & np.isfinite(longitude)
+    timestamps[~valid] = time_utils.NO_TIMESTAMP
+    logger.debug("decoded %i GPRMC sentences, %i valid", len(rows), valid.sum())
+
+    return NPGPRMC(timestamps, latitude, longitude, speed, bearing, valid)
+
+
+def _decode_gpgga_rows(rows, star, checksum_ok, msecs, start_timestamp):
+    """
+    Decodes GPGGA sentence rows, timed by the GPRMC sentence of the same record
+    :param rows: (np.ndarray) (N, W) uint8 rows cut by `_cut_rows`
+    :param star: (np.ndarray) column of the "*" ending each sentence
+    :param checksum_ok: (np.ndarray) whether the checksum of each sentence is correct
+    :param msecs: (np.ndarray) time of each record
+    :param start_timestamp: (int) UTC epoch nanoseconds of msecs 0, None if unknown
+    :return: (NPGPGGA) the decoded columns, nan for the invalid sentences
+    """
+    # fields: utc, lat, lat code, long, long code, fix, satellites, hdop, altitude
+    starts, ends, complete = _field_bounds(rows, star, 9)
+    rows_index = np.arange(len(rows))
+    valid = checksum_ok & complete
+
+    latitude = _convert_gps_to_decimal_degree(_parse_decimal(rows, starts[:, 1], ends[:, 1]), rows[rows_index, starts[:, 2]])
+    longitude = _convert_gps_to_decimal_degree(_parse_decimal(rows, starts[:, 3], ends[:, 3]), rows[rows_index, starts[:, 4]])
+    fix, satellites, hdop, altitude = np.where(valid, [_parse_decimal(rows, starts[:, i], ends[:, i]) for i in (5, 6, 7, 8)], np.nan)
+    latitude, longitude = np.where(valid, [latitude, longitude], np.nan)
+
+    return NPGPGGA(msecs, latitude, longitude, altitude, hdop, satellites, fix, start_timestamp)
+
+
+def _nextbase_records(byte_data):
+    """
+    Views the text track as fixed-stride records, located by their GPRMC sentence
+    :param byte_data: (Bytes) the raw text track
+    :return: (np.ndarray) array of `nextbase_record_dtype`, a view on the data when the records are contiguous
     """
+    buffer = np.frombuffer(byte_data, dtype=np.uint8)
+    gprmc_offset = nextbase_record_dtype.fields["gprmc"][1]
+    starts = _find_sentences(buffer, b"$GPRMC") - gprmc_offset
+    starts = starts[(starts >= 0) & (starts + nextbase_record_dtype.itemsize <= len(buffer))]
+    if len(starts) == 0:
+        return np.zeros(0, dtype=nextbase_record_dtype)
+
+    if (np.diff(starts) == nextbase_record_dtype.itemsize).all():
+        return np.frombuffer(byte_data, dtype=nextbase_record_dtype, count=len(starts), offset=int(starts[0]))
 
-    val_deg = float(value.split(".")[0][:-2])
-    val_min = float(value.split(".")[0][-2:])  # two digits to left of decimal point
-    val_sec = float(value.split(".")[1]) / 10 ** len(value.split(".")[1])
+    # samples with headers or missing records: gather every record on its own
+    rows = buffer[starts[:, None] + np.arange(nextbase_record_dtype.itemsize)]
+    return rows.view(nextbase_record_dtype).reshape(len(starts))
 
-    if code in ["S", "W"]:
-        sign = -1
-    else:
-        sign = 1
 
-    coord_dd = (val_deg + val_min / 60 + val_sec / 60) * sign
+def _record_msecs(timestamps, valid):
+    """
+    Times the records from their valid GPRMC timestamps, interpolating the others
+    :param timestamps: (np.ndarray) UTC epoch nanoseconds of each record
+    :param valid: (np.ndarray) whether each timestamp is valid
+    :return: (np.ndarray) msecs of each record, (int) UTC epoch nanoseconds of msecs 0 or None
+    """
+    index = np.arange(len(timestamps))
+    if valid.sum() < 2:
+        start_timestamp = int(timestamps[valid][0]) if valid.any() else None
+        first = index[valid][0] if valid.any() else 0
+        return (index - first) * 1000., start_timestamp
 
-    return coord_dd
+    start_timestamp = int(timestamps[valid][0])
+    valid_msecs = (timestamps[valid] - start_timestamp) / time_utils.NS_PER_MSEC
+    period = np.median(np.diff(valid_msecs) / np.diff(index[valid]))
+    msecs = np.interp(index, index[valid], valid_msecs)
+    # np.interp clamps outside of the valid records: extrapolate at the median period
+    before, after = index < index[valid][0], index > index[valid][-1]
+    msecs[before] = (index[before] - index[valid][0]) * period
+    msecs[after] = valid_msecs[-1] + (index[after] - index[valid][-1]) * period
+    return msecs, start_timestamp
 
 
-def _get_gprmc_data(gprmc_bytes):
+def decode_nextbase(byte_data: bytes) -> Tuple[NPACCL, NPGYRO, NPGPRMC, NPGPGGA]:
     """
-    Extracts the GPRMC data from the bytes
-    :param gprmc_bytes: (Bytes) of data
-    :return: datetimestamp (datetime), float) latitude, (float) longitude, (String) speed, (String) degree
+    Decodes the IMU samples, GPRMC and GPGGA sentences of a Nextbase text track at once
+    Every record is 480 bytes of IMU samples (20 x accelerometer/gyroscope x 3
+    little-endian float32) followed by a 128 byte GPRMC and a 128 byte GPGGA
+    sentence. The records are viewed through `nextbase_record_dtype` and all
+    their fields are decoded with array operations.
+    :param byte_data: (Bytes) the raw text track
+    :return: (Tuple) NPACCL and NPGYRO with 20 samples per record, NPGPRMC and
+        NPGPGGA with one row per record. The IMU and GPGGA times come from the
+        GPRMC timestamps, interpolated over the records without a valid one.
     """
-    (
-        utc,
-        status,
-        latitude,
-        latitude_code,
-        longitude,
-        longitude_code,
-        speed,
-        degree,
-        date,
-        variation,
-        code,
-        checksum,
-    ) = (
-        str(gprmc_bytes).split("GPRMC,")[1].split(",")
+    records = _nextbase_records(byte_data)
+
+    np_gprmc = _decode_gprmc_rows(*_cut_rows(records["gprmc"].copy()))
+    record_msecs, start_timestamp = _record_msecs(np_gprmc.np_timestamps, np_gprmc.np_valid)
+    np_gpgga = _decode_gpgga_rows(*_cut_rows(records["gpgga"].copy()), record_msecs, start_timestamp)
+
+    # the samples of a record are spread evenly until the next record
+    periods = np.append(np.diff(record_msecs), np.median(np.diff(record_msecs)) if len(records) > 1 else 1000.)
+    sample_msecs = (record_msecs[:, None] + np.arange(IMU_SAMPLES_PER_RECORD) * periods[:, None] / IMU_SAMPLES_PER_RECORD).ravel()
+    block_starts = np.arange(len(records)) * IMU_SAMPLES_PER_RECORD
+
+    imu = records["imu"].astype(np.float64).reshape(-1, 2, 3)
+    np_accl, np_gyro = (
+        np_type.from_columns({
+            "np_block_starts": block_starts,
+            "np_msecs": sample_msecs,
+            "np_z": imu[:, sensor, 2],
+            "np_x": imu[:, sensor, 0],
+            "np_y": imu[:, sensor, 1],
+        }, start_timestamp)
+        for sensor, np_type in ((0, NPACCL), (1, NPGYRO))
     )
-    datetimestamp = datetime.datetime.strptime(
-        date + utc, "%d%m%y%H%M%S.%f"
-    ).timestamp()
-    latitude = _convert_gps_to_decimal_degree(latitude, latitude_code)
-    longitude = _convert_gps_to_decimal_degree(longitude, longitude_code)
-    return {
-        "timestamp": datetimestamp,
-        "latitude": latitude,
-        "longitude": longitude,
-        "bearing": _try_float(degree),
-    }
+    logger.debug("decoded %i Nextbase records", len(records))
+
+    return np_accl, np_gyro, np_gprmc, np_gpgga
 
 
 def _check_imu_gps_data_in_binary(binary_file_path):
@@ -89,36 +361,38 @@ def _check_imu_gps_data_in_binary(binary_file_path):
     :return: (boolean) True if data found in the right format, False elsewise
     """
     # order is 480 bytes of imu (20x2x12bytes) followed by 128 bytes of gprmc and 128 bytes of gpgga
+    tag = b"$GPRMC"
+    chunk_size = 1 << 16
     with open(binary_file_path, "rb") as f:
-        s = f.read()
-    gprmc_index = s.find(b"$GPRMC")
-
-    if gprmc_index < 480:
-        return False
-
-    return True
-
-
-def _try_float(v):
-    try:
-        return float(v)
-    except Exception:
-        return None
+        # read until the first sentence only, keeping the end of the previous chunk for a tag across chunks
+        data = b""
+        offset = 0
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return False
+            data = data[-(len(tag) - 1):] + chunk if data else chunk
+            gprmc_index = data.find(tag)
+            if gprmc_index >= 0:
+                return offset + gprmc_index >= 480
+            offset += len(data) - (len(tag) - 1)
 
 
 def _extract_gps_locations_from_byte_data(byte_data):
     """
     Extracts IMU and GPS data from binary file
-    :param file_path: (String) path to binary file
+    :param byte_data: (Bytes) the raw text track
     :return: (List[Dict]) list of dicts, each dict is represent a gps location example [{"timestamp": 111, "latitude": 15.3,"longitude": 1.2,"bearing": .9}]
     """
     # order is 480 bytes of imu (20x2x12bytes) followed by 128 bytes of gprmc and 128 bytes of gpgga
 
-    indices_of_GPRMC_bytes = [m.start() for m in re.finditer(b"\$GPRMC", byte_data)]
-    gprmc_lines = [byte_data[index : index + 128] for index in indices_of_GPRMC_bytes]
-
-    print(str(gprmc_lines[0]))
-
-    gprmc_extracted_data = [_get_gprmc_data(gprmc_line) for gprmc_line in gprmc_lines]
+    np_gprmc = decode_gprmc(byte_data)
+    # void and corrupted sentences have no location
+    valid = np_gprmc.np_valid
+    bearings = [None if bearing != bearing else bearing for bearing in np_gprmc.np_bearing[valid].tolist()]
 
-    return gprmc_extracted_data
+    return [
+        {"timestamp": timestamp, "latitude": latitude, "longitude": longitude, "bearing": bearing}
+        for timestamp, latitude, longitude, bearing
+        in zip((np_gprmc.np_timestamps[valid] / 1e9).tolist(), np_gprmc.np_lat[valid].tolist(), np_gprmc.np_long[valid].tolist(), bearings)
+    ]
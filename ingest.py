@@ -0,0 +1,82 @@
+import asyncio
+from collections import namedtuple
+import traceback
+
+from JE_ffprobe import JE_FFProbe
+import batch
+import gps_data_extractor
+import main
+
+ClipTelemetry = namedtuple("ClipTelemetry", ["video_path", "kind", "telemetry", "error"])
+
+# kind: (codec tag of the telemetry stream, decoder of the raw stream)
+decoders = {
+    "gopro": ("gpmd", main.decode_gpmf_stream),
+    "nextbase": ("text", gps_data_extractor.decode_nextbase),
+}
+
+
+async def extract_clip_async(video_path, semaphore, executor=None, cache=None):
+    """ Probe, extract and decode the telemetry of one clip
+    Only the probe and extraction hold the semaphore: the decoding runs on
+    `executor` once it is released, so the next clip is extracted while this
+    one is decoded.
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    semaphore: asyncio.Semaphore
+        Bounds the number of clips being probed and extracted at once.
+    executor: concurrent.futures.Executor, optional
+        Where to decode. A `ProcessPoolExecutor` keeps the decoding off the
+        event loop process, defaults to the loop executor.
+    cache: TelemetryCache, optional
+        The telemetry cache, see `batch.process_clip`.
+    Returns
+    -------
+    clip: ClipTelemetry
+        Any exception is caught and reported in `error`.
+    """
+    kind = None
+    try:
+        async with semaphore:
+            probe = await JE_FFProbe.open_async(video_path, cache)
+            kind = batch.detect_kind(probe)
+            if kind is None:
+                raise RuntimeError("No gpmd or text telemetry stream found")
+            codec_tag, decode = decoders[kind]
+            stream = await probe.extract_bin_stream_async(codec_tag)
+
+        telemetry = await asyncio.get_running_loop().run_in_executor(executor, decode, stream)
+        return ClipTelemetry(video_path, kind, telemetry, None)
+    except Exception:
+        return ClipTelemetry(video_path, kind, None, traceback.format_exc())
+
+
+async def iter_clips_async(video_paths, max_concurrency=4, executor=None, cache=None):
+    """ Extract the telemetry of many clips concurrently
+    Parameters
+    ----------
+    video_paths: list of str
+        The input files
+    max_concurrency: int, optional (default=4)
+        The number of clips probed and extracted at once.
+    executor: concurrent.futures.Executor, optional
+        Where to decode, see `extract_clip_async`.
+    cache: TelemetryCache, optional
+        The telemetry cache.
+    Returns
+    -------
+    clip_gen: async generator
+        A generator of `ClipTelemetry`, in completion order. The telemetry is
+        (NPGPS, NPGYRO, NPACCL) for GoPro clips and (NPACCL, NPGYRO, NPGPRMC,
+        NPGPGGA) for Nextbase clips.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = [asyncio.ensure_future(extract_clip_async(video_path, semaphore, executor, cache)) for video_path in video_paths]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,170 @@
+from collections import namedtuple
+import contextvars
+import threading
+import time
+import tracemalloc
+
+StageStats = namedtuple("StageStats", ["calls", "seconds", "bytes_in", "items_out", "peak_bytes"])
+
+enabled = False
+track_memory = False
+_stats = {}
+_stats_lock = threading.Lock()
+# the stages open in the current thread or asyncio task, innermost last
+_stack = contextvars.ContextVar("instrument_stack", default=())
+
+
+class _NullStage:
+    """ What `stage` returns when instrumentation is disabled: does nothing """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, bytes_in=0, items_out=0):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+class _Stage:
+
+    def __init__(self, name, bytes_in, items_out):
+
+        self.name = name
+        self.bytes_in = bytes_in
+        self.items_out = items_out
+        self.peak_seen = 0
+
+    def __enter__(self):
+
+        self.parents = _stack.get()
+        if track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.parents:
+                # resetting the peak below would hide the peak of the enclosing stage so far
+                self.parents[-1].peak_seen = max(self.parents[-1].peak_seen, peak)
+            tracemalloc.reset_peak()
+            self.memory_start = current
+        _stack.set(self.parents + (self,))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+
+        seconds = time.perf_counter() - self.start
+        _stack.set(self.parents)
+        peak_bytes = 0
+        if track_memory:
+            peak = max(self.peak_seen, tracemalloc.get_traced_memory()[1])
+            peak_bytes = peak - self.memory_start
+            if self.parents:
+                self.parents[-1].peak_seen = max(self.parents[-1].peak_seen, peak)
+
+        with _stats_lock:
+            stats = _stats.get(self.name)
+            if stats is None:
+                _stats[self.name] = StageStats(1, seconds, self.bytes_in, self.items_out, peak_bytes)
+            else:
+                _stats[self.name] = StageStats(stats.calls + 1, stats.seconds + seconds, stats.bytes_in + self.bytes_in,
+                                               stats.items_out + self.items_out, max(stats.peak_bytes, peak_bytes))
+        return False
+
+    def add(self, bytes_in=0, items_out=0):
+        """ Count bytes read or items produced by the stage, once known """
+        self.bytes_in += bytes_in
+        self.items_out += items_out
+
+
+def stage(name, bytes_in=0, items_out=0):
+    """ Time a pipeline stage
+    Used as `with instrument.stage("extract") as s: ... s.add(items_out=n)`.
+    When instrumentation is disabled, a shared no-op object is returned, so
+    an instrumented stage costs one function call. Stages nest within each
+    thread and asyncio task, peaks of allocations are process wide.
+    Parameters
+    ----------
+    name: str
+        The stage name, e.g. "probe", "extract", "klv_parse".
+    bytes_in: int, optional
+        The size of the input, when known upfront.
+    items_out: int, optional
+        The number of items produced, when known upfront.
+    Returns
+    -------
+    stage: context manager
+    """
+    if not enabled:
+        return _null_stage
+    return _Stage(name, bytes_in, items_out)
+
+
+def enable(memory=False):
+    """ Start recording stage statistics
+    Parameters
+    ----------
+    memory: bool, optional (default=False)
+        Also record the peak Python allocations of each stage with
+        tracemalloc, which slows allocations down.
+    """
+    global enabled, track_memory
+    enabled = True
+    track_memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+
+    global enabled, track_memory
+    if track_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    enabled = False
+    track_memory = False
+
+
+def reset():
+
+    with _stats_lock:
+        _stats.clear()
+
+
+def get_stats():
+    """ Return the statistics recorded so far
+    Returns
+    -------
+    stats: dict of str to StageStats
+        Per stage: number of calls, total wall time in seconds, total bytes in,
+        total items out and largest peak of allocations in bytes.
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def merge_stats(stats):
+    """ Add statistics recorded elsewhere, e.g. in a worker process """
+    with _stats_lock:
+        for name, other in stats.items():
+            other = StageStats(*other)
+            current = _stats.get(name)
+            if current is None:
+                _stats[name] = other
+            else:
+                _stats[name] = StageStats(current.calls + other.calls, current.seconds + other.seconds,
+                                          current.bytes_in + other.bytes_in, current.items_out + other.items_out,
+                                          max(current.peak_bytes, other.peak_bytes))
+
+
+def format_stats(stats=None):
+    """ Format statistics as a table, one row per stage """
+    stats = get_stats() if stats is None else stats
+    lines = ["%-16s %7s %10s %12s %12s %10s %12s" % (
+        "stage", "calls", "time (s)", "MB in", "items out", "MB/s", "peak (MB)")]
+    for name, s in stats.items():
+        lines.append("%-16s %7i %10.4f %12.2f %12i %10.1f %12.2f" % (
+            name, s.calls, s.seconds, s.bytes_in / 1e6, s.items_out,
+            s.bytes_in / 1e6 / s.seconds if s.seconds else 0., s.peak_bytes / 1e6))
+    return "\n".join(lines)
@@ -1,17 +1,20 @@
 from gps_data_extractor import extract_gps_locations_from_video
+import argparse
+import logging
 import ffmpeg
-import cProfile
 import struct
 import numpy as np
 from collections import namedtuple
-import datetime
 
 from JE_ffprobe import JE_FFProbe
+import instrument
+import mp4_reader
 import parse
+import time_utils
 import gps
-from np_telem import NPGPS, NPACCL, NPGYRO
+from np_telem import NPGPS, NPACCL, NPGYRO, NPACCLCompact, NPGYROCompact, get_block_timing, get_start_timestamp
 
-should_profile = False
+logger = logging.getLogger(__name__)
 
 def find_gpmf_stream(fname):
     """ Find the reference to the GPMF Stream in the video file
@@ -27,16 +30,15 @@ def find_gpmf_stream(fname):
     ------
     RuntimeError: If no stream found.
     """
-    probe = ffmpeg.probe(fname)
-
-    for s in probe["streams"]:
-        if s["codec_tag_string"] == "gpmd":
-            return s
-
-    raise RuntimeError("Could not find GPS stream")
+    stream_info = JE_FFProbe(fname).get_stream("gpmd")
+    if stream_info is None:
+        raise RuntimeError("Could not find GPS stream")
+    return stream_info
 
 def extract_gpmf_stream(fname, verbose=False):
     """Extract GPMF binary data from video files
+    The samples are read straight from the MP4 sample tables, ffmpeg is only
+    used when the container cannot be parsed natively.
     Parameters
     ----------
     fname: str
@@ -48,6 +50,11 @@ def extract_gpmf_stream(fname, verbose=False):
     gpmf_data: bytes
         The raw GPMF binary stream
     """
+    try:
+        return mp4_reader.extract_bin_stream(fname, "gpmd")
+    except (RuntimeError, KeyError, struct.error):
+        pass
+
     stream_info = find_gpmf_stream(fname)
     stream_index = stream_info["index"]
     return ffmpeg.input(fname)\
@@ -113,7 +120,7 @@ def get_DEVC_list(x, suffix=""):
         raw_payload = x[start: start + payload_size]
         DEVC_list.append(raw_payload)
         start += payload_size
-        print(suffix, fourcc, type_str, payload_size)
+        logger.debug("%s %s %s %i", suffix, fourcc, type_str, payload_size)
 
     return DEVC_list
 
@@ -135,9 +142,9 @@ def parse_DEVC(x):
         start += payload_size
 
         if type_str == 'c':
-            print(raw_payload.decode("latin1"))
+            logger.debug(raw_payload.decode("latin1"))
         else:
-            print(fourcc, type_str, payload_size)
+            logger.debug("%s %s %i", fourcc, type_str, payload_size)
 
     return STRM_list
 
@@ -157,150 +164,328 @@ def parse_STRM(x):
         start += payload_size
 
         if type_str == 'c':
-            print(raw_payload.decode("latin1"))
+            logger.debug(raw_payload.decode("latin1"))
         else:
-            print(fourcc, type_str, payload_size)
+            logger.debug("%s %s %i", fourcc, type_str, payload_size)
 
 
-def get_blocks_from_stream(stream):
+block_fourccs = ("ACCL", "GYRO", "GPS5")
 
-    accl_blocks = []
-    gyro_blocks = []
-    gps_blocks = []
-
-    for s in parse.filter_klv(stream, "STRM"):
-        content = []
-        block_type = None
-        for elt in s.value:
-            content.append(elt)
-            if elt.key == "GPS5":
-                block_type = "GPS5"
-            if elt.key == "GPS5":
-                block_type = "GPS5"
-            if elt.key == "ACCL":
-                block_type = "ACCL"
-            if elt.key == "GYRO":
-                block_type = "GYRO"
-        if block_type == "GPS5":
-            gps_blocks.append(content)
-        if block_type == "ACCL":
-            accl_blocks.append(content)
-        if block_type == "GYRO":
-            gyro_blocks.append(content)
-
-    return accl_blocks, gyro_blocks, gps_blocks
-
-GPSItem = namedtuple("GPSItem",
-                     [
-                         "latitude",
-                         "longitude",
-                         "altitude",
-                         "speed_2d",
-                         "speed_3d",
-                     ])
+def get_blocks_from_stream(stream):
+    """ Collect the accelerometer, gyroscope and GPS data blocks of a stream
+    The KLV headers are indexed first, so only the `STRM` containers holding
+    one of `block_fourccs` are decoded, the others are skipped unread.
+    Parameters
+    ----------
+    stream: bytes
+        The raw GPMF binary stream
+    Returns
+    -------
+    accl_blocks, gyro_blocks, gps_blocks: list of list of KLVItem
+        The items of each `STRM`, in stream order.
+    """
+    x = memoryview(stream)
+    with instrument.stage("klv_parse", bytes_in=len(x)) as stage:
+        index = parse.index_klv(x)
+        blocks = {fourcc: [] for fourcc in block_fourccs}
+
+        rows = np.nonzero(parse.select_klv(index, block_fourccs, "STRM"))[0]
+        for row in rows:
+            strm = index[index[row]["parent"]]
+            start = int(strm["offset"])
+            content = list(parse.iter_klv(x, start, start + parse.ceil4(int(strm["size"]) * int(strm["repeat"]))))
+            blocks[index[row]["fourcc"].decode("latin1")].append(content)
+        stage.add(items_out=len(rows))
+
+    return blocks["ACCL"], blocks["GYRO"], blocks["GPS5"]
+
+GPSColumns = namedtuple("GPSColumns",
+                        [
+                            "latitude",
+                            "longitude",
+                            "altitude",
+                            "speed_2d",
+                            "speed_3d",
+                        ])
+
+GYROColumns = namedtuple("GYROColumns",
+                         [
+                             "gy_z",
+                             "gy_x",
+                             "gy_y",
+                         ])
+
+ACCLColumns = namedtuple("ACCLColumns",
+                         [
+                             "acc_z",
+                             "acc_x",
+                             "acc_y",
+                         ])
+
+
+def get_columns_from_blocks(blocks, fourcc, parse_block, columns_type):
+    """Decode data blocks straight into preallocated column arrays
+    The number of points of every block is read from its `fourcc` item first,
+    so the output columns are allocated once and each parsed block is copied in
+    place and dropped. No per-sample Python object is created.
+    Parameters
+    ----------
+    blocks: list of list of KLVItem
+        The data blocks, as returned by `get_blocks_from_stream`.
+    fourcc: str
+        The FourCC code of the data item of a block, e.g. "GPS5".
+    parse_block: callable
+        The block parser, e.g. `gps.parse_gps_block`.
+    columns_type: type
+        The namedtuple type of the output, its fields name the attributes of the
+        parsed blocks to keep.
+    Returns
+    -------
+    timestamp_indexes: numpy.ndarray
+        The index of the first point of each block.
+    parsed_blocks: list
+        The parsed blocks, with their column arrays dropped.
+    columns: columns_type
+        One array per field, holding the points of all blocks.
+    """
+    npoints = [len(next(elt.value for elt in block if elt.key == fourcc)) for block in blocks]
+    timestamp_indexes = np.cumsum([0] + npoints[:-1]) if npoints else np.zeros(0, dtype=np.int64)
+    columns = columns_type(*(np.empty(sum(npoints)) for _ in columns_type._fields))
+
+    parsed_blocks = []
+    with instrument.stage("block_decode", items_out=sum(npoints)):
+        for start, n, block in zip(timestamp_indexes, npoints, blocks):
+            parsed_block = parse_block(block)
+            for field, column in zip(columns_type._fields, columns):
+                column[start: start + n] = getattr(parsed_block, field)
+            parsed_blocks.append(parsed_block._replace(**{field: None for field in columns_type._fields}))
+
+    return timestamp_indexes, parsed_blocks, columns
+
+def get_raw_from_blocks(blocks, fourcc):
+    """Copy the raw integer samples of data blocks into one array, without scaling
+    Parameters
+    ----------
+    blocks: list of list of KLVItem
+        The data blocks, as returned by `get_blocks_from_stream`.
+    fourcc: str
+        The FourCC code of the data item of a block, e.g. "GYRO".
+    Returns
+    -------
+    timestamp_indexes: numpy.ndarray
+        The index of the first point of each block.
+    raw: numpy.ndarray
+        (N, k) array of the samples of all blocks, in native byte order.
+    scales: numpy.ndarray
+        (number of blocks, k) float64 array, the SCAL of each block and value
+        column, 1 when missing.
+    """
+    items = [next(elt for elt in block if elt.key == fourcc) for block in blocks]
+    if not items:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.int16), np.ones((0, 3))
+    itemsize = np.asarray(items[0].value).dtype.itemsize
+    width = items[0].length.size // itemsize
+    npoints = [item.length.repeat for item in items]
+    timestamp_indexes = np.cumsum([0] + npoints[:-1])
+
+    raw = np.empty((sum(npoints), width), dtype=np.asarray(items[0].value).dtype.newbyteorder("="))
+    with instrument.stage("block_decode", items_out=len(raw)):
+        for start, n, item in zip(timestamp_indexes, npoints, items):
+            raw[start: start + n] = np.reshape(item.value, (n, width))
+
+    scales = np.ones((len(blocks), width))
+    for i, scal in enumerate(get_block_values(blocks, "SCAL")):
+        if scal is not None:
+            scales[i] = scal
+    return timestamp_indexes, raw, scales
 
 def get_gps_list_from_blocks(gps_blocks):
 
-    timestamp_indexes = []
-    timestamp_timestamps = []
-    items = []
-
-    index = 0
-    for block in gps_blocks:
-        # for kvl_item in block:
-        #     if kvl_item.key == "GPSU":
-        #         timestamp = kvl_item.value
-        #     if kvl_item.key == "GPS5":
-        #         data = kvl_item.value
-
-        parsed_block = gps.parse_gps_block(block)
-        timestamp_indexes.append(index)
-        timestamp_timestamps.append(parsed_block.timestamp)
-        for i in range(parsed_block.npoints):
-            item = GPSItem(parsed_block.latitude[i], parsed_block.longitude[i], parsed_block.altitude[i], parsed_block.speed_2d[i], parsed_block.speed_3d[i])
-            items.append(item)
-        index += parsed_block.npoints
-
-    print(timestamp_indexes)
-    print(timestamp_timestamps)
-    print(items[0])
-    print(items[-1])
+    timestamp_indexes, parsed_blocks, items = get_columns_from_blocks(gps_blocks, "GPS5", gps.parse_gps_block, GPSColumns)
+    timestamp_timestamps = time_utils.gpsu_to_epoch_ns([parsed_block.timestamp for parsed_block in parsed_blocks])
 
-    return timestamp_indexes, timestamp_timestamps, items
+    logger.debug("block starts %s", timestamp_indexes)
+    logger.debug("block timestamps %s", timestamp_timestamps)
+    logger.debug("%i points", len(items.latitude))
 
-GYROItem = namedtuple("GYROItem",
-                     [
-                         "gy_z",
-                         "gy_x",
-                         "gy_y",
-                     ])
+    return timestamp_indexes, timestamp_timestamps, items
 
 def get_gyro_list_from_blocks(timestamp_timestamps, gyro_blocks):
 
-    timestamp_indexes = []
-    items = []
+    timestamp_indexes, _, items = get_columns_from_blocks(gyro_blocks, "GYRO", gps.parse_gyro_block, GYROColumns)
 
-    index = 0
-    for block in gyro_blocks:
+    logger.debug("block starts %s", timestamp_indexes)
+    logger.debug("block timestamps %s", timestamp_timestamps)
+    logger.debug("%i points", len(items.gy_z))
 
-        parsed_block = gps.parse_gyro_block(block)
-        timestamp_indexes.append(index)
-        for i in range(parsed_block.npoints):
-            item = GYROItem(parsed_block.gy_z[i], parsed_block.gy_x[i], parsed_block.gy_y[i])
-            items.append(item)
-        index += parsed_block.npoints
+    return timestamp_indexes, timestamp_timestamps, items
 
-    print(timestamp_indexes)
-    print(timestamp_timestamps)
-    print(items[0])
-    print(items[-1])
+def get_accl_list_from_blocks(timestamp_timestamps, accl_blocks):
 
-    return timestamp_indexes, timestamp_timestamps, items
+    timestamp_indexes, _, items = get_columns_from_blocks(accl_blocks, "ACCL", gps.parse_accl_block, ACCLColumns)
 
-ACCLItem = namedtuple("ACCLItem",
-                     [
-                         "acc_z",
-                         "acc_x",
-                         "acc_y",
-                     ])
+    logger.debug("block starts %s", timestamp_indexes)
+    logger.debug("block timestamps %s", timestamp_timestamps)
+    logger.debug("%i points", len(items.acc_z))
 
-def get_accl_list_from_blocks(timestamp_timestamps, accl_blocks):
+    return timestamp_indexes, timestamp_timestamps, items
 
-    timestamp_indexes = []
-    items = []
+def calc_timestamp_steps(timestamp_indexes, timestamp_timestamps, items):
+    """ Compute the time step between two points of each block
+    Parameters
+    ----------
+    timestamp_indexes: numpy.ndarray
+        The index of the first point of each block.
+    timestamp_timestamps: numpy.ndarray
+        The UTC epoch nanoseconds of each block, `time_utils.NO_TIMESTAMP` when
+        missing. Blocks without a timestamp get the step of the previous one.
+    items: object
+        Unused, kept for compatibility.
+    Returns
+    -------
+    timestamp_steps: numpy.ndarray
+        The step in milliseconds of each block, the last block gets the median step.
+    """
+    n = min(len(timestamp_indexes), len(timestamp_timestamps))
+    timestamp_indexes = np.asarray(timestamp_indexes[:n], dtype=np.int64)
+    timestamp_timestamps = np.asarray(timestamp_timestamps[:n], dtype=np.int64)
+
+    timed = timestamp_timestamps != time_utils.NO_TIMESTAMP
+    if not timed.any():
+        return np.full(n, np.nan)
+    timed_indexes = timestamp_indexes[timed]
+
+    timestamp_steps = np.diff(timestamp_timestamps[timed]) / np.diff(timed_indexes) / time_utils.NS_PER_MSEC
+    timestamp_steps = np.append(timestamp_steps, np.median(timestamp_steps) if len(timestamp_steps) else np.nan)
+    spans = np.maximum(np.searchsorted(timed_indexes, timestamp_indexes, side="right") - 1, 0)
+    return timestamp_steps[spans]
+
+def get_block_values(blocks, fourcc):
+    """ Return the value of an item in each block, None for the blocks without it """
+    return [next((elt.value for elt in block if elt.key == fourcc), None) for block in blocks]
+
+def calc_sample_msecs(blocks, timestamp_indexes, npoints):
+    """ Time every point of a stream from its own TSMP and STMP counters
+    STMP is the microsecond time of the first sample of a block on the camera
+    clock, TSMP the number of samples delivered since the start of the recording,
+    this block included. A single least squares fit of STMP against the index
+    of the first sample of each block gives the sample period of the stream,
+    independently of GPS, see `time_utils.fit_sample_msecs`.
+    Parameters
+    ----------
+    blocks: list of list of KLVItem
+        The data blocks of the stream.
+    timestamp_indexes: numpy.ndarray
+        The index of the first point of each block in the output columns.
+    npoints: int
+        The total number of points.
+    Returns
+    -------
+    msecs: numpy.ndarray or None
+        The time of each point in milliseconds on the camera clock, None when
+        the blocks do not all have a STMP.
+    """
+    stmp = get_block_values(blocks, "STMP")
+    if any(t is None for t in stmp):
+        return None
+
+    block_sizes = np.diff(np.append(np.asarray(timestamp_indexes, dtype=np.int64), npoints))
+    tsmp = get_block_values(blocks, "TSMP")
+    if any(t is None for t in tsmp):
+        first_samples = np.asarray(timestamp_indexes, dtype=np.int64)
+    else:
+        first_samples = np.array(tsmp, dtype=np.int64) - block_sizes
 
-    index = 0
-    for block in accl_blocks:
+    return time_utils.fit_sample_msecs(stmp, first_samples, block_sizes)
 
-        parsed_block = gps.parse_accl_block(block)
-        timestamp_indexes.append(index)
-        for i in range(parsed_block.npoints):
-            item = ACCLItem(parsed_block.acc_z[i], parsed_block.acc_x[i], parsed_block.acc_y[i])
-            items.append(item)
-        index += parsed_block.npoints
+def calc_stmp_anchor(gps_blocks):
+    """ UTC epoch nanoseconds of STMP 0, from the GPS blocks with a fix
+    Returns
+    -------
+    anchor: int or None
+        None when GPS never had a fix.
+    """
+    gpsu = get_block_values(gps_blocks, "GPSU")
+    gpsf = get_block_values(gps_blocks, "GPSF")
+    stmp = get_block_values(gps_blocks, "STMP")
+    locked = [i for i in range(len(gps_blocks))
+              if gpsu[i] is not None and stmp[i] is not None and gpsf[i] is not None and gpsf[i] >= 2]
+    if not locked:
+        return None
+    gps_time = time_utils.gpsu_to_epoch_ns([gpsu[i] for i in locked])
+    camera_time = np.array([stmp[i] for i in locked], dtype=np.int64) * 1000
+    offsets = np.sort(gps_time - camera_time)
+    # integer median, float64 would round epoch nanoseconds
+    return int(offsets[(len(offsets) - 1) // 2] + (offsets[len(offsets) // 2] - offsets[(len(offsets) - 1) // 2]) // 2)
+
+def build_np_telem(np_type, blocks, timestamp_indexes, timestamp_timestamps, items, stmp_anchor):
+    """ Build an NP* object, timed from STMP when available, from GPSU steps otherwise """
+    with instrument.stage("columnize", items_out=len(items[0])):
+        msecs = calc_sample_msecs(blocks, timestamp_indexes, len(items[0]))
+        if msecs is not None:
+            return np_type(timestamp_indexes, timestamp_timestamps, items, None, msecs=msecs, start_timestamp=stmp_anchor)
+
+        timestamp_steps = calc_timestamp_steps(timestamp_indexes, timestamp_timestamps, items)
+        return np_type(timestamp_indexes, timestamp_timestamps, items, timestamp_steps)
+
+def build_np_imu(np_type, blocks, timestamp_indexes, timestamp_timestamps, raw, scales, stmp_anchor):
+    """ Build a compact NPIMU object, timed as in `build_np_telem` """
+    with instrument.stage("columnize", items_out=len(raw)):
+        block_sizes = np.diff(np.append(timestamp_indexes, len(raw)))
+        stmp = get_block_values(blocks, "STMP")
+        tsmp = get_block_values(blocks, "TSMP")
+        fit = None
+        if blocks and not any(t is None for t in stmp):
+            first_samples = (np.array(tsmp, dtype=np.int64) - block_sizes if not any(t is None for t in tsmp)
+                             else timestamp_indexes)
+            fit = time_utils.fit_sample_period(stmp, first_samples)
+        if fit is not None:
+            origin, period = fit
+            block_msecs = (origin + period * first_samples) / 1000.
+            return np_type(raw, timestamp_indexes, scales, block_msecs, np.full(len(blocks), period / 1000.), stmp_anchor)
+
+        timestamp_steps = calc_timestamp_steps(timestamp_indexes, timestamp_timestamps, None)
+        block_msecs, block_steps = get_block_timing(timestamp_indexes, timestamp_steps, len(raw))
+        return np_type(raw, timestamp_indexes, scales, block_msecs, block_steps, get_start_timestamp(timestamp_timestamps, block_msecs))
+
+def decode_gpmf_stream(stream, compact=False):
+    """Decode the GPS, gyroscope and accelerometer data of a GPMF stream
+    Streams with STMP stamps are timed on the camera clock, so they are usable
+    without GPS lock, and GPSU only anchors their `start_timestamp`. Older
+    streams fall back to steps between GPSU timestamps.
+    Parameters
+    ----------
+    stream: bytes
+        The raw GPMF binary stream
+    compact: bool, optional (default=False)
+        Keep the gyroscope and accelerometer samples as raw integers with
+        the SCAL of each block, scaled on access, see `np_telem.NPIMU`.
+    Returns
+    -------
+    np_gps: NPGPS
+    np_gyro: NPGYRO, or NPGYROCompact if compact
+    np_accl: NPACCL, or NPACCLCompact if compact
+    """
+    accl_blocks, gyro_blocks, gps_blocks = get_blocks_from_stream(stream)
+    stmp_anchor = calc_stmp_anchor(gps_blocks)
 
-    print(timestamp_indexes)
-    print(timestamp_timestamps)
-    print(items[0])
-    print(items[-1])
+    timestamp_indexes, timestamp_timestamps, items = get_gps_list_from_blocks(gps_blocks)
+    np_gps = build_np_telem(NPGPS, gps_blocks, timestamp_indexes, timestamp_timestamps, items, stmp_anchor)
 
-    return timestamp_indexes, timestamp_timestamps, items
+    if compact:
+        timestamp_indexes, raw, scales = get_raw_from_blocks(gyro_blocks, "GYRO")
+        np_gyro = build_np_imu(NPGYROCompact, gyro_blocks, timestamp_indexes, timestamp_timestamps, raw, scales, stmp_anchor)
+        timestamp_indexes, raw, scales = get_raw_from_blocks(accl_blocks, "ACCL")
+        np_accl = build_np_imu(NPACCLCompact, accl_blocks, timestamp_indexes, timestamp_timestamps, raw, scales, stmp_anchor)
+        return np_gps, np_gyro, np_accl
 
-def calc_timestamp_steps(timestamp_indexes, timestamp_timestamps, items):
+    timestamp_indexes, timestamp_timestamps, items = get_gyro_list_from_blocks(timestamp_timestamps, gyro_blocks)
+    np_gyro = build_np_telem(NPGYRO, gyro_blocks, timestamp_indexes, timestamp_timestamps, items, stmp_anchor)
 
-    timestamp_steps = []
-    last_i = None
-    last_t = None
-    for i, t in zip(timestamp_indexes, timestamp_timestamps):
-        t = datetime.datetime.strptime(t, "%Y-%m-%d %H:%M:%S.%f").timestamp()
-        if last_i is not None:
-            timestamp_steps.append((t - last_t) / (i - last_i))
-        else:
-            first_t = t
-        last_i, last_t = i, t
-    timestamp_steps.append(np.median(timestamp_steps))
+    timestamp_indexes, timestamp_timestamps, items = get_accl_list_from_blocks(timestamp_timestamps, accl_blocks)
+    np_accl = build_np_telem(NPACCL, accl_blocks, timestamp_indexes, timestamp_timestamps, items, stmp_anchor)
 
-    return timestamp_steps
+    return np_gps, np_gyro, np_accl
 
 def run_gopro_gps():
 
@@ -308,21 +493,9 @@ def run_gopro_gps():
     probe.log()
     stream = probe.extract_bin_stream("gpmd")
 
-    accl_blocks, gyro_blocks, gps_blocks = get_blocks_from_stream(stream)
-
-    timestamp_indexes, timestamp_timestamps, items = get_gps_list_from_blocks(gps_blocks)
-    timestamp_steps = calc_timestamp_steps(timestamp_indexes, timestamp_timestamps, items)
-    np_gps = NPGPS(timestamp_indexes, timestamp_timestamps, items, timestamp_steps)
+    np_gps, np_gyro, np_accl = decode_gpmf_stream(stream)
     np_gps.log()
-
-    timestamp_indexes, timestamp_timestamps, items = get_gyro_list_from_blocks(timestamp_timestamps, gyro_blocks)
-    timestamp_steps = calc_timestamp_steps(timestamp_indexes, timestamp_timestamps, items)
-    np_gyro = NPGYRO(timestamp_indexes, timestamp_timestamps, items, timestamp_steps)
     np_gyro.log()
-
-    timestamp_indexes, timestamp_timestamps, items = get_accl_list_from_blocks(timestamp_timestamps, accl_blocks)
-    timestamp_steps = calc_timestamp_steps(timestamp_indexes, timestamp_timestamps, items)
-    np_accl = NPACCL(timestamp_indexes, timestamp_timestamps, items, timestamp_steps)
     np_accl.log()
 
     return
@@ -341,8 +514,13 @@ def run_gopro_gps():
 
 if __name__ == "__main__":
 
-    if should_profile:
-        cProfile.run("run()")
-    else:
-        run_gopro_gps()
+    parser = argparse.ArgumentParser(description="Decode the telemetry of the sample GoPro clip")
+    parser.add_argument("--stats", action="store_true", help="print the time, throughput and memory of each stage")
+    args = parser.parse_args()
+
+    if args.stats:
+        instrument.enable(memory=True)
+    run_gopro_gps()
+    if args.stats:
+        print(instrument.format_stats())
 
@@ -0,0 +1,491 @@
+from collections import namedtuple
+import os
+import struct
+
+import numpy as np
+
+
+MP4Box = namedtuple("MP4Box", ["type", "offset", "header_size", "size"])
+
+MP4Track = namedtuple("MP4Track",
+                      [
+                          "track_id",
+                          "handler",
+                          "codec_tag",
+                          "timescale",
+                          "duration",
+                          "sample_offsets",
+                          "sample_sizes",
+                          "sample_times",
+                          "sample_durations",
+                      ])
+
+MP4TrackInfo = namedtuple("MP4TrackInfo",
+                          [
+                              "track_id",
+                              "handler",
+                              "codec_tag",
+                              "timescale",
+                              "duration",
+                              "sample_count",
+                              "data_size",
+                          ])
+
+_box_header = struct.Struct(">I4s")
+_large_size = struct.Struct(">Q")
+_u32 = struct.Struct(">I")
+
+
+def iter_boxes(buf, start=0, end=None):
+    """ Iterate on the ISO-BMFF boxes contained in a buffer
+    Parameters
+    ----------
+    buf: bytes or memoryview
+        The buffer holding the boxes.
+    start: int, optional (default=0)
+        Offset of the first box.
+    end: int, optional
+        Offset of the end of the last box. Defaults to the end of the buffer.
+    Returns
+    -------
+    box_gen: generator
+        A generator of `MP4Box` objects, offsets are relative to `buf`.
+    """
+    if end is None:
+        end = len(buf)
+
+    while start + 8 <= end:
+        size, box_type = _box_header.unpack_from(buf, start)
+        header_size = 8
+        if size == 1:
+            size, = _large_size.unpack_from(buf, start + 8)
+            header_size = 16
+        elif size == 0:
+            size = end - start
+        if size < header_size or start + size > end:
+            raise RuntimeError("Truncated MP4 box '%s' at offset %i" % (box_type.decode("latin1"), start))
+        yield MP4Box(box_type.decode("latin1"), start, header_size, size)
+        start += size
+
+
+def find_box(buf, path, start=0, end=None):
+    """ Find the first box following a path of box types
+    Parameters
+    ----------
+    buf: bytes or memoryview
+        The buffer holding the boxes.
+    path: list of str
+        The box types to descend through, e.g. ["mdia", "minf", "stbl"].
+    Returns
+    -------
+    box: MP4Box or None
+        The box found at the end of the path, None if missing.
+    """
+    box = None
+    for box_type in path:
+        for box in iter_boxes(buf, start, end):
+            if box.type == box_type:
+                break
+        else:
+            return None
+        start, end = box.offset + box.header_size, box.offset + box.size
+    return box
+
+
+def iter_file_boxes(f, start, end):
+    """ Iterate on the boxes of an open file, reading only their headers
+    Parameters
+    ----------
+    f: file
+        The file, opened in binary mode.
+    start: int
+        Offset of the first box.
+    end: int
+        Offset of the end of the last box, e.g. the file size.
+    Returns
+    -------
+    box_gen: generator
+        A generator of `MP4Box` objects, offsets are relative to the file.
+    """
+    while start + 8 <= end:
+        f.seek(start)
+        head = f.read(16)
+        size, box_type = _box_header.unpack_from(head)
+        header_size = 8
+        if size == 1:
+            size, = _large_size.unpack_from(head, 8)
+            header_size = 16
+        elif size == 0:
+            size = end - start
+        if size < header_size:
+            break
+        yield MP4Box(box_type.decode("latin1"), start, header_size, size)
+        start += size
+
+
+def read_moov(video_path):
+    """ Read the `moov` box of an MP4 file without reading the media data
+    Only the box headers are read until `moov` is found, so the cost does not
+    depend on the size of the `mdat` box.
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    Returns
+    -------
+    moov: bytes
+        The payload of the `moov` box.
+    Raises
+    ------
+    RuntimeError: If no `moov` box found.
+    """
+    with open(video_path, "rb") as f:
+        for box in iter_file_boxes(f, 0, os.path.getsize(video_path)):
+            if box.type == "moov":
+                f.seek(box.offset + box.header_size)
+                return f.read(box.size - box.header_size)
+
+    raise RuntimeError("Could not find moov box in %s" % video_path)
+
+
+def _full_box_payload(buf, box):
+    """ Return (version, payload_offset) of a full box """
+    version = buf[box.offset + box.header_size]
+    return version, box.offset + box.header_size + 4
+
+
+def _parse_mdhd(buf, box):
+    version, offset = _full_box_payload(buf, box)
+    if version == 1:
+        timescale, duration = struct.unpack_from(">IQ", buf, offset + 16)
+    else:
+        timescale, duration = struct.unpack_from(">II", buf, offset + 8)
+    return timescale, duration
+
+
+def _parse_tkhd(buf, box):
+    version, offset = _full_box_payload(buf, box)
+    if version == 1:
+        track_id, = _u32.unpack_from(buf, offset + 16)
+    else:
+        track_id, = _u32.unpack_from(buf, offset + 8)
+    return track_id
+
+
+def _parse_hdlr(buf, box):
+    _, offset = _full_box_payload(buf, box)
+    return bytes(buf[offset + 4: offset + 8]).decode("latin1")
+
+
+def _parse_stsd(buf, box):
+    _, offset = _full_box_payload(buf, box)
+    entry_count, = _u32.unpack_from(buf, offset)
+    if entry_count == 0:
+        return None
+    return bytes(buf[offset + 8: offset + 12]).decode("latin1")
+
+
+def _table(buf, box, header, dtype, columns=1):
+    """ Read the entry table of a full box as a big-endian numpy array
+    Raises
+    ------
+    RuntimeError: If the box is too small for its entry count.
+    """
+    _, offset = _full_box_payload(buf, box)
+    entry_count, = _u32.unpack_from(buf, offset + header - 4)
+    if offset + header + entry_count * columns * np.dtype(dtype).itemsize > box.offset + box.size:
+        raise RuntimeError("'%s' box of %i bytes too small for %i entries" % (box.type, box.size, entry_count))
+    table = np.frombuffer(buf, dtype=dtype, count=entry_count * columns, offset=offset + header)
+    table = table.astype(table.dtype.newbyteorder("="))
+    if columns > 1:
+        table = table.reshape(entry_count, columns)
+    return table
+
+
+def _parse_sample_table(buf, stbl):
+    """ Compute the byte offset, size and decode time of every sample
+    Raises
+    ------
+    RuntimeError: If a table is missing or does not cover every sample.
+    """
+    start, end = stbl.offset + stbl.header_size, stbl.offset + stbl.size
+    boxes = {box.type: box for box in iter_boxes(buf, start, end)}
+    missing = {"stsz", "stsc", "stts"}.difference(boxes) | ({"stco"} if "co64" not in boxes and "stco" not in boxes else set())
+    if missing:
+        raise RuntimeError("Missing sample table boxes %s" % ", ".join(sorted(missing)))
+
+    stsz = boxes["stsz"]
+    _, offset = _full_box_payload(buf, stsz)
+    sample_size, sample_count = struct.unpack_from(">II", buf, offset)
+    if sample_size == 0:
+        sizes = _table(buf, stsz, 8, ">u4").astype(np.int64)
+    else:
+        sizes = np.full(sample_count, sample_size, dtype=np.int64)
+
+    if "co64" in boxes:
+        chunk_offsets = _table(buf, boxes["co64"], 4, ">u8").astype(np.int64)
+    else:
+        chunk_offsets = _table(buf, boxes["stco"], 4, ">u4").astype(np.int64)
+    n_chunks = len(chunk_offsets)
+
+    # stsc is run-length encoded: (first_chunk, samples_per_chunk, description_index)
+    stsc = _table(buf, boxes["stsc"], 4, ">u4", columns=3).astype(np.int64)
+    first_chunks = stsc[:, 0] - 1
+    if sample_count and (len(stsc) == 0 or first_chunks[0] != 0 or (np.diff(first_chunks) <= 0).any() or first_chunks[-1] >= n_chunks):
+        raise RuntimeError("Invalid 'stsc' box")
+    runs = np.diff(np.append(first_chunks, n_chunks))
+    samples_per_chunk = np.repeat(stsc[:, 1], runs)
+
+    chunk_of_sample = np.repeat(np.arange(n_chunks), samples_per_chunk)[:sample_count]
+    if len(chunk_of_sample) < sample_count:
+        raise RuntimeError("'stsc' box covers %i of %i samples" % (len(chunk_of_sample), sample_count))
+    first_sample_of_chunk = np.cumsum(samples_per_chunk) - samples_per_chunk
+    position = np.cumsum(sizes) - sizes
+    offsets = chunk_offsets[chunk_of_sample] + position - position[first_sample_of_chunk[chunk_of_sample]]
+
+    # stts is run-length encoded: (sample_count, sample_delta)
+    stts = _table(buf, boxes["stts"], 4, ">u4", columns=2).astype(np.int64)
+    durations = np.repeat(stts[:, 1], stts[:, 0])[:sample_count]
+    if len(durations) < sample_count:
+        raise RuntimeError("'stts' box covers %i of %i samples" % (len(durations), sample_count))
+    times = np.cumsum(durations) - durations
+
+    return offsets, sizes, times, durations
+
+
+def read_tracks(video_path, moov=None):
+    """ List the tracks of an MP4 file with their sample tables
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    moov: bytes, optional
+        The payload of the `moov` box, if already read.
+    Returns
+    -------
+    tracks: list of MP4Track
+        One `MP4Track` per `trak` box. Sample times and durations are in units of
+        the track `timescale`.
+    """
+    if moov is None:
+        moov = read_moov(video_path)
+    buf = memoryview(moov)
+
+    tracks = []
+    for trak in iter_boxes(buf):
+        if trak.type != "trak":
+            continue
+        start, end = trak.offset + trak.header_size, trak.offset + trak.size
+        tkhd = find_box(buf, ["tkhd"], start, end)
+        mdhd = find_box(buf, ["mdia", "mdhd"], start, end)
+        hdlr = find_box(buf, ["mdia", "hdlr"], start, end)
+        stbl = find_box(buf, ["mdia", "minf", "stbl"], start, end)
+        if mdhd is None or stbl is None:
+            continue
+        stsd = find_box(buf, ["stsd"], stbl.offset + stbl.header_size, stbl.offset + stbl.size)
+
+        timescale, duration = _parse_mdhd(buf, mdhd)
+        try:
+            offsets, sizes, times, durations = _parse_sample_table(buf, stbl)
+        except (ValueError, IndexError) as e:
+            # any other inconsistency of the tables, reported like the checked ones
+            raise RuntimeError("Invalid sample table in %s: %s" % (video_path, e)) from e
+        tracks.append(MP4Track(
+            track_id=_parse_tkhd(buf, tkhd) if tkhd is not None else None,
+            handler=_parse_hdlr(buf, hdlr) if hdlr is not None else None,
+            codec_tag=_parse_stsd(buf, stsd) if stsd is not None else None,
+            timescale=timescale,
+            duration=duration,
+            sample_offsets=offsets,
+            sample_sizes=sizes,
+            sample_times=times,
+            sample_durations=durations
+        ))
+
+    return tracks
+
+
+def _read_box(f, box):
+    """ Read a whole box, returned with the box relocated at offset 0 of the bytes """
+    f.seek(box.offset)
+    return f.read(box.size), box._replace(offset=0)
+
+
+def _file_children(f, box):
+
+    return {child.type: child for child in iter_file_boxes(f, box.offset + box.header_size, box.offset + box.size)}
+
+
+def read_track_info(video_path, sized_codecs=("gpmd", "text")):
+    """ Summarize the tracks of an MP4 file from the headers of its `moov` box
+    The boxes are walked with seeks and only the small header boxes of each
+    track are read: the sample tables are skipped, so the cost does not depend
+    on the length of the video.
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    sized_codecs: list of str, optional
+        The codec tags of the tracks whose sample size table is read to sum
+        their data size, e.g. the telemetry tracks.
+    Returns
+    -------
+    tracks: list of MP4TrackInfo
+        One per `trak` box. `duration` is in units of `timescale`, `data_size`
+        in bytes and None when not computed.
+    Raises
+    ------
+    RuntimeError: If no `moov` box found, or if the sample size or chunk
+        offset table of a track is smaller than its entry count.
+    """
+    tracks = []
+    with open(video_path, "rb") as f:
+        moov = next((box for box in iter_file_boxes(f, 0, os.path.getsize(video_path)) if box.type == "moov"), None)
+        if moov is None:
+            raise RuntimeError("Could not find moov box in %s" % video_path)
+
+        for trak in iter_file_boxes(f, moov.offset + moov.header_size, moov.offset + moov.size):
+            if trak.type != "trak":
+                continue
+            trak_boxes = _file_children(f, trak)
+            mdia_boxes = _file_children(f, trak_boxes["mdia"]) if "mdia" in trak_boxes else {}
+            minf_boxes = _file_children(f, mdia_boxes["minf"]) if "minf" in mdia_boxes else {}
+            stbl_boxes = _file_children(f, minf_boxes["stbl"]) if "stbl" in minf_boxes else {}
+            if "mdhd" not in mdia_boxes or "stsz" not in stbl_boxes:
+                continue
+
+            timescale, duration = _parse_mdhd(*_read_box(f, mdia_boxes["mdhd"]))
+            codec_tag = _parse_stsd(*_read_box(f, stbl_boxes["stsd"])) if "stsd" in stbl_boxes else None
+
+            stsz = stbl_boxes["stsz"]
+            f.seek(stsz.offset + stsz.header_size + 4)
+            sample_size, sample_count = struct.unpack(">II", f.read(8))
+            if sample_size == 0 and stsz.header_size + 12 + 4 * sample_count > stsz.size:
+                raise RuntimeError("'stsz' box of %i bytes too small for %i entries" % (stsz.size, sample_count))
+            for chunk_box, entry_size in (("stco", 4), ("co64", 8)):
+                if chunk_box in stbl_boxes:
+                    box = stbl_boxes[chunk_box]
+                    f.seek(box.offset + box.header_size + 4)
+                    chunk_count, = _u32.unpack(f.read(4))
+                    if box.header_size + 8 + entry_size * chunk_count > box.size:
+                        raise RuntimeError("'%s' box of %i bytes too small for %i entries" % (chunk_box, box.size, chunk_count))
+            data_size = None
+            if sample_size != 0:
+                data_size = sample_size * sample_count
+            elif codec_tag in sized_codecs:
+                f.seek(stsz.offset + stsz.header_size + 12)
+                data_size = int(np.frombuffer(f.read(4 * sample_count), dtype=">u4").sum(dtype=np.int64))
+
+            tracks.append(MP4TrackInfo(
+                track_id=_parse_tkhd(*_read_box(f, trak_boxes["tkhd"])) if "tkhd" in trak_boxes else None,
+                handler=_parse_hdlr(*_read_box(f, mdia_boxes["hdlr"])) if "hdlr" in mdia_boxes else None,
+                codec_tag=codec_tag,
+                timescale=timescale,
+                duration=duration,
+                sample_count=sample_count,
+                data_size=data_size,
+            ))
+
+    return tracks
+
+
+def find_track(video_path, codec_tag, tracks=None):
+    """ Find the first track with a given codec tag
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    codec_tag: str
+        The sample entry fourcc, e.g. "gpmd" or "text".
+    Returns
+    -------
+    track: MP4Track
+    Raises
+    ------
+    RuntimeError: If no track found.
+    """
+    if tracks is None:
+        tracks = read_tracks(video_path)
+    for track in tracks:
+        if track.codec_tag == codec_tag:
+            return track
+
+    raise RuntimeError("codec_tag %s not found in %s" % (codec_tag, video_path))
+
+
+def read_samples(video_path, track, first=0, last=None):
+    """ Read the raw samples of a track straight from the file
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    track: MP4Track
+        The track to read.
+    first: int, optional (default=0)
+        Index of the first sample to read.
+    last: int, optional
+        Index one past the last sample to read. Defaults to all samples.
+    Returns
+    -------
+    data: bytes
+        The samples concatenated in decode order, as `ffmpeg -codec copy` would output them.
+    """
+    offsets = track.sample_offsets[first:last]
+    sizes = track.sample_sizes[first:last]
+
+    data = bytearray(int(sizes.sum()))
+    view = memoryview(data)
+    position = 0
+    with open(video_path, "rb") as f:
+        for offset, size in zip(offsets.tolist(), sizes.tolist()):
+            f.seek(offset)
+            if f.readinto(view[position: position + size]) != size:
+                raise RuntimeError("Truncated sample at offset %i in %s" % (offset, video_path))
+            position += size
+
+    return bytes(data)
+
+
+def extract_bin_stream(video_path, codec_tag):
+    """ Extract a data track from an MP4 file without spawning ffmpeg
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    codec_tag: str
+        The sample entry fourcc, e.g. "gpmd" or "text".
+    Returns
+    -------
+    data: bytes
+        The raw track data
+    """
+    return read_samples(video_path, find_track(video_path, codec_tag))
+
+
+def iter_samples(video_path, track, first=0, last=None):
+    """ Iterate on the raw samples of a track, reading one sample at a time
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    track: MP4Track
+        The track to read.
+    first: int, optional (default=0)
+        Index of the first sample to read.
+    last: int, optional
+        Index one past the last sample to read. Defaults to all samples.
+    Returns
+    -------
+    sample_gen: generator
+        A generator of bytes, one per sample, in decode order.
+    """
+    offsets = track.sample_offsets[first:last]
+    sizes = track.sample_sizes[first:last]
+
+    with open(video_path, "rb") as f:
+        for offset, size in zip(offsets.tolist(), sizes.tolist()):
+            f.seek(offset)
+            sample = f.read(size)
+            if len(sample) != size:
+                raise RuntimeError("Truncated sample at offset %i in %s" % (offset, video_path))
+            yield sample
@@ -1,124 +1,339 @@
-import numpy as np
-
-
-class NPGPS:
-
-    def __init__(self, timestamp_indexes, timestamp_timestamps, items, timestamp_steps):
-
-        msecs, lat, long, elev = [], [], [], []
-
-        def get_next_block_item_index(block_index, timestamp_indexes):
-
-            if block_index + 1 >= len(timestamp_indexes):
-                return 1000000000
-
-            return timestamp_indexes[block_index + 1]
-
-        block_index = 0
-        next_block_item_index = get_next_block_item_index(block_index, timestamp_indexes)
-        msec = 0
-        time_step = timestamp_steps[block_index]
-        for i, item in enumerate(items):
-
-            if i == next_block_item_index:
-                block_index += 1
-                next_block_item_index = get_next_block_item_index(block_index, timestamp_indexes)
-                time_step = timestamp_steps[block_index]
-
-            msecs.append(msec)
-            lat.append(item.latitude)
-            long.append(item.longitude)
-            elev.append(item.altitude)
-            msec += time_step
-
-        self.np_msecs = np.array(msecs)
-        self.np_lat = np.array(lat)
-        self.np_long = np.array(long)
-        self.np_elev = np.array(elev)
-
-    def log(self):
-
-        for msec, lat, long, elev in zip(self.np_msecs, self.np_lat, self.np_long, self.np_elev):
-            print(msec, lat, long, elev)
-
-
-class NPGYRO:
-
-    def __init__(self, timestamp_indexes, timestamp_timestamps, items, timestamp_steps):
-
-        msecs, gy_z, gy_x, gy_y = [], [], [], []
-
-        def get_next_block_item_index(block_index, timestamp_indexes):
+import sys
 
-            if block_index + 1 >= len(timestamp_indexes):
-                return 1000000000
-
-            return timestamp_indexes[block_index + 1]
-
-        block_index = 0
-        next_block_item_index = get_next_block_item_index(block_index, timestamp_indexes)
-        msec = 0
-        time_step = timestamp_steps[block_index]
-        for i, item in enumerate(items):
-
-            if i == next_block_item_index:
-                block_index += 1
-                next_block_item_index = get_next_block_item_index(block_index, timestamp_indexes)
-                time_step = timestamp_steps[block_index]
-
-            msecs.append(msec)
-            gy_z.append(item.gy_z)
-            gy_x.append(item.gy_x)
-            gy_y.append(item.gy_y)
-            msec += time_step
-
-        self.np_msecs = np.array(msecs)
-        self.np_z = np.array(gy_z)
-        self.np_x = np.array(gy_x)
-        self.np_y = np.array(gy_y)
-
-    def log(self):
-
-        for msec, z, x, y in zip(self.np_msecs, self.np_z, self.np_x, self.np_y):
-            print(msec, z, x, y)
-
-
-class NPACCL:
-
-    def __init__(self, timestamp_indexes, timestamp_timestamps, items, timestamp_steps):
-
-        msecs, acc_z, acc_x, acc_y = [], [], [], []
-
-        def get_next_block_item_index(block_index, timestamp_indexes):
-
-            if block_index + 1 >= len(timestamp_indexes):
-                return 1000000000
-
-            return timestamp_indexes[block_index + 1]
-
-        block_index = 0
-        next_block_item_index = get_next_block_item_index(block_index, timestamp_indexes)
-        msec = 0
-        time_step = timestamp_steps[block_index]
-        for i, item in enumerate(items):
-
-            if i == next_block_item_index:
-                block_index += 1
-                next_block_item_index = get_next_block_item_index(block_index, timestamp_indexes)
-                time_step = timestamp_steps[block_index]
-
-            msecs.append(msec)
-            acc_z.append(item.acc_z)
-            acc_x.append(item.acc_x)
-            acc_y.append(item.acc_y)
-            msec += time_step
+import numpy as np
 
-        self.np_msecs = np.array(msecs)
-        self.np_z = np.array(acc_z)
-        self.np_x = np.array(acc_x)
-        self.np_y = np.array(acc_y)
+import export
+import telem_file
+import time_utils
+
+
+def pad_block_steps(timestamp_steps, nblocks):
+    """ Return one time step per block, the last step repeated for the blocks without one
+    A stream without any step, e.g. a single block with no later timestamp, gets
+    a zero step: all its points are at the time of the block start.
+    """
+    block_steps = np.asarray(timestamp_steps, dtype=np.float64)[:nblocks]
+    if len(block_steps) < nblocks:
+        last_step = block_steps[-1] if len(block_steps) else 0.
+        block_steps = np.append(block_steps, np.repeat(last_step, nblocks - len(block_steps)))
+    return block_steps
+
+
+def get_block_msecs(timestamp_indexes, timestamp_steps, npoints):
+    """ Compute the time of every point from per-block time steps
+    Parameters
+    ----------
+    timestamp_indexes: list of int
+        The index of the first point of each block.
+    timestamp_steps: list of float
+        The time step in milliseconds between two points of each block. When there are fewer
+        steps than blocks, the last step is used for the remaining blocks, a zero
+        step when there is none.
+    npoints: int
+        The total number of points.
+    Returns
+    -------
+    msecs: numpy.ndarray
+        The time of each point, starting at 0.
+    """
+    block_sizes = np.diff(np.append(np.asarray(timestamp_indexes, dtype=np.int64), npoints))
+    block_steps = pad_block_steps(timestamp_steps, len(block_sizes))
+
+    steps = np.repeat(block_steps, block_sizes)
+    msecs = np.zeros(npoints)
+    np.cumsum(steps[:-1], out=msecs[1:])
+    return msecs
+
+
+def get_start_timestamp(timestamp_timestamps, block_msecs=None):
+    """ Return the UTC epoch nanoseconds of the first timed block, None when unknown
+    Given the time in msecs of the first point of every block, the timestamp is
+    moved back to msecs 0, so that it also anchors the blocks recorded before
+    the first timed one, e.g. before the GPS lock.
+    """
+    timestamp_timestamps = np.asarray(timestamp_timestamps, dtype=np.int64)
+    timed = np.flatnonzero(timestamp_timestamps != time_utils.NO_TIMESTAMP)
+    if block_msecs is not None:
+        timed = timed[timed < len(block_msecs)]
+    if not len(timed):
+        return None
+    if block_msecs is None:
+        return int(timestamp_timestamps[timed[0]])
+    return int(timestamp_timestamps[timed[0]] - round(block_msecs[timed[0]] * time_utils.NS_PER_MSEC))
+
+
+def get_block_timing(timestamp_indexes, timestamp_steps, npoints):
+    """ Compute the time of the first point of every block from per-block time steps
+    Parameters
+    ----------
+    timestamp_indexes, timestamp_steps, npoints:
+        As for `get_block_msecs`.
+    Returns
+    -------
+    block_msecs: numpy.ndarray
+        The time of the first point of each block, starting at 0.
+    block_steps: numpy.ndarray
+        The time step of each block, padded with the last step.
+    """
+    timestamp_indexes = np.asarray(timestamp_indexes, dtype=np.int64)
+    block_sizes = np.diff(np.append(timestamp_indexes, npoints))
+    block_steps = pad_block_steps(timestamp_steps, len(block_sizes))
+
+    block_msecs = np.zeros(len(block_sizes))
+    np.cumsum((block_sizes * block_steps)[:-1], out=block_msecs[1:])
+    return block_msecs, block_steps
+
+
+class NPTelem:
+    """ Saving, printing and memory-mapped loading of the `np_*` arrays of a telemetry stream """
+
+    def save(self, path):
+        """ Save the arrays and start timestamp in the memory-mappable telemetry format """
+        columns = {name: value for name, value in vars(self).items() if name.startswith("np_")}
+        telem_file.write_columns(path, type(self).__name__, columns, {"start_timestamp": self.start_timestamp})
+
+    def __len__(self):
+
+        return len(self.np_msecs)
+
+    def column(self, name, start=0, end=None):
+        """ The values of an `np_*` column for samples [start, end) """
+        return getattr(self, name)[start:end]
 
     def log(self):
-
-        for msec, z, x, y in zip(self.np_msecs, self.np_z, self.np_x, self.np_y):
-            print(msec, z, x, y)
\ No newline at end of file
+        """ Print every sample as CSV """
+        export.write_csv(self, sys.stdout)
+
+    @classmethod
+    def open(cls, path, mode="r"):
+        """ Load a stream saved by `save`, its arrays are views on a `numpy.memmap` of the file
+        Parameters
+        ----------
+        path: str
+            The telemetry file.
+        mode: str, optional (default="r")
+            "r" for read-only arrays, "c" for copy-on-write.
+        Returns
+        -------
+        telem: instance of the class
+        Raises
+        ------
+        RuntimeError: If the file holds another kind of stream.
+        """
+        kind, attrs, columns = telem_file.open_columns(path, mode)
+        if kind != cls.__name__:
+            raise RuntimeError(f"{path} holds {kind}, not {cls.__name__}")
+        return cls.from_columns(columns, attrs.get("start_timestamp"))
+
+    @classmethod
+    def from_columns(cls, columns, start_timestamp=None):
+        """ Build the stream from already decoded `np_*` arrays """
+        telem = cls.__new__(cls)
+        telem.start_timestamp = start_timestamp
+        for name, value in columns.items():
+            setattr(telem, name, value)
+        return telem
+
+
+class NPGPS(NPTelem):
+
+    columns = ("np_lat", "np_long", "np_elev")
+
+    def __init__(self, timestamp_indexes, timestamp_timestamps, items, timestamp_steps, msecs=None, start_timestamp=None):
+
+        self.np_block_starts = np.asarray(timestamp_indexes, dtype=np.int64)
+        if msecs is None:
+            self.np_msecs = get_block_msecs(timestamp_indexes, timestamp_steps, len(items.latitude))
+            block_msecs, _ = get_block_timing(timestamp_indexes, timestamp_steps, len(items.latitude))
+            self.start_timestamp = get_start_timestamp(timestamp_timestamps, block_msecs)
+        else:
+            self.start_timestamp = start_timestamp
+            self.np_msecs = np.asarray(msecs)
+        self.np_lat = np.asarray(items.latitude)
+        self.np_long = np.asarray(items.longitude)
+        self.np_elev = np.asarray(items.altitude)
+
+
+class NPGYRO(NPTelem):
+
+    columns = ("np_z", "np_x", "np_y")
+
+    def __init__(self, timestamp_indexes, timestamp_timestamps, items, timestamp_steps, msecs=None, start_timestamp=None):
+
+        self.np_block_starts = np.asarray(timestamp_indexes, dtype=np.int64)
+        if msecs is None:
+            self.np_msecs = get_block_msecs(timestamp_indexes, timestamp_steps, len(items.gy_z))
+            block_msecs, _ = get_block_timing(timestamp_indexes, timestamp_steps, len(items.gy_z))
+            self.start_timestamp = get_start_timestamp(timestamp_timestamps, block_msecs)
+        else:
+            self.start_timestamp = start_timestamp
+            self.np_msecs = np.asarray(msecs)
+        self.np_z = np.asarray(items.gy_z)
+        self.np_x = np.asarray(items.gy_x)
+        self.np_y = np.asarray(items.gy_y)
+
+
+class NPACCL(NPTelem):
+
+    columns = ("np_z", "np_x", "np_y")
+
+    def __init__(self, timestamp_indexes, timestamp_timestamps, items, timestamp_steps, msecs=None, start_timestamp=None):
+
+        self.np_block_starts = np.asarray(timestamp_indexes, dtype=np.int64)
+        if msecs is None:
+            self.np_msecs = get_block_msecs(timestamp_indexes, timestamp_steps, len(items.acc_z))
+            block_msecs, _ = get_block_timing(timestamp_indexes, timestamp_steps, len(items.acc_z))
+            self.start_timestamp = get_start_timestamp(timestamp_timestamps, block_msecs)
+        else:
+            self.start_timestamp = start_timestamp
+            self.np_msecs = np.asarray(msecs)
+        self.np_z = np.asarray(items.acc_z)
+        self.np_x = np.asarray(items.acc_x)
+        self.np_y = np.asarray(items.acc_y)
+
+
+class NPIMU(NPTelem):
+    """ Compact accelerometer or gyroscope samples
+    The raw samples are kept as one (N, 3) integer array in native byte order,
+    with the SCAL, the time of the first sample and the time step of each block:
+    6 bytes per int16 sample instead of 32 for float64 axes and times. The scaled
+    axes and the times are computed on each access, see `scaled`, `sample_msecs`
+    and `expand`.
+    """
+
+    columns = ("np_z", "np_x", "np_y")
+    # the float64 class of the same stream, see `expand`
+    expanded_type = None
+
+    def __init__(self, raw, block_starts, block_scales, block_msecs, block_steps, start_timestamp=None):
+
+        self.start_timestamp = start_timestamp
+        self.np_raw = np.asarray(raw)
+        self.np_block_starts = np.asarray(block_starts, dtype=np.int64)
+        self.np_block_scales = np.asarray(block_scales, dtype=np.float64)
+        self.np_block_msecs = np.asarray(block_msecs, dtype=np.float64)
+        self.np_block_steps = np.asarray(block_steps, dtype=np.float64)
+
+    def _blocks(self, start, end):
+        """ The first and last + 1 block overlapping samples [start, end), and their number of samples in it """
+        first = max(int(np.searchsorted(self.np_block_starts, start, side="right")) - 1, 0)
+        last = int(np.searchsorted(self.np_block_starts, end, side="left"))
+        bounds = np.clip(np.append(self.np_block_starts[first:last], end), start, end)
+        return first, last, np.diff(bounds)
+
+    def scaled(self, start=0, end=None, axis=None, dtype=np.float32):
+        """ Apply SCAL to the raw samples
+        Parameters
+        ----------
+        start, end: int, optional
+            The range of samples, all of them by default.
+        axis: int, optional
+            Only scale this column of `np_raw`: 0 for z, 1 for x, 2 for y.
+        dtype: numpy.dtype, optional (default=numpy.float32)
+            The output type.
+        Returns
+        -------
+        values: numpy.ndarray
+            (n, 3) array, or (n,) for a single axis.
+        """
+        end = len(self.np_raw) if end is None else end
+        first, last, sizes = self._blocks(start, end)
+        raw = self.np_raw[start:end] if axis is None else self.np_raw[start:end, axis]
+        scales = self.np_block_scales[first:last] if axis is None else self.np_block_scales[first:last, axis]
+        if len(scales) == 0:
+            return raw.astype(dtype)
+        if (scales == scales[0]).all():
+            return np.divide(raw, scales[0].astype(dtype), dtype=dtype)
+        return np.divide(raw, np.repeat(scales.astype(dtype), sizes, axis=0), dtype=dtype)
+
+    def sample_msecs(self, start=0, end=None):
+        """ The time of samples [start, end) in milliseconds """
+        end = len(self.np_raw) if end is None else end
+        first, last, sizes = self._blocks(start, end)
+        offsets = np.arange(start, end) - np.repeat(self.np_block_starts[first:last], sizes)
+        return np.repeat(self.np_block_msecs[first:last], sizes) + offsets * np.repeat(self.np_block_steps[first:last], sizes)
+
+    def __len__(self):
+
+        return len(self.np_raw)
+
+    def column(self, name, start=0, end=None):
+        """ The values of a column for samples [start, end), only those are timed or scaled """
+        if name == "np_msecs":
+            return self.sample_msecs(start, end)
+        if name in self.columns:
+            return self.scaled(start, end, self.columns.index(name))
+        return getattr(self, name)[start:end]
+
+    @property
+    def np_msecs(self):
+        return self.sample_msecs()
+
+    @property
+    def np_z(self):
+        return self.scaled(axis=0)
+
+    @property
+    def np_x(self):
+        return self.scaled(axis=1)
+
+    @property
+    def np_y(self):
+        return self.scaled(axis=2)
+
+    def expand(self, dtype=np.float64):
+        """ Convert to the `expanded_type` stream, with one array per axis """
+        values = self.scaled(dtype=dtype)
+        return self.expanded_type.from_columns({
+            "np_block_starts": self.np_block_starts,
+            "np_msecs": self.sample_msecs(),
+            "np_z": values[:, 0],
+            "np_x": values[:, 1],
+            "np_y": values[:, 2],
+        }, self.start_timestamp)
+
+
+class NPGYROCompact(NPIMU):
+
+    expanded_type = NPGYRO
+
+
+class NPACCLCompact(NPIMU):
+
+    expanded_type = NPACCL
+
+
+class NPGPRMC(NPTelem):
+
+    columns = ("np_lat", "np_long", "np_speed", "np_bearing")
+
+    def __init__(self, timestamps, lat, long, speed, bearing, valid):
+
+        self.np_timestamps = np.asarray(timestamps, dtype=np.int64)
+        # measured from the first valid sentence, nan for the invalid ones
+        self.start_timestamp = get_start_timestamp(self.np_timestamps)
+        timed = self.np_timestamps != time_utils.NO_TIMESTAMP
+        self.np_msecs = np.full(len(self.np_timestamps), np.nan)
+        if self.start_timestamp is not None:
+            self.np_msecs[timed] = (self.np_timestamps[timed] - self.start_timestamp) / time_utils.NS_PER_MSEC
+        self.np_lat = np.asarray(lat)
+        self.np_long = np.asarray(long)
+        self.np_speed = np.asarray(speed)
+        self.np_bearing = np.asarray(bearing)
+        self.np_valid = np.asarray(valid, dtype=bool)
+
+
+class NPGPGGA(NPTelem):
+
+    columns = ("np_lat", "np_long", "np_altitude", "np_hdop", "np_satellites", "np_fix")
+
+    def __init__(self, msecs, lat, long, altitude, hdop, satellites, fix, start_timestamp=None):
+
+        self.start_timestamp = start_timestamp
+        self.np_msecs = np.asarray(msecs)
+        self.np_lat = np.asarray(lat)
+        self.np_long = np.asarray(long)
+        self.np_altitude = np.asarray(altitude)
+        self.np_hdop = np.asarray(hdop)
+        self.np_satellites = np.asarray(satellites)
+        self.np_fix = np.asarray(fix)
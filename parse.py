@@ -10,6 +10,9 @@ logger = logging.getLogger(__name__)
 KLVItem = namedtuple("KLVItem", ["key", "length", "value"])
 KLVLength = namedtuple("KLVLength", ["type", "size", "repeat"])
 
+# fourcc, type, size, repeat
+klv_header = struct.Struct(">4scBH")
+
 
 def ceil4(x):
     """ Find the closest greater or equal multiple of 4
@@ -43,8 +46,8 @@ def parse_payload(x, fourcc, type_str, size, repeat):
     """ Parse the payload
     Parameters
     ----------
-    x: byte
-        The byte array corresponding to the payload
+    x: memoryview
+        A view on the bytes corresponding to the payload
     fourcc: str
         The fourcc code
     type_str: str
@@ -67,7 +70,7 @@ def parse_payload(x, fourcc, type_str, size, repeat):
                 x = list(numpy.frombuffer(x, dtype="S%i" % size))
                 return [s.decode("latin1") for s in x]
             else:
-                return x.decode("latin1")
+                return bytes(x).decode("latin1")
 
         elif type_str in num_types:
             dtype, stype = num_types[type_str]
@@ -82,39 +85,45 @@ def parse_payload(x, fourcc, type_str, size, repeat):
                 a = a.reshape(repeat, dim1)
             return a
         elif type_str == "U":
-            x = x.decode()
-            year = "20" + x[:2]
-            month = x[2:4]
-            day = x[4:6]
-            hours = x[6:8]
-            mins = x[8:10]
-            seconds = x[10:]
-            return "%s-%s-%s %s:%s:%s" % (year, month, day, hours, mins, seconds)
+            # kept raw, see time_utils.gpsu_to_epoch_ns
+            return bytes(x)
         else:
-            return x
+            return bytes(x)
 
 
-def iter_klv(x):
+def iter_klv(x, start=0, end=None):
     """ Iterate on KLV items.
+    The stream is never copied: headers are read in place with
+    `klv_header.unpack_from` and payloads are views on the same buffer, so
+    nested containers cost no copies whatever their depth.
     Parameters
     ----------
-    x: byte
+    x: bytes or memoryview
         The byte array corresponding to the stream.
+    start: int, optional (default=0)
+        Offset of the first item.
+    end: int, optional
+        Offset of the end of the last item. Defaults to the end of `x`.
     Returns
     -------
     klv_gen: generator
         A generator of (fourcc, (type_str, size, repeat), payload) tuples.
     """
-    start = 0
+    if not isinstance(x, memoryview):
+        x = memoryview(x)
+    if end is None:
+        end = len(x)
 
-    while start < len(x):
-        head = struct.unpack(">cccccBH", x[start: start + 8])
-        fourcc = (b"".join(head[:4])).decode()
-        type_str, size, repeat = head[4:]
-        type_str = type_str.decode()
+    while start < end:
+        fourcc, type_str, size, repeat = klv_header.unpack_from(x, start)
+        fourcc = fourcc.decode("latin1")
+        type_str = type_str.decode("latin1")
         start += 8
         payload_size = ceil4(size * repeat)
-        payload = parse_payload(x[start: start + payload_size], fourcc, type_str, size, repeat)
+        if type_str == "\x00":
+            payload = iter_klv(x, start, start + payload_size)
+        else:
+            payload = parse_payload(x[start: start + payload_size], fourcc, type_str, size, repeat)
         start += payload_size
 
         yield KLVItem(fourcc, KLVLength(type_str, size, repeat), payload)
@@ -168,3 +177,191 @@ def expand_klv(x):
     -------
     """
     return _expand_klv(iter_klv(x))
+
+
+klv_index_dtype = numpy.dtype([
+    ("fourcc", "S4"),
+    ("type", "S1"),
+    ("size", "u1"),
+    ("repeat", "u2"),
+    ("offset", "i8"),
+    ("depth", "i2"),
+    ("parent", "i4"),
+])
+
+
+def index_klv(x):
+    """Index the headers of every KLV item in a single pass
+    Payloads are not decoded, only the headers are read to build a flat table of
+    the KLV tree. Items are stored in stream order, so children always come after
+    their parent.
+    Parameters
+    ----------
+    x: bytes or memoryview
+        The input stream
+    Returns
+    -------
+    index: numpy.ndarray
+        Structured array of `klv_index_dtype` with one row per item: fourcc, type,
+        size, repeat, payload offset in `x`, nesting depth and row of the parent
+        container (-1 for top level items).
+    """
+    if not isinstance(x, memoryview):
+        x = memoryview(x)
+
+    unpack = klv_header.unpack_from
+    rows = []
+    stack = []
+    start, end, depth, parent = 0, len(x), 0, -1
+
+    while True:
+        while start >= end and stack:
+            end, parent = stack.pop()
+            depth -= 1
+        if start >= end:
+            break
+        fourcc, type_str, size, repeat = unpack(x, start)
+        start += 8
+        rows.append((fourcc, type_str, size, repeat, start, depth, parent))
+        payload_size = ceil4(size * repeat)
+        if type_str == b"\x00":
+            stack.append((end, parent))
+            end, depth, parent = start + payload_size, depth + 1, len(rows) - 1
+        else:
+            start += payload_size
+
+    return numpy.array(rows, dtype=klv_index_dtype)
+
+
+def split_klv(x, nparts):
+    """Split a stream into ranges of whole top level items, e.g. `DEVC`
+    Only the headers of the top level items are read.
+    Parameters
+    ----------
+    x: bytes or memoryview
+        The input stream
+    nparts: int
+        The number of ranges wanted, each covering about the same number of bytes.
+    Returns
+    -------
+    bounds: list of (int, int)
+        The (start, end) offsets of at most `nparts` non empty ranges, in stream order.
+    """
+    unpack = klv_header.unpack_from
+    starts = []
+    start, end = 0, len(x)
+    while start + 8 <= end:
+        starts.append(start)
+        _, _, size, repeat = unpack(x, start)
+        start += 8 + ceil4(size * repeat)
+
+    # cut at the first item starting past each multiple of len(x) / nparts
+    cuts = numpy.searchsorted(starts, numpy.arange(1, nparts) * (end / nparts))
+    cuts = numpy.unique(numpy.append(numpy.array(starts, dtype=numpy.int64)[cuts[cuts < len(starts)]], [0, end]))
+    return [(int(a), int(b)) for a, b in zip(cuts[:-1], cuts[1:]) if b > a]
+
+
+def select_klv(index, fourcc, parent_fourcc=None):
+    """Select the rows of a KLV index with a given fourcc
+    Parameters
+    ----------
+    index: numpy.ndarray
+        The index built by `index_klv`
+    fourcc: str or list of str
+        The FourCC code(s) to select
+    parent_fourcc: str, optional
+        If given, only keep items whose parent container has this FourCC code.
+    Returns
+    -------
+    mask: numpy.ndarray
+        Boolean mask over the rows of `index`
+    """
+    if isinstance(fourcc, str):
+        fourcc = [fourcc]
+    mask = numpy.isin(index["fourcc"], [f.encode("latin1") for f in fourcc])
+    if parent_fourcc is not None:
+        parents = index["parent"]
+        has_parent = parents >= 0
+        mask &= has_parent
+        mask[has_parent] &= index["fourcc"][parents[has_parent]] == parent_fourcc.encode("latin1")
+    return mask
+
+
+def gather_payloads(x, index, rows, dtype=None):
+    """Decode the numeric payloads of several KLV items at once
+    The payload bytes of all the selected items are gathered with one fancy
+    index and decoded with a single `numpy.frombuffer`.
+    Parameters
+    ----------
+    x: bytes or memoryview
+        The input stream
+    index: numpy.ndarray
+        The index built by `index_klv`
+    rows: numpy.ndarray
+        Boolean mask or integer rows of the items to decode. They must share the
+        same type and size.
+    dtype: numpy.dtype, optional
+        The big-endian dtype of one value, for the complex "?" items described by
+        a `TYPE` item. Defaults to the dtype of the item type.
+    Returns
+    -------
+    values: numpy.ndarray
+        The concatenated values in native byte order, of shape
+        (total repeat, size // itemsize) or (total repeat,) for scalar items.
+    counts: numpy.ndarray
+        The repeat of each selected item, i.e. its number of rows in `values`.
+    """
+    items = index[rows]
+    if len(items) == 0:
+        return numpy.empty(0), numpy.zeros(0, dtype=numpy.int64)
+    types = numpy.unique(items["type"])
+    sizes = numpy.unique(items["size"])
+    assert len(types) == 1 and len(sizes) == 1, "gather_payloads needs items of a single type and size"
+
+    if dtype is None:
+        dtype = numpy.dtype(">" + num_types[types[0].decode("latin1")][1])
+    size = int(sizes[0])
+    counts = items["repeat"].astype(numpy.int64)
+    lengths = counts * size
+
+    ends = numpy.cumsum(lengths)
+    positions = numpy.arange(ends[-1]) + numpy.repeat(items["offset"] - (ends - lengths), lengths)
+    raw = numpy.frombuffer(x, dtype=numpy.uint8)[positions]
+
+    values = raw.view(dtype).astype(dtype.newbyteorder("="))
+    dim1 = size // dtype.itemsize
+    if dim1 > 1:
+        values = values.reshape(-1, dim1)
+    return values, counts
+
+
+def iter_top_level(chunks):
+    """Reassemble complete top level KLV items from a stream read in chunks
+    Only the bytes of the item being reassembled are buffered, so memory use does
+    not depend on the length of the stream.
+    Parameters
+    ----------
+    chunks: iterable of bytes
+        The stream, split at arbitrary positions (pipe reads, MP4 samples...).
+    Returns
+    -------
+    item_gen: generator
+        A generator of bytes, each holding one complete top level item (e.g. a
+        `DEVC` container) including its header.
+    """
+    buf = bytearray()
+    pos = 0
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) - pos >= 8:
+            _, _, size, repeat = klv_header.unpack_from(buf, pos)
+            item_size = 8 + ceil4(size * repeat)
+            if len(buf) - pos < item_size:
+                break
+            yield bytes(buf[pos: pos + item_size])
+            pos += item_size
+        del buf[:pos]
+        pos = 0
+
+    if buf:
+        logger.warning("Dropping %i trailing bytes of an incomplete KLV item", len(buf))
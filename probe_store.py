@@ -0,0 +1,123 @@
+import asyncio
+import json
+import threading
+
+import ffmpeg
+
+import cache as cache_module
+import instrument
+
+
+async def probe_async(video_path, cmd="ffprobe"):
+    """ Run ffprobe without blocking the event loop, as `ffmpeg.probe` does
+    Returns
+    -------
+    probe: dict
+        The format and streams of the file.
+    Raises
+    ------
+    ffmpeg.Error: If ffprobe fails.
+    """
+    process = await asyncio.create_subprocess_exec(
+        cmd, "-show_format", "-show_streams", "-of", "json", video_path,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    out, err = await process.communicate()
+    if process.returncode != 0:
+        raise ffmpeg.Error(cmd, out, err)
+    return json.loads(out.decode("utf-8"))
+
+
+class ProbeStore:
+    """ ffprobe results kept in memory, keyed by file identity
+    The key is `cache.file_key`: the absolute path, size and mtime of the
+    file, so a modified file is probed again. A `TelemetryCache` persists the
+    results on disk across processes.
+    """
+
+    def __init__(self, cache=None, max_entries=4096):
+
+        self.cache = cache
+        self.max_entries = max_entries
+        self._probes = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, video_path, cache):
+        """ Return the key of a file and its stored probe, None when not stored """
+        key = cache_module.file_key(video_path)
+        with self._lock:
+            probe = self._probes.get(key)
+        if probe is None and cache is not None:
+            probe = cache.get_probe(video_path)
+            if probe is not None:
+                self._remember(key, probe)
+        return key, probe
+
+    def _remember(self, key, probe):
+
+        with self._lock:
+            if key not in self._probes and len(self._probes) >= self.max_entries:
+                self._probes.pop(next(iter(self._probes)))
+            self._probes[key] = probe
+
+    def _store(self, video_path, key, probe, cache):
+
+        self._remember(key, probe)
+        if cache is not None:
+            cache.put_probe(video_path, probe)
+
+    def get(self, video_path, cache=None):
+        """ Return the ffprobe result of a file, running ffprobe only once per file
+        Parameters
+        ----------
+        video_path: str
+            The input file
+        cache: TelemetryCache, optional
+            Where to read and persist the result, defaults to the cache of the store.
+        Returns
+        -------
+        probe: dict
+            The format and streams of the file, as returned by `ffmpeg.probe`.
+        Raises
+        ------
+        ffmpeg.Error: If ffprobe fails.
+        """
+        cache = cache if cache is not None else self.cache
+        key, probe = self._lookup(video_path, cache)
+        if probe is None:
+            with instrument.stage("probe"):
+                probe = ffmpeg.probe(video_path)
+            self._store(video_path, key, probe, cache)
+        return probe
+
+    async def get_async(self, video_path, cache=None):
+        """ Same as `get`, running ffprobe without blocking the event loop """
+        cache = cache if cache is not None else self.cache
+        key, probe = self._lookup(video_path, cache)
+        if probe is None:
+            with instrument.stage("probe"):
+                probe = await probe_async(video_path)
+            self._store(video_path, key, probe, cache)
+        return probe
+
+    def put(self, video_path, probe, cache=None):
+        """ Store a probe result obtained elsewhere """
+        self._store(video_path, cache_module.file_key(video_path), probe, cache if cache is not None else self.cache)
+
+    def clear(self):
+
+        with self._lock:
+            self._probes.clear()
+
+
+# shared by `JE_FFProbe`, `main.find_gpmf_stream` and the extractors built on them
+default_store = ProbeStore()
+
+
+def get_probe(video_path, cache=None):
+    """ Return the ffprobe result of a file from the shared store, see `ProbeStore.get` """
+    return default_store.get(video_path, cache)
+
+
+async def get_probe_async(video_path, cache=None):
+    """ Return the ffprobe result of a file from the shared store, see `ProbeStore.get_async` """
+    return await default_store.get_async(video_path, cache)
@@ -0,0 +1,286 @@
+from collections import namedtuple
+import json
+import math
+
+import numpy as np
+
+import cache
+import time_utils
+
+Track = namedtuple("Track", ["np_msecs", "np_lat", "np_long", "start_timestamp"])
+Match = namedtuple("Match", ["clip_id", "start_msecs", "end_msecs"])
+
+segment_dtype = np.dtype([
+    ("clip", "<i4"),
+    ("lat_min", "<f8"),
+    ("lat_max", "<f8"),
+    ("long_min", "<f8"),
+    ("long_max", "<f8"),
+    ("start_msecs", "<f8"),
+    ("end_msecs", "<f8"),
+])
+
+METERS_PER_DEGREE = 111320.
+
+
+def track_segments(msecs, lat, long, valid=None, points_per_segment=64):
+    """ Cut a track into segments of consecutive points and compute their bounds
+    Parameters
+    ----------
+    msecs, lat, long: numpy.ndarray
+        The time and position of every point.
+    valid: numpy.ndarray, optional
+        False for the points without a fix. Points at (0, 0) or nan are always dropped.
+    points_per_segment: int, optional (default=64)
+        The number of points of each segment.
+    Returns
+    -------
+    segments: numpy.ndarray
+        Array of `segment_dtype`, with `clip` set to 0.
+    """
+    msecs = np.asarray(msecs, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    long = np.asarray(long, dtype=np.float64)
+    keep = np.isfinite(lat) & np.isfinite(long) & ((lat != 0) | (long != 0))
+    if valid is not None:
+        keep &= np.asarray(valid, dtype=bool)
+    msecs, lat, long = msecs[keep], lat[keep], long[keep]
+
+    starts = np.arange(0, len(msecs), points_per_segment)
+    segments = np.zeros(len(starts), dtype=segment_dtype)
+    if not len(starts):
+        return segments
+    # each segment ends on the first point of the next one, so that it covers the path between them
+    ends = np.minimum(starts + points_per_segment, len(msecs) - 1)
+    segments["lat_min"] = np.minimum(np.minimum.reduceat(lat, starts), lat[ends])
+    segments["lat_max"] = np.maximum(np.maximum.reduceat(lat, starts), lat[ends])
+    segments["long_min"] = np.minimum(np.minimum.reduceat(long, starts), long[ends])
+    segments["long_max"] = np.maximum(np.maximum.reduceat(long, starts), long[ends])
+    segments["start_msecs"] = msecs[starts]
+    segments["end_msecs"] = msecs[ends]
+    return segments
+
+
+class SpatialIndex:
+    """ Grid index of the GPS tracks of many clips
+
+    Every track is cut into short segments whose bounding box and time range
+    are kept in one structured array. A segment is registered in every grid
+    cell its bounding box overlaps, and the (cell, segment) pairs are kept
+    sorted by cell so a query is a few binary searches, whatever the number
+    of clips. Segments spanning more than `max_segment_cells` cells, e.g. a
+    GPS glitch jumping across the map, are not registered in the grid but
+    checked by every query. Inserts are appended and merged into the sorted
+    grid on the next query.
+    """
+
+    max_segment_cells = 64
+
+    def __init__(self, cell_degrees=0.01, points_per_segment=64):
+
+        self.cell_degrees = cell_degrees
+        self.points_per_segment = points_per_segment
+        self.clip_ids = []
+        self.clip_numbers = {}
+        self.clip_starts = []
+        self.segments = np.zeros(0, dtype=segment_dtype)
+        self.pending = []
+        self._cells = None
+        self._cell_segments = None
+        self._large_segments = None
+
+    def _cell(self, degrees):
+
+        return np.floor(np.asarray(degrees) / self.cell_degrees).astype(np.int64)
+
+    def _cell_key(self, lat_cell, long_cell):
+
+        return (lat_cell << 32) + long_cell
+
+    def insert(self, clip_id, telem, valid=None):
+        """ Add or replace the track of a clip
+        Parameters
+        ----------
+        clip_id: str
+            The identifier of the clip, e.g. its path.
+        telem: NPGPS or NPGPRMC
+            Any object with `np_msecs`, `np_lat`, `np_long` and `start_timestamp`.
+            `np_valid` is used when present.
+        valid: numpy.ndarray, optional
+            Overrides `np_valid`.
+        """
+        if clip_id in self.clip_numbers:
+            self.remove(clip_id)
+        if valid is None:
+            valid = getattr(telem, "np_valid", None)
+
+        clip = len(self.clip_ids)
+        self.clip_ids.append(clip_id)
+        self.clip_numbers[clip_id] = clip
+        start_timestamp = getattr(telem, "start_timestamp", None)
+        self.clip_starts.append(time_utils.NO_TIMESTAMP if start_timestamp is None else start_timestamp)
+
+        segments = track_segments(telem.np_msecs, telem.np_lat, telem.np_long, valid, self.points_per_segment)
+        segments["clip"] = clip
+        self.pending.append(segments)
+
+    def insert_columns(self, clip_id, arrays):
+        """ Add or replace the track of a clip from the arrays saved by `batch.process_clip` """
+        start_timestamp = None
+        if "gps_start_timestamp" in arrays:
+            start_timestamp = int(arrays["gps_start_timestamp"])
+        elif len(arrays.get("gps_timestamps", ())):
+            start_timestamp = int(arrays["gps_timestamps"][0])
+        if start_timestamp == time_utils.NO_TIMESTAMP:
+            start_timestamp = None
+
+        track = Track(arrays["gps_msecs"], arrays["gps_lat"], arrays["gps_long"], start_timestamp)
+        self.insert(clip_id, track, arrays["gps_valid"] if "gps_valid" in arrays else None)
+
+    def remove(self, clip_id):
+        """ Remove the track of a clip, its id stays reserved until the next `insert` of it """
+        clip = self.clip_numbers.pop(clip_id)
+        self._flush()
+        self.segments = self.segments[self.segments["clip"] != clip]
+        self._cells = None
+
+    def _flush(self):
+
+        if self.pending:
+            self.segments = np.concatenate([self.segments] + self.pending)
+            self.pending = []
+            self._cells = None
+
+    def _build_grid(self):
+        """ Sort the (cell, segment) pairs of all the segments by cell """
+        self._flush()
+        if self._cells is not None:
+            return
+
+        lat0, lat1 = self._cell(self.segments["lat_min"]), self._cell(self.segments["lat_max"])
+        long0, long1 = self._cell(self.segments["long_min"]), self._cell(self.segments["long_max"])
+        nlat, nlong = lat1 - lat0 + 1, long1 - long0 + 1
+        counts = nlat * nlong
+        large = counts > self.max_segment_cells
+        self._large_segments = np.flatnonzero(large)
+        counts[large] = 0
+
+        # one row per (segment, cell) pair, the cell given by its rank within the segment bbox
+        segment_ids = np.repeat(np.arange(len(self.segments)), counts)
+        rank = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        lat_cells = np.repeat(lat0, counts) + rank // np.repeat(nlong, counts)
+        long_cells = np.repeat(long0, counts) + rank % np.repeat(nlong, counts)
+
+        cells = self._cell_key(lat_cells, long_cells)
+        order = np.argsort(cells, kind="stable")
+        self._cells = cells[order]
+        self._cell_segments = segment_ids[order]
+
+    def _candidates(self, lat_min, lat_max, long_min, long_max):
+        """ Index of the segments registered in the cells overlapping a bbox """
+        self._build_grid()
+        lat_cells = np.arange(self._cell(lat_min), self._cell(lat_max) + 1)
+        long_cells = np.arange(self._cell(long_min), self._cell(long_max) + 1)
+        if len(lat_cells) * len(long_cells) > len(self._cells):
+            # a query larger than the whole grid is cheaper as a scan
+            return np.arange(len(self.segments))
+        keys = self._cell_key(lat_cells[:, None], long_cells[None, :]).ravel()
+
+        left = np.searchsorted(self._cells, keys, side="left")
+        right = np.searchsorted(self._cells, keys, side="right")
+        return np.unique(np.concatenate([self._large_segments] + [self._cell_segments[l:r] for l, r in zip(left, right) if r > l]))
+
+    def _in_time(self, segments, start, end):
+        """ True for the segments overlapping [start, end], in UTC epoch nanoseconds """
+        clip_starts = np.asarray(self.clip_starts, dtype=np.int64)[segments["clip"]]
+        keep = clip_starts != time_utils.NO_TIMESTAMP
+        if start is not None:
+            keep &= clip_starts + segments["end_msecs"] * time_utils.NS_PER_MSEC >= start
+        if end is not None:
+            keep &= clip_starts + segments["start_msecs"] * time_utils.NS_PER_MSEC <= end
+        return keep
+
+    def query_bbox(self, lat_min, lat_max, long_min, long_max, start=None, end=None):
+        """ Find the clips passing through a bounding box
+        The matches are at segment resolution: a time range covers the whole
+        segments whose bounding box overlaps the query.
+        Parameters
+        ----------
+        lat_min, lat_max, long_min, long_max: float
+            The bounding box in decimal degrees.
+        start, end: int, optional
+            UTC epoch nanoseconds limiting the time of the matches. Clips
+            without a known start time never match a time limited query.
+        Returns
+        -------
+        matches: list of Match
+            The clip id and time range in msecs of each pass, sorted by clip
+            and time, consecutive segments merged.
+        """
+        segment_ids = self._candidates(lat_min, lat_max, long_min, long_max)
+        segments = self.segments[segment_ids]
+        hit = ((segments["lat_max"] >= lat_min) & (segments["lat_min"] <= lat_max) &
+               (segments["long_max"] >= long_min) & (segments["long_min"] <= long_max))
+        if start is not None or end is not None:
+            hit &= self._in_time(segments, start, end)
+        return self._merge(segment_ids[hit])
+
+    def query_point(self, lat, long, radius_meters, start=None, end=None):
+        """ Find the clips passing within a distance of a point
+        The distance is checked against the segment bounding boxes, with an
+        equirectangular approximation, see `query_bbox` for the parameters.
+        """
+        scale = max(math.cos(math.radians(lat)), 1e-6)
+        dlat = radius_meters / METERS_PER_DEGREE
+        dlong = dlat / scale
+        segment_ids = self._candidates(lat - dlat, lat + dlat, long - dlong, long + dlong)
+        segments = self.segments[segment_ids]
+
+        nearest_lat = np.clip(lat, segments["lat_min"], segments["lat_max"])
+        nearest_long = np.clip(long, segments["long_min"], segments["long_max"])
+        distance = np.hypot(nearest_lat - lat, (nearest_long - long) * scale) * METERS_PER_DEGREE
+        hit = distance <= radius_meters
+        if start is not None or end is not None:
+            hit &= self._in_time(segments, start, end)
+        return self._merge(segment_ids[hit])
+
+    def _merge(self, segment_ids):
+        """ Turn matching segments into per clip time ranges """
+        segments = np.sort(self.segments[segment_ids], order=["clip", "start_msecs"])
+        matches = []
+        for segment in segments:
+            clip_id = self.clip_ids[segment["clip"]]
+            if matches and matches[-1].clip_id == clip_id and segment["start_msecs"] <= matches[-1].end_msecs:
+                matches[-1] = matches[-1]._replace(end_msecs=max(matches[-1].end_msecs, float(segment["end_msecs"])))
+            else:
+                matches.append(Match(clip_id, float(segment["start_msecs"]), float(segment["end_msecs"])))
+        return matches
+
+    def save(self, path):
+        """ Save the index as a `.npz` file, replaced atomically """
+        self._flush()
+        meta = {
+            "cell_degrees": self.cell_degrees,
+            "points_per_segment": self.points_per_segment,
+            "clip_ids": self.clip_ids,
+            "removed": [clip for clip, clip_id in enumerate(self.clip_ids) if self.clip_numbers.get(clip_id) != clip],
+        }
+        cache._write_atomic(path, lambda f: np.savez(
+            f,
+            meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8),
+            clip_starts=np.asarray(self.clip_starts, dtype=np.int64),
+            segments=self.segments,
+        ))
+
+    @classmethod
+    def load(cls, path):
+        """ Load an index saved by `save` """
+        with np.load(path) as npz:
+            meta = json.loads(npz["meta"].tobytes())
+            index = cls(meta["cell_degrees"], meta["points_per_segment"])
+            index.clip_ids = meta["clip_ids"]
+            index.clip_starts = npz["clip_starts"].tolist()
+            index.segments = npz["segments"]
+        removed = set(meta["removed"])
+        index.clip_numbers = {clip_id: clip for clip, clip_id in enumerate(index.clip_ids) if clip not in removed}
+        return index
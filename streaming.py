@@ -0,0 +1,236 @@
+from collections import namedtuple
+
+import numpy as np
+
+from JE_ffprobe import JE_FFProbe
+import gps
+import main
+import parse
+import time_utils
+
+TelemetryChunk = namedtuple("TelemetryChunk", ["sensor", "msecs", "columns"])
+
+
+class _RunningFit:
+    """ Least squares fit of STMP against the first sample of each block, one block at a time
+    Same fit as `time_utils.fit_sample_period`, from running means and co-moments.
+    """
+
+    def __init__(self):
+
+        self.n = 0
+        self.mean_x = 0.
+        self.mean_y = 0.
+        self.cxx = 0.
+        self.cxy = 0.
+
+    def add(self, first_sample, stmp):
+
+        self.n += 1
+        dx = first_sample - self.mean_x
+        self.mean_x += dx / self.n
+        self.mean_y += (stmp - self.mean_y) / self.n
+        self.cxx += dx * (first_sample - self.mean_x)
+        self.cxy += dx * (stmp - self.mean_y)
+
+    def get(self):
+        """ (origin, period) in microseconds, None before two distinct blocks """
+        if self.n < 2 or self.cxx == 0.:
+            return None
+        period = self.cxy / self.cxx
+        return self.mean_y - period * self.mean_x, period
+
+
+class StreamDecoder:
+    """ Incremental decoder of a GPMF stream, one `DEVC` container at a time
+
+    Sensors whose blocks have STMP are timed on the camera clock like in
+    `main.calc_sample_msecs`, with the sample period fitted over the blocks
+    received so far: the times match `main.decode_gpmf_stream` as the fit
+    converges, the early chunks of a recording can differ by the error of a fit
+    over a few blocks. `stmp_anchor` is the UTC epoch nanoseconds of STMP 0 as
+    in `main.calc_stmp_anchor`, None until GPS has a fix.
+
+    Older streams without STMP are timed from the GPS timestamps as in
+    `main.calc_timestamp_steps`: the time step of a block is only known once the
+    next GPS timestamp arrives, so each sensor keeps its blocks since the last
+    one pending, and the blocks before the GPS lock get the first step.
+
+    Memory use is bounded by one `DEVC` plus the pending blocks of each sensor,
+    one per `DEVC` once GPS is locked, and one integer per GPS block for the
+    anchor, whatever the length of the recording.
+    """
+
+    sensors = {
+        "gps": ("GPS5", gps.parse_gps_block, main.GPSColumns),
+        "gyro": ("GYRO", gps.parse_gyro_block, main.GYROColumns),
+        "accl": ("ACCL", gps.parse_accl_block, main.ACCLColumns),
+    }
+
+    def __init__(self):
+
+        # sensor: True when timed from STMP, decided by its first block
+        self.stmp_timed = {}
+        # STMP timing: fit, number of samples so far, blocks waiting for a fit
+        self.fits = {sensor: _RunningFit() for sensor in self.sensors}
+        self.nsamples = {sensor: 0 for sensor in self.sensors}
+        self.unfitted = {sensor: [] for sensor in self.sensors}
+        # GPS timing: the pending block of each sensor
+        self.pending = {}
+        self.steps = {sensor: [] for sensor in self.sensors}
+        self.msecs = {sensor: 0. for sensor in self.sensors}
+        self._anchors = []
+
+    @property
+    def stmp_anchor(self):
+
+        if not self._anchors:
+            return None
+        anchors = np.sort(np.array(self._anchors, dtype=np.int64))
+        # integer median, as in `main.calc_stmp_anchor`
+        return int(anchors[(len(anchors) - 1) // 2] + (anchors[len(anchors) // 2] - anchors[(len(anchors) - 1) // 2]) // 2)
+
+    def _emit(self, sensor, step):
+
+        columns, npoints, _, _ = self.pending.pop(sensor)
+        increments = np.full(npoints, step)
+        increments[0] = self.msecs[sensor]
+        msecs = np.cumsum(increments)
+        self.msecs[sensor] = msecs[-1] + step
+        return TelemetryChunk(sensor, msecs, columns)
+
+    def _emit_fitted(self, sensor, fit):
+
+        columns = type(self.unfitted[sensor][0][0])(*(np.concatenate(c) for c in zip(*(block[0] for block in self.unfitted[sensor]))))
+        first_samples = np.concatenate([block[1] for block in self.unfitted[sensor]])
+        block_sizes = np.concatenate([block[2] for block in self.unfitted[sensor]])
+        self.unfitted[sensor] = []
+        return TelemetryChunk(sensor, time_utils.period_sample_msecs(fit, first_samples, block_sizes), columns)
+
+    def _feed_stmp(self, sensor, sensor_blocks, timestamp_indexes, columns):
+
+        npoints = len(columns[0])
+        block_sizes = np.diff(np.append(timestamp_indexes, npoints)).astype(np.int64)
+        stmp = main.get_block_values(sensor_blocks, "STMP")
+        tsmp = main.get_block_values(sensor_blocks, "TSMP")
+        first_samples = np.empty(len(sensor_blocks), dtype=np.int64)
+        for i, block_size in enumerate(block_sizes):
+            first_samples[i] = tsmp[i] - block_size if tsmp[i] is not None else self.nsamples[sensor]
+            self.nsamples[sensor] = first_samples[i] + block_size
+            if stmp[i] is not None:
+                self.fits[sensor].add(first_samples[i], stmp[i])
+
+        self.unfitted[sensor].append((columns, first_samples, block_sizes))
+        fit = self.fits[sensor].get()
+        return [self._emit_fitted(sensor, fit)] if fit is not None else []
+
+    def feed(self, devc):
+        """ Decode one top level `DEVC` container
+        Parameters
+        ----------
+        devc: bytes
+            A complete `DEVC` item, header included.
+        Returns
+        -------
+        chunks: list of TelemetryChunk
+            The blocks whose timing became known, at most one per sensor.
+        """
+        accl_blocks, gyro_blocks, gps_blocks = main.get_blocks_from_stream(devc)
+        blocks = {"gps": gps_blocks, "gyro": gyro_blocks, "accl": accl_blocks}
+        anchor = main.calc_stmp_anchor(gps_blocks)
+        if anchor is not None:
+            self._anchors.append(anchor)
+
+        decoded = {}
+        timestamp = time_utils.NO_TIMESTAMP
+        for sensor, (fourcc, parse_block, columns_type) in self.sensors.items():
+            if not blocks[sensor]:
+                continue
+            timestamp_indexes, parsed_blocks, columns = main.get_columns_from_blocks(blocks[sensor], fourcc, parse_block, columns_type)
+            decoded[sensor] = timestamp_indexes, columns
+            if sensor not in self.stmp_timed:
+                self.stmp_timed[sensor] = all(t is not None for t in main.get_block_values(blocks[sensor], "STMP"))
+            if sensor == "gps":
+                timestamp = int(time_utils.gpsu_to_epoch_ns([parsed_blocks[0].timestamp])[0])
+
+        chunks = []
+        for sensor, (timestamp_indexes, columns) in decoded.items():
+            if self.stmp_timed[sensor]:
+                chunks.extend(self._feed_stmp(sensor, blocks[sensor], timestamp_indexes, columns))
+                continue
+            npoints = len(columns[0])
+            if sensor not in self.pending:
+                self.pending[sensor] = (columns, npoints, 0, timestamp)
+                continue
+            # pending points, and the first point and GPS time of the span they end with
+            pending_columns, pending_npoints, span_start, span_timestamp = self.pending[sensor]
+            if span_timestamp != time_utils.NO_TIMESTAMP and timestamp != time_utils.NO_TIMESTAMP:
+                step = (timestamp - span_timestamp) / (pending_npoints - span_start) / time_utils.NS_PER_MSEC
+                self.steps[sensor].append(step)
+                chunks.append(self._emit(sensor, step))
+                self.pending[sensor] = (columns, npoints, 0, timestamp)
+                continue
+            # no GPS time to close the span: merge this block into it
+            if span_timestamp == time_utils.NO_TIMESTAMP and timestamp != time_utils.NO_TIMESTAMP:
+                span_start, span_timestamp = pending_npoints, timestamp
+            columns = type(columns)(*(np.concatenate(c) for c in zip(pending_columns, columns)))
+            self.pending[sensor] = (columns, pending_npoints + npoints, span_start, span_timestamp)
+
+        return chunks
+
+    def finish(self):
+        """ Flush the pending blocks
+        Blocks timed from GPS get the median step of their sensor. Blocks timed
+        from STMP but too few to fit a period are timed at their STMP, with a
+        zero step.
+        Returns
+        -------
+        chunks: list of TelemetryChunk
+        """
+        chunks = []
+        for sensor in self.sensors:
+            if self.unfitted[sensor]:
+                fit = self.fits[sensor].get()
+                chunks.append(self._emit_fitted(sensor, fit if fit is not None else (self.fits[sensor].mean_y, 0.)))
+        for sensor in list(self.pending):
+            steps = self.steps[sensor]
+            chunks.append(self._emit(sensor, np.median(steps) if steps else 0.))
+        return chunks
+
+
+def decode_stream_chunks(chunks):
+    """ Decode a GPMF stream read in chunks
+    Parameters
+    ----------
+    chunks: iterable of bytes
+        The raw GPMF stream, split at arbitrary positions.
+    Returns
+    -------
+    chunk_gen: generator
+        A generator of `TelemetryChunk` (sensor name, msecs, columns), in stream
+        order for each sensor.
+    """
+    decoder = StreamDecoder()
+    for devc in parse.iter_top_level(chunks):
+        yield from decoder.feed(devc)
+    yield from decoder.finish()
+
+
+def iter_video_telemetry(video_path, backend="auto", probe=None):
+    """ Stream the GPS, gyroscope and accelerometer data of a GoPro video
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    backend: str, optional (default="auto")
+        See `JE_FFProbe.extract_bin_stream`.
+    probe: JE_FFProbe, optional
+        Probe of the video, if already available.
+    Returns
+    -------
+    chunk_gen: generator
+        A generator of `TelemetryChunk`.
+    """
+    if probe is None:
+        probe = JE_FFProbe(video_path)
+    yield from decode_stream_chunks(probe.iter_bin_stream("gpmd", backend=backend))
@@ -0,0 +1,203 @@
+import datetime
+import functools
+
+import numpy as np
+
+import parse
+
+
+def klv_item(fourcc, type_str, size, repeat, payload):
+    """ Encode one KLV item, padding its payload to a multiple of 4 bytes
+    Parameters
+    ----------
+    fourcc: str
+        The FourCC code
+    type_str: str
+        The type of the value, "\\x00" for nested containers.
+    size: int
+        The size of one value
+    repeat: int
+        The number of values
+    payload: bytes
+        The encoded values
+    Returns
+    -------
+    item: bytes
+    """
+    payload = bytes(payload)
+    padding = parse.ceil4(len(payload)) - len(payload)
+    return parse.klv_header.pack(fourcc.encode("latin1"), type_str.encode("latin1"), size, repeat) + payload + b"\0" * padding
+
+
+def klv_container(fourcc, items):
+
+    payload = b"".join(items)
+    return klv_item(fourcc, "\x00", 4, len(payload) // 4, payload)
+
+
+def klv_string(fourcc, value):
+
+    value = value.encode("latin1")
+    return klv_item(fourcc, "c", 1, len(value), value)
+
+
+def klv_array(fourcc, type_str, values):
+    """ Encode a numeric array as a KLV item, one row per repeat """
+    values = np.asarray(values)
+    stype = parse.num_types[type_str][1]
+    values = values.astype(">" + stype)
+    if values.ndim == 0:
+        values = values.reshape(1)
+    repeat = values.shape[0]
+    return klv_item(fourcc, type_str, values.itemsize * int(np.prod(values.shape[1:], dtype=int)), repeat, values.tobytes())
+
+
+def _sample_counters(total_samples, stmp_us):
+    """ The STMP and TSMP items of a stream, none for older cameras when `stmp_us` is None """
+    if stmp_us is None:
+        return []
+    return [klv_array("STMP", "J", stmp_us), klv_array("TSMP", "L", total_samples)]
+
+
+def _imu_strm(fourcc, name, samples, total_samples, stmp_us, scale):
+
+    return klv_container("STRM", _sample_counters(total_samples, stmp_us) + [
+        klv_string("STNM", name),
+        klv_string("SIUN", "m/s2" if fourcc == "ACCL" else "rad/s"),
+        klv_array("SCAL", "s", scale),
+        klv_array(fourcc, "s", np.round(samples * scale)),
+    ])
+
+
+def _gps_strm(samples, total_samples, stmp_us, gpsu):
+
+    units = b"".join(u.ljust(3, b"\0") for u in (b"deg", b"deg", b"m", b"m/s", b"m/s"))
+    scale = np.array([10000000, 10000000, 1000, 1000, 100])
+    if gpsu is None:
+        gps_time = [klv_array("GPSF", "L", 0)]
+    else:
+        gps_time = [
+            klv_array("GPSF", "L", 3),
+            klv_item("GPSU", "U", 16, 1, gpsu.strftime("%y%m%d%H%M%S.%f")[:16].encode()),
+        ]
+    return klv_container("STRM", _sample_counters(total_samples, stmp_us) + [
+        klv_string("STNM", "GPS (Lat., Long., Alt., 2D speed, 3D speed)"),
+    ] + gps_time + [
+        klv_array("GPSP", "S", 150),
+        klv_item("UNIT", "c", 3, 5, units),
+        klv_array("SCAL", "l", scale),
+        klv_array("GPS5", "l", np.round(samples * scale)),
+    ])
+
+
+def make_gpmf_stream(seconds, accl_rate=200., gyro_rate=400., gps_rate=18., devc_seconds=1.001,
+                     start=datetime.datetime(2023, 10, 17, 10, 5, 0), gps_fix_seconds=0., seed=0, stmp=True):
+    """ Generate a valid GPMF stream shaped like a GoPro `gpmd` track
+    Every `DEVC` holds one ACCL, one GYRO and one GPS5 stream with STMP, TSMP,
+    SCAL and, for GPS, GPSU timestamps, at the given sample rates.
+    Parameters
+    ----------
+    seconds: float
+        The length of the recording.
+    accl_rate, gyro_rate, gps_rate: float, optional
+        The sample rates in Hz.
+    devc_seconds: float, optional (default=1.001)
+        The duration covered by each `DEVC`, GoPro cameras use about one second.
+    start: datetime.datetime, optional
+        The GPS time of the first sample.
+    gps_fix_seconds: float, optional (default=0.)
+        Time of the GPS lock. Before it, GPS streams have GPSF 0 and no GPSU,
+        as recorded indoors.
+    seed: int, optional (default=0)
+        The random seed of the sensor values.
+    stmp: bool, optional (default=True)
+        If False, leave out STMP and TSMP, as older cameras do, so the
+        samples can only be timed from GPSU.
+    Returns
+    -------
+    stream: bytes
+    """
+    rng = np.random.default_rng(seed)
+    ndevc = max(1, int(round(seconds / devc_seconds)))
+    totals = {"ACCL": 0, "GYRO": 0, "GPS5": 0}
+    rates = {"ACCL": accl_rate, "GYRO": gyro_rate, "GPS5": gps_rate}
+    position = np.array([51.5, -0.2, 50., 10., 10.])
+
+    devcs = []
+    for i in range(ndevc):
+        t0, t1 = i * devc_seconds, (i + 1) * devc_seconds
+        counts = {fourcc: int(round(t1 * rate)) - int(round(t0 * rate)) for fourcc, rate in rates.items()}
+        stmp_us = int(t0 * 1e6) if stmp else None
+
+        accl = rng.normal([9.81, 0., 0.], 0.5, (counts["ACCL"], 3))
+        gyro = rng.normal(0., 0.1, (counts["GYRO"], 3))
+        steps = np.cumsum(rng.normal(0., 1e-6, (counts["GPS5"], 5)) * [1, 1, 1e4, 1e5, 1e5], axis=0)
+        gps5 = position + steps
+        position = gps5[-1]
+
+        # TSMP counts the samples delivered since the start, this payload included
+        for fourcc in totals:
+            totals[fourcc] += counts[fourcc]
+        gpsu = start + datetime.timedelta(seconds=t0) if t0 >= gps_fix_seconds else None
+
+        devcs.append(klv_container("DEVC", [
+            klv_array("DVID", "L", 1),
+            klv_string("DVNM", "Camera"),
+            _imu_strm("ACCL", "Accelerometer", accl, totals["ACCL"], stmp_us, 418),
+            _imu_strm("GYRO", "Gyroscope", gyro, totals["GYRO"], stmp_us, 939),
+            _gps_strm(gps5, totals["GPS5"], stmp_us, gpsu),
+        ]))
+
+    return b"".join(devcs)
+
+
+def _nmea(body):
+
+    checksum = functools.reduce(lambda a, b: a ^ b, body.encode(), 0)
+    return ("$%s*%02X\r\n" % (body, checksum)).encode()
+
+
+def _nmea_coordinate(value, width):
+
+    degrees = int(abs(value))
+    return "%0*.4f" % (width, degrees * 100 + (abs(value) - degrees) * 60)
+
+
+def make_nextbase_text(records, start=datetime.datetime(2023, 10, 17, 10, 5, 0), seed=0):
+    """ Generate a Nextbase style `text` track
+    Each record is 480 bytes of IMU data (20 samples x accelerometer/gyroscope x
+    3 little-endian float32) followed by a 128 byte GPRMC and a 128 byte GPGGA
+    sentence, zero padded, one record per second.
+    Parameters
+    ----------
+    records: int
+        The number of records.
+    start: datetime.datetime, optional
+        The UTC time of the first record.
+    seed: int, optional (default=0)
+        The random seed.
+    Returns
+    -------
+    track: bytes
+    """
+    rng = np.random.default_rng(seed)
+    imu = rng.normal(0., 1., (records, 20, 2, 3)).astype("<f4")
+    latitude = 51.5 + np.cumsum(rng.normal(0., 1e-5, records))
+    longitude = -0.2 + np.cumsum(rng.normal(0., 2e-5, records))
+
+    out = []
+    for i in range(records):
+        t = start + datetime.timedelta(seconds=i)
+        gprmc = "GPRMC,%s,A,%s,%s,%s,%s,%.2f,%.1f,%s,,,A" % (
+            t.strftime("%H%M%S.%f")[:10],
+            _nmea_coordinate(latitude[i], 9), "N" if latitude[i] >= 0 else "S",
+            _nmea_coordinate(longitude[i], 10), "E" if longitude[i] >= 0 else "W",
+            rng.uniform(0, 40), rng.uniform(0, 360), t.strftime("%d%m%y"))
+        gpgga = "GPGGA,%s,%s,%s,%s,%s,1,08,0.9,%.1f,M,47.0,M,," % (
+            t.strftime("%H%M%S.%f")[:10],
+            _nmea_coordinate(latitude[i], 9), "N" if latitude[i] >= 0 else "S",
+            _nmea_coordinate(longitude[i], 10), "E" if longitude[i] >= 0 else "W",
+            rng.uniform(40, 60))
+        out.append(imu[i].tobytes() + _nmea(gprmc).ljust(128, b"\0") + _nmea(gpgga).ljust(128, b"\0"))
+
+    return b"".join(out)
@@ -0,0 +1,114 @@
+import json
+import struct
+
+import numpy as np
+
+import cache
+import instrument
+
+# magic, format version, size of the JSON header that follows
+file_header = struct.Struct("<4sII")
+MAGIC = b"TELM"
+VERSION = 1
+ALIGNMENT = 64
+
+
+def _align(offset):
+
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_columns(path, kind, columns, attrs=None):
+    """ Save named column arrays in the memory-mappable telemetry format
+    The file is a small header followed by every column as a contiguous
+    little-endian array, aligned on 64 bytes. The header is JSON describing the
+    kind, attributes and the dtype, shape and offset of every column.
+    Parameters
+    ----------
+    path: str
+        The output file, replaced atomically.
+    kind: str
+        What the columns describe, e.g. "NPGPS", checked when opening.
+    columns: dict of str to numpy.ndarray
+        The arrays, of any numeric dtype and shape.
+    attrs: dict, optional
+        Extra JSON serializable values, e.g. the start timestamp.
+    """
+    arrays = {}
+    for name, values in columns.items():
+        values = np.asarray(values)
+        arrays[name] = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder("<"))
+
+    # the offsets are part of the header: grow the data start until the header fits before it
+    layout = {name: {"dtype": values.dtype.str, "shape": list(values.shape), "offset": 0} for name, values in arrays.items()}
+    data_start = 0
+    while True:
+        offset = data_start
+        for name, values in arrays.items():
+            layout[name]["offset"] = offset
+            offset = _align(offset + values.nbytes)
+        header_bytes = json.dumps({"kind": kind, "attrs": attrs or {}, "columns": layout}).encode()
+        if file_header.size + len(header_bytes) <= data_start:
+            break
+        data_start = _align(file_header.size + len(header_bytes))
+
+    def write(f):
+        f.write(file_header.pack(MAGIC, VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, values in arrays.items():
+            f.seek(layout[name]["offset"])
+            f.write(values.tobytes())
+        f.truncate(offset)
+
+    with instrument.stage("export", items_out=len(arrays)):
+        cache._write_atomic(path, write)
+
+
+def read_header(path):
+    """ Read the header of a telemetry file
+    Returns
+    -------
+    header: dict
+        "kind", "attrs" and "columns" (dtype, shape and offset of each column).
+    Raises
+    ------
+    RuntimeError: If the file is not a telemetry file of a supported version.
+    """
+    with open(path, "rb") as f:
+        prefix = f.read(file_header.size)
+        if len(prefix) < file_header.size:
+            raise RuntimeError(f"{path} is not a telemetry file")
+        magic, version, header_size = file_header.unpack(prefix)
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError(f"{path} is not a version {VERSION} telemetry file")
+        return json.loads(f.read(header_size))
+
+
+def open_columns(path, mode="r"):
+    """ Map the columns of a telemetry file, without reading or parsing them
+    The arrays are views on one `numpy.memmap` of the file, so processes
+    opening the same file share its pages through the page cache.
+    Parameters
+    ----------
+    path: str
+        The telemetry file.
+    mode: str, optional (default="r")
+        The `numpy.memmap` mode, "r" for read-only views, "c" for copy-on-write.
+    Returns
+    -------
+    kind: str
+    attrs: dict
+    columns: dict of str to numpy.ndarray
+    """
+    header = read_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode=mode)
+
+    columns = {}
+    for name, layout in header["columns"].items():
+        dtype = np.dtype(layout["dtype"])
+        shape = tuple(layout["shape"])
+        nbytes = dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+        start = layout["offset"]
+        columns[name] = data[start: start + nbytes].view(dtype).reshape(shape)
+
+    return header["kind"], header["attrs"], columns
@@ -0,0 +1,65 @@
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parse
+import synthetic
+
+
+def _box(box_type, payload):
+
+    return struct.pack(">I4s", 8 + len(payload), box_type.encode()) + payload
+
+
+def _full_box(box_type, payload):
+
+    return _box(box_type, b"\0" * 4 + payload)
+
+
+def write_mp4(path, codec_tag, samples, timescale=1000, sample_delta=1000, handler="meta"):
+    """ Write an MP4 file with one track holding `samples`, one chunk per sample, moov last """
+    ftyp = _box("ftyp", b"isom" + b"\0" * 4)
+    mdat = _box("mdat", b"".join(samples))
+
+    chunk_offsets, offset = [], len(ftyp) + 8
+    for sample in samples:
+        chunk_offsets.append(offset)
+        offset += len(sample)
+
+    stbl = _box("stbl", b"".join([
+        _full_box("stsd", struct.pack(">I", 1) + _box(codec_tag, b"\0" * 8)),
+        _full_box("stts", struct.pack(">III", 1, len(samples), sample_delta)),
+        _full_box("stsc", struct.pack(">IIII", 1, 1, 1, 1)),
+        _full_box("stsz", struct.pack(">II%iI" % len(samples), 0, len(samples), *map(len, samples))),
+        _full_box("stco", struct.pack(">I%iI" % len(samples), len(samples), *chunk_offsets)),
+    ]))
+    trak = _box("trak", b"".join([
+        _full_box("tkhd", struct.pack(">IIII", 0, 0, 1, 0) + b"\0" * 64),
+        _box("mdia", b"".join([
+            _full_box("mdhd", struct.pack(">IIII", 0, 0, timescale, sample_delta * len(samples)) + b"\0" * 4),
+            _full_box("hdlr", b"\0" * 4 + handler.encode() + b"\0" * 12 + b"x\0"),
+            _box("minf", stbl),
+        ])),
+    ]))
+    moov = _box("moov", _full_box("mvhd", b"\0" * 96) + trak)
+
+    with open(path, "wb") as f:
+        f.write(ftyp + mdat + moov)
+    return path
+
+
+@pytest.fixture(scope="session")
+def gpmf_stream():
+
+    return synthetic.make_gpmf_stream(60.)
+
+
+@pytest.fixture
+def gopro_clip(tmp_path, gpmf_stream):
+    """ A GoPro clip with one `gpmd` sample per `DEVC` of `gpmf_stream` """
+    samples = list(parse.iter_top_level([gpmf_stream]))
+    return write_mp4(str(tmp_path / "GX010001.MP4"), "gpmd", samples, sample_delta=1001)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import align
+import gps_data_extractor
+import main
+import synthetic
+
+
+@pytest.fixture(scope="module")
+def nextbase():
+
+    track = synthetic.make_nextbase_text(20)
+    # the first records are logged before the GPS fix
+    void = synthetic._nmea("GPRMC,100500.00,V,,,,,,,171023,,,N").ljust(128, b"\0")
+    record_size = gps_data_extractor.nextbase_record_dtype.itemsize
+    for record in range(3):
+        start = record * record_size + 480
+        track = track[:start] + void + track[start + 128:]
+    return gps_data_extractor.decode_nextbase(track)
+
+
+@pytest.mark.parametrize("order", [("gps", "gyro"), ("gyro", "gps")])
+def test_resample_ignores_untimed_gprmc_rows(nextbase, order):
+
+    _, np_gyro, np_gprmc, _ = nextbase
+    streams = {"gps": np_gprmc, "gyro": np_gyro}
+    aligned = align.resample({name: streams[name] for name in order}, rate=10.)
+
+    assert len(aligned.np_msecs) > 100
+    assert np.isfinite(aligned.columns["gps_lat"]).all()
+    assert np.isfinite(aligned.columns["gyro_x"]).all()
+
+
+@pytest.fixture(scope="module")
+def gopro(gpmf_stream):
+
+    return main.decode_gpmf_stream(gpmf_stream), main.decode_gpmf_stream(gpmf_stream, compact=True)
+
+
+@pytest.mark.parametrize("kwargs", [{"rate": 100.}, {"reference": "gps"}, {"msecs": np.linspace(-100., 61000., 5000)}])
+def test_resample_compact_matches_expanded(gopro, kwargs):
+
+    (np_gps, np_gyro, np_accl), (_, compact_gyro, compact_accl) = gopro
+    aligned = align.resample({"gps": np_gps, "gyro": np_gyro, "accl": np_accl}, chunk_size=1000, **kwargs)
+    compact = align.resample({"gps": np_gps, "gyro": compact_gyro, "accl": compact_accl}, chunk_size=1000, **kwargs)
+
+    np.testing.assert_array_equal(compact.np_msecs, aligned.np_msecs)
+    for name, column in aligned.columns.items():
+        np.testing.assert_allclose(compact.columns[name], column, rtol=1e-6, atol=1e-9)
+
+
+def test_resample_interpolates_linearly(gopro):
+
+    (np_gps, np_gyro, _), _ = gopro
+    aligned = align.resample({"gyro": np_gyro}, msecs=np_gyro.np_msecs[100:110] + 0.5 * np.diff(np_gyro.np_msecs[100:111]))
+
+    np.testing.assert_allclose(aligned.columns["gyro_x"], (np_gyro.np_x[100:110] + np_gyro.np_x[101:111]) / 2)
+    assert np.isnan(align.resample({"gyro": np_gyro}, msecs=[-1000.]).columns["gyro_x"]).all()
+
+
+def test_resample_empty_streams(gopro):
+
+    (np_gps, _, _), _ = gopro
+    empty = np_gps.from_columns({"np_msecs": np.zeros(0), "np_lat": np.zeros(0), "np_long": np.zeros(0), "np_elev": np.zeros(0)})
+    aligned = align.resample({"gps": empty}, rate=10.)
+
+    assert len(aligned.np_msecs) == 0
+    assert len(aligned.columns["gps_lat"]) == 0
@@ -0,0 +1,49 @@
+import os
+import shutil
+
+import numpy as np
+
+import batch
+from cache import TelemetryCache
+
+
+def test_columns_round_trip_and_version(tmp_path, gopro_clip):
+
+    cache = TelemetryCache(str(tmp_path / "cache"))
+    assert cache.get_columns(gopro_clip, "gopro") is None
+
+    cache.put_columns(gopro_clip, "gopro", {"gps_msecs": np.arange(5.)})
+    np.testing.assert_array_equal(cache.get_columns(gopro_clip, "gopro")["gps_msecs"], np.arange(5.))
+    assert "gopro.v%i.npz" % TelemetryCache.columns_version in os.listdir(cache.entry_dir(gopro_clip))
+
+    # columns written by another decoder version are not reused
+    cache.columns_version += 1
+    assert cache.get_columns(gopro_clip, "gopro") is None
+
+
+def test_entry_removed_meanwhile_is_a_miss(tmp_path, gopro_clip):
+
+    cache = TelemetryCache(str(tmp_path / "cache"))
+    cache.put_stream(gopro_clip, "gpmd", b"data")
+    shutil.rmtree(cache.entry_dir(gopro_clip))
+
+    assert cache.get_stream(gopro_clip, "gpmd") is None
+    cache.put_stream(gopro_clip, "gpmd", b"data")
+    assert cache.get_stream(gopro_clip, "gpmd") == b"data"
+
+
+def test_batch_evicts_to_cache_max_bytes(tmp_path, gopro_clip):
+
+    clips = []
+    for name in "abc":
+        os.makedirs(str(tmp_path / name))
+        clips.append(shutil.copy(gopro_clip, str(tmp_path / name / "GX010001.MP4")))
+    cache_dir = str(tmp_path / "cache")
+
+    results = batch.run_batch(clips, str(tmp_path / "out"), workers=1, cache_dir=cache_dir, log=lambda line: None,
+                              cache_max_bytes=1)
+
+    assert all(result.error is None for result in results)
+    assert sorted(result.output_path for result in results) == [str(tmp_path / "out" / name / "GX010001.npz") for name in "abc"]
+    # the most recently used entry is always kept
+    assert len(list(TelemetryCache(cache_dir).iter_entries())) == 1
@@ -0,0 +1,18 @@
+import chapters
+
+
+def test_gopr_is_the_chapter_before_gp01():
+
+    assert chapters.chapter_key("GOPR0042.MP4") == (("GP", "0042", "mp4"), 0)
+    assert chapters.chapter_key("GP010042.MP4") == (("GP", "0042", "mp4"), 1)
+    assert chapters.chapter_key("GX010042.MP4")[1] == 1
+    assert chapters.chapter_key("IMG_0042.MP4") is None
+
+
+def test_find_chapters_keeps_gopr_and_gp01(tmp_path):
+
+    for name in ["GP020042.MP4", "GOPR0042.MP4", "GP010042.MP4", "GOPR0043.MP4"]:
+        (tmp_path / name).write_bytes(b"")
+
+    found = chapters.find_chapters(str(tmp_path / "GP010042.MP4"))
+    assert found == [str(tmp_path / name) for name in ["GOPR0042.MP4", "GP010042.MP4", "GP020042.MP4"]]
@@ -0,0 +1,72 @@
+import io
+import json
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+import pytest
+
+import export
+import gps_data_extractor
+import main
+import synthetic
+
+
+@pytest.fixture(scope="module")
+def np_gprmc():
+
+    track = synthetic.make_nextbase_text(10)
+    # records logged before the GPS fix and a corrupted one
+    void = synthetic._nmea("GPRMC,100500.00,V,,,,,,,171023,,,N").ljust(128, b"\0")
+    record_size = gps_data_extractor.nextbase_record_dtype.itemsize
+    for record in (0, 1, 5):
+        start = record * record_size + 480
+        track = track[:start] + void + track[start + 128:]
+    return gps_data_extractor.decode_gprmc(track)
+
+
+def test_csv_matches_columns(gpmf_stream):
+
+    np_gps, _, _ = main.decode_gpmf_stream(gpmf_stream)
+    out = io.BytesIO()
+    export.write_csv(np_gps, out, chunk_size=100)
+    table = np.loadtxt(io.BytesIO(out.getvalue()), delimiter=",", skiprows=1)
+
+    assert out.getvalue().startswith(b"msecs,lat,long,elev\n")
+    np.testing.assert_allclose(table[:, 0], np_gps.np_msecs, atol=1e-3)
+    np.testing.assert_allclose(table[:, 1], np_gps.np_lat, atol=1e-7)
+    np.testing.assert_allclose(table[:, 3], np_gps.np_elev, atol=1e-3)
+
+
+def test_geojson_leaves_out_void_fixes(np_gprmc):
+
+    out = io.BytesIO()
+    export.write_geojson(np_gprmc, out, chunk_size=4)
+    coordinates = json.loads(out.getvalue())["features"][0]["geometry"]["coordinates"]
+
+    valid = np_gprmc.np_valid
+    assert valid.sum() == 7
+    np.testing.assert_allclose(coordinates, np.column_stack([np_gprmc.np_long[valid], np_gprmc.np_lat[valid]]), atol=1e-7)
+
+
+def test_gpx_leaves_out_void_fixes(np_gprmc):
+
+    out = io.BytesIO()
+    export.write_gpx(np_gprmc, out, name="clip", chunk_size=4)
+    namespace = {"gpx": "http://www.topografix.com/GPX/1/1"}
+    points = ElementTree.fromstring(out.getvalue()).findall(".//gpx:trkpt", namespace)
+
+    assert len(points) == np_gprmc.np_valid.sum()
+    assert all(point.find("gpx:time", namespace).text.endswith("Z") for point in points)
+    np.testing.assert_allclose([float(point.get("lat")) for point in points], np_gprmc.np_lat[np_gprmc.np_valid], atol=1e-7)
+
+
+def test_parquet_gives_untimed_rows_a_null_timestamp(tmp_path, np_gprmc):
+
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    path = str(tmp_path / "gps.parquet")
+    export.write_parquet(np_gprmc, path)
+    timestamps = pyarrow.parquet.read_table(path).column("timestamp")
+
+    assert timestamps.null_count == (~np_gprmc.np_valid).sum()
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from JE_ffprobe import JE_FFProbe
+from conftest import write_mp4
+import gpmf_streams
+import main
+import np_telem
+import parse
+import synthetic
+import window
+
+fourccs = ["GPS5", "ACCL", "GYRO"]
+
+
+def _rows(stream):
+
+    return np.column_stack(list(stream.columns.values()))
+
+
+def test_parallel_decode_matches_serial(gpmf_stream):
+
+    serial = gpmf_streams.decode_streams(gpmf_stream, fourccs)
+    parallel = gpmf_streams.decode_streams_parallel(gpmf_stream, fourccs, workers=3, min_bytes=0)
+
+    assert list(parallel) == list(serial)
+    for fourcc, stream in serial.items():
+        np.testing.assert_array_equal(_rows(parallel[fourcc]), _rows(stream))
+        np.testing.assert_array_equal(parallel[fourcc].block_starts, stream.block_starts)
+        np.testing.assert_allclose(parallel[fourcc].msecs, stream.msecs, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("stmp", [True, False])
+def test_concat_streams_matches_serial(stmp):
+
+    stream = synthetic.make_gpmf_stream(30., stmp=stmp)
+    serial = gpmf_streams.decode_streams(stream, fourccs)
+    for nparts in (2, 5, 31):
+        parts = [gpmf_streams.decode_streams(stream[start:end], fourccs) for start, end in parse.split_klv(stream, nparts)]
+        joined = gpmf_streams.concat_streams(parts)
+
+        for fourcc, expected in serial.items():
+            np.testing.assert_array_equal(_rows(joined[fourcc]), _rows(expected))
+            np.testing.assert_array_equal(joined[fourcc].block_starts, expected.block_starts)
+            if stmp:
+                np.testing.assert_allclose(joined[fourcc].msecs, expected.msecs, rtol=0, atol=1e-6)
+            else:
+                assert joined[fourcc].msecs is None and expected.msecs is None
+
+
+def test_telem_file_round_trip(tmp_path, gpmf_stream):
+
+    np_gps, np_gyro, _ = main.decode_gpmf_stream(gpmf_stream)
+    np_gps.save(str(tmp_path / "gps.telm"))
+    loaded = np_telem.NPGPS.open(str(tmp_path / "gps.telm"))
+
+    assert loaded.start_timestamp == np_gps.start_timestamp
+    for name, value in vars(np_gps).items():
+        if name.startswith("np_"):
+            np.testing.assert_array_equal(getattr(loaded, name), value)
+
+    _, compact_gyro, _ = main.decode_gpmf_stream(gpmf_stream, compact=True)
+    compact_gyro.save(str(tmp_path / "gyro.telm"))
+    loaded = np_telem.NPGYROCompact.open(str(tmp_path / "gyro.telm"))
+
+    np.testing.assert_array_equal(loaded.np_raw, compact_gyro.np_raw)
+    np.testing.assert_allclose(loaded.np_msecs, np_gyro.np_msecs)
+    np.testing.assert_allclose(loaded.np_x, np_gyro.np_x, rtol=1e-6)
+
+
+def test_window_matches_full_decode(gopro_clip, gpmf_stream):
+
+    full = gpmf_streams.decode_streams(gpmf_stream, fourccs)
+    windowed = window.extract(gopro_clip, 20., 30., fourccs)
+
+    for fourcc in fourccs:
+        rows, full_rows = _rows(windowed[fourcc]), _rows(full[fourcc])
+        n = len(rows)
+        assert n > 0
+        first = next(i for i in range(len(full_rows) - n + 1) if np.array_equal(full_rows[i:i + n], rows))
+        full_msecs = full[fourcc].msecs[first:first + n]
+        # the window fits its own sample period, it stays within half a sample of the full fit
+        period = np.median(np.diff(full[fourcc].msecs))
+        assert np.abs(windowed[fourcc].msecs - full_msecs).max() < period / 2
+        assert 19000. < full_msecs[0] - full[fourcc].msecs[0] < 21000.
+        assert 9000. < full_msecs[-1] - full_msecs[0] < 10500.
+
+
+def test_window_without_stmp_uses_container_times(tmp_path):
+
+    stream = synthetic.make_gpmf_stream(30., stmp=False)
+    clip = write_mp4(str(tmp_path / "GX010002.MP4"), "gpmd", list(parse.iter_top_level([stream])), sample_delta=1001)
+    windowed = window.extract(clip, 10., 20., ["ACCL"])["ACCL"]
+
+    assert windowed.msecs[0] >= 10000. and windowed.msecs[-1] < 20000.
+    assert abs(len(windowed.msecs) - 2000) <= 2
+
+
+def test_window_fallback_without_stmp_is_an_error(tmp_path, monkeypatch):
+
+    clip = tmp_path / "GX010003.MP4"
+    clip.write_bytes(b"not an mp4")
+    monkeypatch.setattr(JE_FFProbe, "extract_bin_stream", lambda self, *args, **kwargs: synthetic.make_gpmf_stream(30., stmp=False))
+
+    with pytest.raises(RuntimeError):
+        window.extract(str(clip), 10., 20., ["ACCL"])
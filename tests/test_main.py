@@ -0,0 +1,23 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import main
+import synthetic
+import time_utils
+
+start = datetime.datetime(2023, 10, 17, 10, 5, 0)
+start_ns = int(time_utils.civil_to_epoch_ns(start.year, start.month, start.day, start.hour, start.minute, 0))
+
+
+@pytest.mark.parametrize("stmp", [True, False])
+@pytest.mark.parametrize("compact", [False, True])
+def test_start_timestamp_is_msecs_zero_with_late_gps_lock(stmp, compact):
+
+    stream = synthetic.make_gpmf_stream(20., start=start, gps_fix_seconds=5., stmp=stmp)
+    for telem in main.decode_gpmf_stream(stream, compact=compact):
+        # the synthetic GPS time of the first sample is `start`
+        utc_msecs = (telem.start_timestamp - start_ns) / time_utils.NS_PER_MSEC + np.asarray(telem.np_msecs)
+        assert abs(utc_msecs[0]) < 10.
+        assert 19900. < utc_msecs[-1] < 20100.
@@ -0,0 +1,47 @@
+import struct
+
+import pytest
+
+from conftest import write_mp4
+import mp4_reader
+import triage
+
+
+def _damage_stsz(path, sample_count):
+    """ Overwrite the sample count of the stsz box """
+    with open(path, "r+b") as f:
+        data = f.read()
+        f.seek(data.index(b"stsz") + 12)
+        f.write(struct.pack(">I", sample_count))
+
+
+@pytest.fixture
+def damaged_clip(tmp_path):
+
+    path = write_mp4(str(tmp_path / "GX010001.MP4"), "gpmd", [bytes(100)] * 10)
+    _damage_stsz(path, 1000)
+    return path
+
+
+def test_damaged_sample_table_is_a_runtime_error(damaged_clip):
+
+    with pytest.raises(RuntimeError):
+        mp4_reader.read_tracks(damaged_clip)
+    with pytest.raises(RuntimeError):
+        mp4_reader.extract_bin_stream(damaged_clip, "gpmd")
+
+
+def test_triage_reports_damaged_sample_table(damaged_clip):
+
+    info = triage.scan_file(damaged_clip)
+    assert info.error is not None
+    assert info.kind is None
+
+
+def test_triage_reads_sample_table(tmp_path):
+
+    path = write_mp4(str(tmp_path / "GX010001.MP4"), "gpmd", [bytes(100)] * 10, sample_delta=1001)
+    info = triage.scan_file(path)
+    assert info.error is None
+    assert (info.kind, info.sample_count, info.data_size) == ("gopro", 10, 1000)
+    assert info.duration == pytest.approx(10.01)
@@ -0,0 +1,36 @@
+import numpy as np
+
+import gps_data_extractor
+import synthetic
+import time_utils
+
+record_size = gps_data_extractor.nextbase_record_dtype.itemsize
+
+
+def _with_void_fix(track, record):
+    """ Replace the GPRMC sentence of a record with a void one, as logged before a fix """
+    sentence = synthetic._nmea("GPRMC,100500.00,V,,,,,,,171023,,,N").ljust(128, b"\0")
+    start = record * record_size + 480
+    return track[:start] + sentence + track[start + 128:]
+
+
+def test_void_gprmc_has_no_timestamp():
+
+    track = _with_void_fix(synthetic.make_nextbase_text(10), 0)
+    np_gprmc = gps_data_extractor.decode_gprmc(track)
+
+    assert not np_gprmc.np_valid[0]
+    assert np_gprmc.np_valid[1:].all()
+    assert np_gprmc.np_timestamps[0] == time_utils.NO_TIMESTAMP
+    assert np_gprmc.start_timestamp == np_gprmc.np_timestamps[1]
+    assert np.isnan(np_gprmc.np_msecs[0])
+    np.testing.assert_allclose(np_gprmc.np_msecs[1:], np.arange(9) * 1000.)
+
+
+def test_void_gprmc_is_not_a_location():
+
+    track = _with_void_fix(synthetic.make_nextbase_text(10), 3)
+    locations = gps_data_extractor._extract_gps_locations_from_byte_data(track)
+
+    timestamps = np.array([location["timestamp"] for location in locations])
+    np.testing.assert_allclose(timestamps - timestamps[0], [0, 1, 2, 4, 5, 6, 7, 8, 9])
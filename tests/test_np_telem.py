@@ -0,0 +1,54 @@
+import io
+
+import numpy as np
+import pytest
+
+import export
+import main
+import np_telem
+
+
+@pytest.fixture(scope="module")
+def gyro(gpmf_stream):
+
+    _, np_gyro, _ = main.decode_gpmf_stream(gpmf_stream)
+    _, compact_gyro, _ = main.decode_gpmf_stream(gpmf_stream, compact=True)
+    return np_gyro, compact_gyro
+
+
+def test_compact_matches_expanded(gyro):
+
+    np_gyro, compact_gyro = gyro
+    assert compact_gyro.np_raw.dtype == np.int16
+    np.testing.assert_allclose(compact_gyro.np_msecs, np_gyro.np_msecs)
+    for name in compact_gyro.columns:
+        np.testing.assert_allclose(getattr(compact_gyro, name), getattr(np_gyro, name), rtol=1e-6)
+
+    expanded = compact_gyro.expand()
+    assert isinstance(expanded, np_telem.NPGYRO)
+    np.testing.assert_allclose(expanded.np_x, np_gyro.np_x)
+
+
+def test_compact_ranges_match_whole_stream(gyro):
+
+    _, compact_gyro = gyro
+    for start, end in [(0, 10), (395, 1210), (len(compact_gyro) - 7, len(compact_gyro))]:
+        np.testing.assert_array_equal(compact_gyro.sample_msecs(start, end), compact_gyro.np_msecs[start:end])
+        np.testing.assert_array_equal(compact_gyro.scaled(start, end, 1), compact_gyro.np_x[start:end])
+        np.testing.assert_array_equal(compact_gyro.column("np_y", start, end), compact_gyro.np_y[start:end])
+
+
+def test_compact_csv_is_scaled_per_chunk(gyro, monkeypatch):
+
+    np_gyro, compact_gyro = gyro
+    ranges = []
+    sample_msecs = np_telem.NPIMU.sample_msecs
+    monkeypatch.setattr(np_telem.NPIMU, "sample_msecs", lambda self, start=0, end=None: ranges.append((start, end)) or sample_msecs(self, start, end))
+
+    out = io.BytesIO()
+    export.write_csv(compact_gyro, out, chunk_size=1000)
+
+    assert ranges and all(end - start <= 1000 for start, end in ranges)
+    table = np.loadtxt(io.BytesIO(out.getvalue()), delimiter=",", skiprows=1)
+    np.testing.assert_allclose(table[:, 0], np_gyro.np_msecs, atol=1e-3)
+    np.testing.assert_allclose(table[:, 2], np_gyro.np_x, atol=1e-6)
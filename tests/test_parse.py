@@ -0,0 +1,112 @@
+import struct
+
+import numpy as np
+import pytest
+
+import parse
+import synthetic
+
+
+def _reference_klv(x):
+    """ Straightforward parser copying every payload, to check the in-place one against """
+    items, start = [], 0
+    while start < len(x):
+        fourcc, type_str, size, repeat = struct.unpack(">4scBH", x[start:start + 8])
+        payload = bytes(x[start + 8:start + 8 + size * repeat])
+        start += 8 + parse.ceil4(size * repeat)
+        if type_str == b"\0":
+            payload = _reference_klv(payload)
+        items.append((fourcc.decode("latin1"), type_str.decode("latin1"), size, repeat, payload))
+    return items
+
+
+def _compare(items, reference):
+
+    assert len(items) == len(reference)
+    for item, (fourcc, type_str, size, repeat, payload) in zip(items, reference):
+        assert (item.key, tuple(item.length)) == (fourcc, (type_str, size, repeat))
+        if type_str == "\0":
+            _compare(item.value, payload)
+        elif type_str in parse.num_types:
+            expected = np.frombuffer(payload, dtype=">" + parse.num_types[type_str][1])
+            np.testing.assert_array_equal(np.ravel(item.value), expected)
+
+
+@pytest.mark.parametrize("as_type", [bytes, bytearray, memoryview])
+def test_iter_klv_matches_reference(gpmf_stream, as_type):
+
+    _compare(parse.expand_klv(as_type(gpmf_stream)), _reference_klv(gpmf_stream))
+
+
+def test_iter_klv_does_not_copy_payloads(gpmf_stream):
+
+    buf = bytearray(gpmf_stream)
+    devc = next(parse.iter_klv(buf))
+    strm = next(item for item in devc.value if item.key == "STRM")
+    accl = next(item for item in strm.value if item.key == "ACCL")
+
+    assert not accl.value.flags.owndata
+    assert np.shares_memory(accl.value, np.frombuffer(buf, dtype=np.uint8))
+
+
+def test_filter_klv_finds_nested_items(gpmf_stream):
+
+    found = list(parse.filter_klv(gpmf_stream, ["GPSU"]))
+    assert len(found) == 60
+    assert all(item.key == "GPSU" for item in found)
+
+
+
+def _flatten(items, depth=0, parent=-1, rows=None):
+    """ (fourcc, depth, parent row) of every item of an expanded KLV tree, in stream order """
+    rows = [] if rows is None else rows
+    for item in items:
+        rows.append((item.key, depth, parent))
+        if item.length.type == "\0":
+            _flatten(item.value, depth + 1, len(rows) - 1, rows)
+    return rows
+
+
+def test_index_klv_matches_tree(gpmf_stream):
+
+    index = parse.index_klv(gpmf_stream)
+    rows = _flatten(parse.expand_klv(gpmf_stream))
+
+    assert len(index) == len(rows)
+    assert [(fourcc.decode("latin1"), int(depth), int(parent)) for fourcc, depth, parent
+            in zip(index["fourcc"], index["depth"], index["parent"])] == rows
+    # the offsets point at the payloads
+    first = index[0]
+    assert gpmf_stream[first["offset"] - 8:first["offset"] - 4] == first["fourcc"]
+
+
+def test_gather_payloads_matches_iteration(gpmf_stream):
+
+    index = parse.index_klv(gpmf_stream)
+    rows = parse.select_klv(index, "ACCL", parent_fourcc="STRM")
+    values, counts = parse.gather_payloads(gpmf_stream, index, rows)
+
+    expected = [item.value for item in parse.filter_klv(gpmf_stream, ["ACCL"])]
+    np.testing.assert_array_equal(values, np.concatenate(expected))
+    np.testing.assert_array_equal(counts, [len(value) for value in expected])
+    assert not parse.select_klv(index, "ACCL", parent_fourcc="DEVC").any()
+
+def test_iter_top_level_reassembles_any_split(gpmf_stream):
+
+    devcs = [bytes(item) for item in parse.iter_top_level([gpmf_stream])]
+    assert b"".join(devcs) == gpmf_stream
+    assert len(devcs) == len(parse.expand_klv(gpmf_stream))
+    for chunk_size in (1, 7, 4096):
+        chunks = (gpmf_stream[i:i + chunk_size] for i in range(0, len(gpmf_stream), chunk_size))
+        assert [bytes(item) for item in parse.iter_top_level(chunks)] == devcs
+
+
+def test_split_klv_cuts_between_top_level_items(gpmf_stream):
+
+    starts = set(np.cumsum([0] + [len(item) for item in parse.iter_top_level([gpmf_stream])]).tolist())
+    for nparts in (1, 3, 7, 1000):
+        bounds = parse.split_klv(gpmf_stream, nparts)
+        assert bounds[0][0] == 0 and bounds[-1][1] == len(gpmf_stream)
+        assert len(bounds) <= nparts
+        assert all(a == b for (_, a), (b, _) in zip(bounds[:-1], bounds[1:]))
+        assert all(start in starts for start, _ in bounds)
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+import spatial_index
+import time_utils
+
+start_timestamp = 1697537100 * 10 ** 9
+
+
+def _track(lat, long, start=start_timestamp):
+
+    return spatial_index.Track(np.arange(len(lat)) * 1000., np.asarray(lat, dtype=float), np.asarray(long, dtype=float), start)
+
+
+@pytest.fixture
+def index():
+
+    index = spatial_index.SpatialIndex(points_per_segment=16)
+    # north then east along a 0.1 degree square, and a clip elsewhere
+    index.insert("square", _track(np.r_[np.linspace(51., 51.1, 100), np.full(100, 51.1)],
+                                  np.r_[np.full(100, -0.2), np.linspace(-0.2, -0.1, 100)]))
+    index.insert("elsewhere", _track(np.linspace(40., 40.1, 100), np.linspace(2., 2.1, 100)))
+    return index
+
+
+def _brute_force(index, lat_min, lat_max, long_min, long_max):
+
+    segments = index.segments
+    hit = ((segments["lat_max"] >= lat_min) & (segments["lat_min"] <= lat_max) &
+           (segments["long_max"] >= long_min) & (segments["long_min"] <= long_max))
+    return sorted({index.clip_ids[clip] for clip in segments["clip"][hit]})
+
+
+def test_query_bbox_matches_brute_force(index):
+
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        lat, long = rng.uniform([39.9, -0.3], [51.2, 2.2])
+        size = rng.uniform(0.001, 0.05)
+        matches = index.query_bbox(lat, lat + size, long, long + size)
+        assert sorted({match.clip_id for match in matches}) == _brute_force(index, lat, lat + size, long, long + size)
+
+
+def test_query_point_and_time(index):
+
+    matches = index.query_point(51.1, -0.15, 100.)
+    assert [match.clip_id for match in matches] == ["square"]
+    assert 100000. <= matches[0].start_msecs <= 150000. <= matches[0].end_msecs
+
+    assert index.query_point(51.1, -0.15, 100., start=start_timestamp + 300 * 10 ** 9) == []
+    assert index.query_point(51.0, -0.2, 100., end=start_timestamp) != []
+
+
+def test_glitch_segment_stays_out_of_the_grid():
+
+    index = spatial_index.SpatialIndex(points_per_segment=16)
+    lat, long = np.linspace(51., 51.01, 100), np.linspace(-0.2, -0.19, 100)
+    # one fix on the other side of the world
+    lat[50], long[50] = -40., 170.
+    index.insert("glitch", _track(lat, long))
+    index._build_grid()
+
+    assert len(index._large_segments) == 1
+    assert len(index._cells) < 100
+    assert [match.clip_id for match in index.query_bbox(-41., -39., 169., 171.)] == ["glitch"]
+    assert [match.clip_id for match in index.query_point(51.005, -0.195, 50.)] == ["glitch"]
+
+
+def test_save_load_and_remove(tmp_path, index):
+
+    index.remove("elsewhere")
+    index.save(str(tmp_path / "index.npz"))
+    loaded = spatial_index.SpatialIndex.load(str(tmp_path / "index.npz"))
+
+    assert loaded.query_bbox(39.9, 40.2, 1.9, 2.2) == []
+    assert loaded.query_bbox(51., 51.1, -0.2, -0.1) == index.query_bbox(51., 51.1, -0.2, -0.1)
+
+
+def test_untimed_clip_never_matches_a_time_query():
+
+    index = spatial_index.SpatialIndex()
+    index.insert("untimed", _track(np.linspace(51., 51.01, 100), np.full(100, -0.2), start=None))
+
+    assert index.query_point(51.005, -0.2, 50.) != []
+    assert index.query_point(51.005, -0.2, 50., start=0) == []
+    assert index.clip_starts == [time_utils.NO_TIMESTAMP]
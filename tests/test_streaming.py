@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+import main
+import streaming
+import synthetic
+
+
+def _streamed(stream, chunk_size=5000):
+
+    chunks = list(streaming.decode_stream_chunks(stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)))
+    return {
+        sensor: (np.concatenate([chunk.msecs for chunk in chunks if chunk.sensor == sensor]),
+                 np.concatenate([chunk.columns[0] for chunk in chunks if chunk.sensor == sensor]))
+        for sensor in streaming.StreamDecoder.sensors
+    }
+
+
+@pytest.mark.parametrize("gps_fix_seconds", [0., 5.])
+def test_streamed_gpsu_timing_matches_full_decode(gps_fix_seconds):
+
+    stream = synthetic.make_gpmf_stream(20., gps_fix_seconds=gps_fix_seconds, stmp=False)
+    full = dict(zip(["gps", "gyro", "accl"], main.decode_gpmf_stream(stream)))
+
+    for sensor, (msecs, values) in _streamed(stream).items():
+        np.testing.assert_array_equal(values, getattr(full[sensor], full[sensor].columns[0]))
+        np.testing.assert_allclose(msecs, full[sensor].np_msecs, rtol=0, atol=1e-6)
+
+
+def test_streamed_stmp_timing_converges_to_full_decode(gpmf_stream):
+
+    full = dict(zip(["gps", "gyro", "accl"], main.decode_gpmf_stream(gpmf_stream)))
+
+    for sensor, (msecs, values) in _streamed(gpmf_stream).items():
+        np.testing.assert_array_equal(values, getattr(full[sensor], full[sensor].columns[0]))
+        # the running fit starts within a sample period of the fit over the whole stream, and converges
+        period = np.median(np.diff(full[sensor].np_msecs))
+        errors = np.abs(msecs - full[sensor].np_msecs)
+        assert errors.max() < period
+        assert errors[full[sensor].np_msecs > full[sensor].np_msecs[0] + 10000.].max() < period / 2
+
+
+def test_video_telemetry_streams_every_sample(gopro_clip, gpmf_stream):
+
+    chunks = list(streaming.iter_video_telemetry(gopro_clip, backend="native"))
+    full = dict(zip(["gps", "gyro", "accl"], main.decode_gpmf_stream(gpmf_stream)))
+
+    for sensor, telem in full.items():
+        sensor_chunks = [chunk for chunk in chunks if chunk.sensor == sensor]
+        # one chunk per DEVC once the sample period is known
+        assert len(sensor_chunks) >= 59
+        np.testing.assert_array_equal(np.concatenate([chunk.columns[1] for chunk in sensor_chunks]),
+                                      getattr(telem, telem.columns[1]))
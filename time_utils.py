@@ -0,0 +1,173 @@
+import numpy as np
+
+NS_PER_SECOND = 1000000000
+NS_PER_MSEC = 1000000
+# int64 value of numpy.datetime64("NaT"), marks missing timestamps
+NO_TIMESTAMP = np.iinfo(np.int64).min
+
+
+def parse_digits(chars, start, width):
+    """ Parse a fixed-width field of ASCII digits on every row at once
+    Parameters
+    ----------
+    chars: numpy.ndarray
+        (N, W) uint8 array, one text record per row.
+    start: int or numpy.ndarray
+        Column of the first digit, per row or shared by all rows.
+    width: int
+        The number of digits.
+    Returns
+    -------
+    values: numpy.ndarray
+        int64 array of shape (N,).
+    valid: numpy.ndarray
+        False for the rows where one of the characters is not a digit.
+    """
+    columns = np.asarray(start)[..., None] + np.arange(width)
+    digits = np.take_along_axis(chars, np.broadcast_to(columns, (len(chars), width)), axis=1).astype(np.int64) - ord("0")
+    valid = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    values = digits @ (10 ** np.arange(width - 1, -1, -1, dtype=np.int64))
+    return values, valid
+
+
+def civil_to_epoch_ns(year, month, day, hours, minutes, nanoseconds):
+    """ Convert UTC calendar fields to integer nanoseconds since the epoch
+    All arguments are integer arrays of the same shape. The conversion is
+    vectorized and does not depend on the local timezone.
+    Parameters
+    ----------
+    year, month, day, hours, minutes: numpy.ndarray
+        The calendar fields, month and day start at 1.
+    nanoseconds: numpy.ndarray
+        The seconds within the minute, in nanoseconds.
+    Returns
+    -------
+    epoch_ns: numpy.ndarray
+        int64 nanoseconds since 1970-01-01 00:00:00 UTC.
+    """
+    months = (np.asarray(year, dtype=np.int64) - 1970) * 12 + np.asarray(month, dtype=np.int64) - 1
+    days = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64) + np.asarray(day, dtype=np.int64) - 1
+    return ((days * 24 + hours) * 60 + minutes) * (60 * NS_PER_SECOND) + nanoseconds
+
+
+def gpsu_to_epoch_ns(gpsu):
+    """ Convert GPMF `GPSU` values to integer nanoseconds since the epoch
+    All the values are parsed in one vectorized pass over their fixed-width
+    "yymmddhhmmss.sss" digits.
+    Parameters
+    ----------
+    gpsu: list of bytes
+        The raw 16 character `GPSU` payloads, as returned by `parse.parse_payload`,
+        None for missing values.
+    Returns
+    -------
+    epoch_ns: numpy.ndarray
+        int64 UTC nanoseconds since the epoch, one per value, `NO_TIMESTAMP`
+        for missing values.
+    Raises
+    ------
+    ValueError: If a value is not a valid GPSU timestamp.
+    """
+    missing = np.array([t is None for t in gpsu], dtype=bool)
+    epoch_ns = np.full(len(gpsu), NO_TIMESTAMP, dtype=np.int64)
+    if missing.all():
+        return epoch_ns
+    chars = np.frombuffer(b"".join(bytes(t[:16]).ljust(16, b"\0") for t in gpsu if t is not None), dtype=np.uint8).reshape(-1, 16)
+
+    fields = [parse_digits(chars, start, width) for start, width in ((0, 2), (2, 2), (4, 2), (6, 2), (8, 2), (10, 2), (13, 3))]
+    (year, month, day, hours, minutes, seconds, msecs), valid = zip(*fields)
+    if not (np.logical_and.reduce(valid) & (chars[:, 12] == ord("."))).all():
+        raise ValueError("Invalid GPSU timestamp in %s" % gpsu)
+
+    epoch_ns[~missing] = civil_to_epoch_ns(2000 + year, month, day, hours, minutes, (seconds * 1000 + msecs) * NS_PER_MSEC)
+    return epoch_ns
+
+
+def fit_sample_period(stmp, first_samples):
+    """ Fit the camera time of sample 0 and the sample period of a stream
+    Parameters
+    ----------
+    stmp: numpy.ndarray
+        The camera time of the first sample of each block, in microseconds.
+    first_samples: numpy.ndarray
+        The index of the first sample of each block since the start of the recording.
+    Returns
+    -------
+    fit: tuple or None
+        (origin, period) in microseconds, None when there are not enough blocks
+        to fit a period.
+    """
+    stmp = np.asarray(stmp, dtype=np.float64)
+    first_samples = np.asarray(first_samples, dtype=np.int64)
+    x = first_samples - first_samples.mean() if len(first_samples) else first_samples
+    if len(stmp) < 2 or not x.any():
+        return None
+    period = np.dot(x, stmp - stmp.mean()) / np.dot(x, x)
+    return stmp.mean() - period * first_samples.mean(), period
+
+
+def fit_sample_msecs(stmp, first_samples, block_sizes):
+    """ Time every sample of a stream from the STMP and first sample of its blocks
+    A single least squares fit of STMP against the index of the first sample of
+    each block gives the sample period, so jitter on one block does not move
+    the others.
+    Parameters
+    ----------
+    stmp: numpy.ndarray
+        The camera time of the first sample of each block, in microseconds.
+    first_samples: numpy.ndarray
+        The index of the first sample of each block since the start of the
+        recording, e.g. TSMP minus the block size.
+    block_sizes: numpy.ndarray
+        The number of samples of each block.
+    Returns
+    -------
+    msecs: numpy.ndarray or None
+        The time of each sample in milliseconds on the camera clock, None when
+        there are not enough blocks to fit a period.
+    """
+    fit = fit_sample_period(stmp, first_samples)
+    if fit is None:
+        return None
+    return period_sample_msecs(fit, first_samples, block_sizes)
+
+
+def period_sample_msecs(fit, first_samples, block_sizes):
+    """ Time every sample of a stream from a fitted origin and period
+    Parameters
+    ----------
+    fit: tuple
+        (origin, period) in microseconds, see `fit_sample_period`.
+    first_samples: numpy.ndarray
+        The index of the first sample of each block since the start of the recording.
+    block_sizes: numpy.ndarray
+        The number of samples of each block.
+    Returns
+    -------
+    msecs: numpy.ndarray
+        The time of each sample in milliseconds on the camera clock.
+    """
+    origin, period = fit
+    first_samples = np.asarray(first_samples, dtype=np.int64)
+    block_sizes = np.asarray(block_sizes, dtype=np.int64)
+
+    npoints = int(block_sizes.sum())
+    block_starts = np.cumsum(block_sizes) - block_sizes
+    sample_indexes = np.repeat(first_samples - block_starts, block_sizes) + np.arange(npoints)
+    return (origin + period * sample_indexes) / 1000.
+
+
+def format_epoch_ns(epoch_ns, unit="ms"):
+    """ Format epoch nanoseconds as ISO 8601 UTC strings, for export only
+    Parameters
+    ----------
+    epoch_ns: numpy.ndarray
+        int64 nanoseconds since the epoch.
+    unit: str, optional (default="ms")
+        The resolution of the output, as a numpy datetime unit.
+    Returns
+    -------
+    strings: numpy.ndarray
+        Array of str.
+    """
+    return np.datetime_as_string(np.asarray(epoch_ns, dtype="datetime64[ns]"), unit=unit)
@@ -0,0 +1,142 @@
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import os
+import struct
+import sys
+import time
+
+import batch
+import mp4_reader
+
+ClipInfo = namedtuple("ClipInfo",
+                      [
+                          "video_path",
+                          "file_size",
+                          "kind",
+                          "codec_tag",
+                          "sample_count",
+                          "duration",
+                          "data_size",
+                          "error",
+                      ])
+
+# codec tag of the telemetry track: kind of clip, as in `batch.detect_kind`
+telemetry_kinds = {
+    "gpmd": "gopro",
+    "text": "nextbase",
+}
+
+
+def scan_file(video_path):
+    """ Describe the telemetry of a clip from its `moov` box only
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    Returns
+    -------
+    info: ClipInfo
+        The file size, the kind of clip ("gopro", "nextbase" or None), and the
+        codec tag, number of samples, duration in seconds and size in bytes of
+        its telemetry track. Errors are reported in `error`.
+    """
+    file_size = None
+    try:
+        file_size = os.path.getsize(video_path)
+        for track in mp4_reader.read_track_info(video_path, sized_codecs=list(telemetry_kinds)):
+            if track.codec_tag in telemetry_kinds:
+                return ClipInfo(video_path, file_size, telemetry_kinds[track.codec_tag], track.codec_tag,
+                                track.sample_count, track.duration / track.timescale if track.timescale else None,
+                                track.data_size, None)
+        return ClipInfo(video_path, file_size, None, None, 0, None, 0, None)
+    except (OSError, RuntimeError, KeyError, struct.error) as e:
+        return ClipInfo(video_path, file_size, None, None, 0, None, 0, "%s: %s" % (type(e).__name__, e))
+
+
+def scan_files(video_paths, workers=None):
+    """ Describe the telemetry of many clips
+    Parameters
+    ----------
+    video_paths: list of str
+        The input files
+    workers: int, optional
+        The number of threads. The scan waits on small reads, so threads help
+        on network filesystems. Defaults to scanning in this thread.
+    Returns
+    -------
+    infos: list of ClipInfo
+        In the order of `video_paths`.
+    """
+    if not workers or workers <= 1:
+        return [scan_file(video_path) for video_path in video_paths]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(scan_file, video_paths))
+
+
+def plan_shards(infos, nshards):
+    """ Split clips with telemetry into shards of about the same telemetry size
+    The largest clips are assigned first, each to the least loaded shard.
+    Parameters
+    ----------
+    infos: list of ClipInfo
+    nshards: int
+    Returns
+    -------
+    shards: list of list of str
+        The video paths of each shard.
+    """
+    shards = [[] for _ in range(nshards)]
+    loads = [(0, i) for i in range(nshards)]
+    for info in sorted((info for info in infos if info.kind is not None), key=lambda info: -(info.data_size or info.file_size)):
+        load, i = heapq.heappop(loads)
+        shards[i].append(info.video_path)
+        heapq.heappush(loads, (load + (info.data_size or info.file_size), i))
+    return shards
+
+
+def format_info(info):
+
+    if info.error is not None:
+        return "%s ERROR %s" % (info.video_path, info.error)
+    if info.kind is None:
+        return "%s none %.1f MB" % (info.video_path, info.file_size / 1e6)
+    return "%s %s %i samples %.1f s %.2f MB telemetry %.1f MB" % (
+        info.video_path, info.kind, info.sample_count, info.duration or 0., (info.data_size or 0) / 1e6, info.file_size / 1e6)
+
+
+def main_cli(argv=None):
+
+    parser = argparse.ArgumentParser(description="List the telemetry tracks of clips from their MP4 metadata, without decoding")
+    parser.add_argument("inputs", nargs="+", help="video files, directories or glob patterns")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of threads (default: 1)")
+    parser.add_argument("--shards", type=int, default=None, help="also split the clips with telemetry into this many shards")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the summary")
+    args = parser.parse_args(argv)
+
+    video_paths = batch.find_videos(args.inputs)
+    start = time.perf_counter()
+    infos = scan_files(video_paths, args.workers)
+    elapsed = time.perf_counter() - start
+
+    if not args.quiet:
+        for info in infos:
+            print(format_info(info))
+    for kind in sorted(set(telemetry_kinds.values())):
+        clips = [info for info in infos if info.kind == kind]
+        print("%s: %i clips, %.1f h, %.1f MB telemetry" % (
+            kind, len(clips), sum(info.duration or 0. for info in clips) / 3600., sum(info.data_size or 0 for info in clips) / 1e6))
+    print("%i files scanned in %.2fs (%.0f files/s), %i without telemetry, %i errors" % (
+        len(infos), elapsed, len(infos) / elapsed if elapsed else 0., sum(info.kind is None and info.error is None for info in infos),
+        sum(info.error is not None for info in infos)))
+
+    if args.shards:
+        for i, shard in enumerate(plan_shards(infos, args.shards)):
+            print("shard %i: %s" % (i, " ".join(shard)))
+    return 1 if any(info.error is not None for info in infos) else 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main_cli())
@@ -0,0 +1,156 @@
+import logging
+import struct
+
+import numpy as np
+
+from JE_ffprobe import JE_FFProbe
+import cache
+import gpmf_streams
+import instrument
+import mp4_reader
+
+logger = logging.getLogger(__name__)
+
+# file key: gpmd track of the file, so repeated windows of a clip read its moov once
+_tracks = {}
+max_cached_tracks = 256
+
+
+def get_gpmd_track(video_path):
+    """ Read the sample table of the `gpmd` track of a file, cached in memory
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    Returns
+    -------
+    track: mp4_reader.MP4Track
+    Raises
+    ------
+    RuntimeError: If the file has no `gpmd` track.
+    """
+    key = cache.file_key(video_path)
+    track = _tracks.get(key)
+    if track is None:
+        track = mp4_reader.find_track(video_path, "gpmd")
+        if len(_tracks) >= max_cached_tracks:
+            _tracks.pop(next(iter(_tracks)))
+        _tracks[key] = track
+    return track
+
+
+def select_samples(track, t0, t1):
+    """ Find the samples of a track covering a time range
+    Parameters
+    ----------
+    track: mp4_reader.MP4Track
+    t0, t1: float
+        The range in seconds from the start of the track.
+    Returns
+    -------
+    first, last: int
+        The first sample and one past the last sample overlapping [t0, t1).
+    """
+    starts = track.sample_times / track.timescale
+    ends = (track.sample_times + track.sample_durations) / track.timescale
+    return int(np.searchsorted(ends, t0, side="right")), int(np.searchsorted(starts, t1, side="left"))
+
+
+def _container_msecs(stream, track, first, last):
+    """ Sample times of a stream without STMP, spread over the container time of its samples """
+    npoints = len(next(iter(stream.columns.values())))
+    block_sizes = np.diff(np.append(stream.block_starts, npoints))
+    if len(block_sizes) == last - first:
+        # one block per gpmd sample, the usual layout
+        starts = track.sample_times[first:last] * 1000. / track.timescale
+        steps = track.sample_durations[first:last] * 1000. / track.timescale / np.maximum(block_sizes, 1)
+    else:
+        start = track.sample_times[first] * 1000. / track.timescale if last > first else 0.
+        end = (track.sample_times[last - 1] + track.sample_durations[last - 1]) * 1000. / track.timescale if last > first else 0.
+        starts = start + stream.block_starts * (end - start) / max(npoints, 1)
+        steps = np.full(len(block_sizes), (end - start) / max(npoints, 1))
+    offsets = np.arange(npoints) - np.repeat(stream.block_starts, block_sizes)
+    return np.repeat(starts, block_sizes) + offsets * np.repeat(steps, block_sizes)
+
+
+def trim_stream(stream, start_msecs, end_msecs):
+    """ Keep the samples of a decoded stream within a time range
+    Parameters
+    ----------
+    stream: gpmf_streams.GPMFStream
+        A stream with `msecs`.
+    start_msecs, end_msecs: float
+        The range to keep, [start_msecs, end_msecs).
+    Returns
+    -------
+    stream: gpmf_streams.GPMFStream
+        Views on the columns and times of the samples in range. `block_starts`,
+        `stmp` and `tsmp` keep the blocks the samples come from.
+    """
+    i0, i1 = np.searchsorted(stream.msecs, [start_msecs, end_msecs])
+    b0 = max(int(np.searchsorted(stream.block_starts, i0, side="right")) - 1, 0)
+    b1 = int(np.searchsorted(stream.block_starts, i1, side="left"))
+    return stream._replace(
+        columns={name: column[i0:i1] for name, column in stream.columns.items()},
+        msecs=stream.msecs[i0:i1],
+        block_starts=np.maximum(stream.block_starts[b0:b1] - i0, 0),
+        stmp=stream.stmp[b0:b1] if stream.stmp is not None else None,
+        tsmp=stream.tsmp[b0:b1] if stream.tsmp is not None else None,
+    )
+
+
+def extract(video_path, t0, t1, streams=("GPS5", "ACCL", "GYRO"), margin=5.):
+    """ Extract the telemetry of a time range of a GoPro clip
+    Only the `gpmd` samples covering the range are read from the file and
+    decoded, using the sample table of the container, so the cost depends on
+    the length of the range and not on the length of the clip.
+    Parameters
+    ----------
+    video_path: str
+        The input file
+    t0, t1: float
+        The range in seconds from the start of the clip.
+    streams: list of str, optional
+        The data fourccs to decode, see `gpmf_streams.decode_streams`.
+    margin: float, optional (default=5.)
+        Seconds read and decoded on each side of the range, so the sample
+        period is fitted from STMP over more blocks than the range holds.
+    Returns
+    -------
+    streams: dict of str to gpmf_streams.GPMFStream
+        The samples within [t0, t1). Times are in msecs on the camera clock as
+        with `gpmf_streams.decode_streams`, or on the container clock for the
+        streams without STMP.
+    Raises
+    ------
+    RuntimeError: If a stream without STMP is requested from a file whose
+        sample table cannot be read, as its samples cannot be timed.
+    """
+    try:
+        track = get_gpmd_track(video_path)
+        first, last = select_samples(track, t0 - margin, t1 + margin)
+        with instrument.stage("extract") as stage:
+            stream = mp4_reader.read_samples(video_path, track, first, last)
+            stage.add(bytes_in=len(stream))
+    except (RuntimeError, KeyError, struct.error):
+        # no native sample table, the whole track has to be extracted
+        track, first, last = None, 0, 0
+        stream = JE_FFProbe(video_path).extract_bin_stream("gpmd", backend="ffmpeg")
+    logger.debug("%s: %.1f-%.1f s, %i bytes", video_path, t0, t1, len(stream))
+
+    decoded = gpmf_streams.decode_streams(stream, list(streams))
+    for fourcc, decoded_stream in decoded.items():
+        if decoded_stream.msecs is not None:
+            # the range is on the container clock, the times on the camera clock
+            if track is not None and last > first:
+                shift = decoded_stream.msecs[0] - track.sample_times[first] * 1000. / track.timescale
+            else:
+                shift = 0.
+        elif track is not None:
+            decoded_stream = decoded_stream._replace(msecs=_container_msecs(decoded_stream, track, first, last))
+            shift = 0.
+        else:
+            raise RuntimeError("%s: %s has no STMP and the file no sample table, the samples of %.3f-%.3f s cannot be located"
+                               % (video_path, fourcc, t0, t1))
+        decoded[fourcc] = trim_stream(decoded_stream, t0 * 1000. + shift, t1 * 1000. + shift)
+    return decoded